@@ -4,43 +4,183 @@ import json
 import uuid
 from datetime import datetime
 import base64
-from encrypted_chat_app.encrypted_database import EncryptedDatabase
+import atexit
+import os
+from encrypted_chat_app.encrypted_database import EncryptedDatabase, MessageRing
+from encrypted_chat_app.metrics import CONTENT_TYPE, COUNT_BUCKETS, MetricsRegistry
+from encrypted_chat_app.delivery import RoomBatcher, parse_batch_rooms
+from encrypted_chat_app.ratelimit import RateLimiter, parse_budget
 
 # In-memory user session storage for legacy code (should be removed if using only EncryptedDatabase)
 user_sessions = {}
-public_messages = []
+public_messages = MessageRing(1000)
 group_rooms = {}
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-this'
-socketio = SocketIO(app, cors_allowed_origins="*")
 
-# Initialize encrypted database
-db = EncryptedDatabase("chat_data.db", "your-super-secure-database-password-2024")
+# Cluster workers (see cluster.py) share room fan-out through a message queue
+# and call a database server instead of owning the database file
+MESSAGE_QUEUE = os.environ.get('CHAT_MESSAGE_QUEUE')
+DB_ADDRESS = os.environ.get('CHAT_DB_ADDRESS')
+PORT = int(os.environ.get('CHAT_PORT', 5000))
+
+# Where the single-process server keeps its data; benchmarks/socketio_load.py points
+# these at a scratch file and turns the debug reloader off to measure one process
+DB_FILE = os.environ.get('CHAT_DB_FILE', 'chat_data.db')
+STORAGE_MODE = os.environ.get('CHAT_STORAGE_MODE', 'snapshot')
+DEBUG = os.environ.get('CHAT_DEBUG', '1') != '0'
+
+# Prometheus metrics at /metrics; CHAT_METRICS=0 turns all instrumentation off
+metrics = MetricsRegistry() if os.environ.get('CHAT_METRICS', '1') != '0' else None
+
+socketio_options = {'cors_allowed_origins': "*"}
+if MESSAGE_QUEUE and MESSAGE_QUEUE.startswith('local://'):
+    from encrypted_chat_app.cluster import LocalSocketManager
+    socketio_options['client_manager'] = LocalSocketManager(MESSAGE_QUEUE)
+elif MESSAGE_QUEUE:
+    socketio_options['message_queue'] = MESSAGE_QUEUE
+socketio = SocketIO(app, **socketio_options)
+
+if DB_ADDRESS:
+    from encrypted_chat_app.cluster import connect_database
+    db = connect_database(DB_ADDRESS, os.environ.get('CHAT_DB_AUTHKEY', ''))
+else:
+    # Initialize encrypted database
+    # Writes are group-committed by a background flusher so handlers never wait on disk
+    db = EncryptedDatabase(
+        DB_FILE,
+        "your-super-secure-database-password-2024",
+        storage_mode=STORAGE_MODE,
+        write_behind=True,
+        flush_interval_ms=100,
+        flush_max_ops=200,
+        metrics=metrics
+    )
+    atexit.register(db.close)
+
+# Messages sent on join and per load_history request; older history is paged in on scroll
+HISTORY_PAGE_SIZE = 30
+MAX_HISTORY_PAGE_SIZE = 100
+
+# Largest page of group summaries /admin/stats returns
+MAX_GROUPS_PAGE_SIZE = 500
+
+# Rooms whose new messages may be batched into one 'new_messages' event when
+# they arrive faster than one per window ('*' for all, unset for none), and
+# the most messages one batch holds
+BATCH_ROOMS = parse_batch_rooms(os.environ.get('CHAT_BATCH_ROOMS'))
+BATCH_WINDOW_MS = int(os.environ.get('CHAT_BATCH_WINDOW_MS', 25))
+BATCH_MAX = int(os.environ.get('CHAT_BATCH_MAX', 50))
+
+# Per-connection budgets as (events per second, burst); '0' turns one off.
+# Writes are refused while more than MAX_PENDING_WRITES wait for the flusher
+RATE_BUDGETS = {
+    'message': parse_budget(os.environ.get('CHAT_RATE_MESSAGES'), (5.0, 20.0)),
+    'create_group': parse_budget(os.environ.get('CHAT_RATE_GROUPS'), (0.1, 3.0)),
+    'join': parse_budget(os.environ.get('CHAT_RATE_JOINS'), (1.0, 10.0))
+}
+MAX_PENDING_WRITES = int(os.environ.get('CHAT_MAX_PENDING_WRITES', 5000))
+
+# How often a running backup's progress is relayed to the admin who started it
+BACKUP_POLL_INTERVAL = 0.5
 
 # Clean up old sessions on startup
 db.cleanup_old_sessions(24)  # Remove sessions older than 24 hours
 
+def room_size(room):
+    """Connections in a room of the default namespace"""
+    return len(socketio.server.manager.rooms.get('/', {}).get(room, ()))
+
+def socket_counts():
+    """Connected clients and shared rooms (every client also has a room of its own)"""
+    namespace = socketio.server.manager.rooms.get('/', {})
+    connected = namespace.get(None, {})
+    return len(connected), sum(1 for room in list(namespace) if room is not None and room not in connected)
+
+if metrics is not None:
+    event_seconds = metrics.histogram('chat_event_seconds', 'Socket.IO handler latency', ('event',))
+    emit_fanout = metrics.histogram(
+        'chat_emit_fanout', 'Connections a room emit is delivered to', ('event', 'room'), COUNT_BUCKETS
+    )
+    metrics.gauge('chat_connected_sids', 'Connected Socket.IO clients', function=lambda: socket_counts()[0])
+    metrics.gauge('chat_rooms', 'Rooms with at least one client', function=lambda: socket_counts()[1])
+    if DB_ADDRESS:
+        # Cluster workers report the database server's totals
+        metrics.gauge('chat_db_messages', 'Messages held in memory across all rooms',
+                      function=lambda: db.get_stats()['total_messages'])
+        metrics.gauge('chat_db_size_bytes', 'Bytes used on disk by the database',
+                      function=lambda: db.get_stats()['database_size'])
+    
+    @app.route('/metrics')
+    def metrics_endpoint():
+        """Prometheus scrape endpoint"""
+        return metrics.render(), 200, {'Content-Type': CONTENT_TYPE}
+
+def on_event(event):
+    """socketio.on that also records the handler's latency when metrics are on"""
+    def decorator(handler):
+        if metrics is not None:
+            handler = event_seconds.time(handler, (event,))
+        return socketio.on(event)(handler)
+    return decorator
+
+def record_fanout(event, room):
+    """Record how many connections a room emit reaches; group rooms share one series"""
+    if metrics is not None:
+        emit_fanout.observe(room_size(room), (event, 'public' if room == 'public' else 'group'))
+
+def emit_message(room, message):
+    record_fanout('new_message', room)
+    socketio.emit('new_message', message, to=room)
+
+def emit_messages(room, messages):
+    record_fanout('new_messages', room)
+    socketio.emit('new_messages', {'room': room, 'messages': messages}, to=room)
+
+def schedule_flush(delay, callback):
+    def run():
+        socketio.sleep(delay)
+        callback()
+    socketio.start_background_task(run)
+
+outbound = RoomBatcher(emit_message, emit_messages, schedule_flush, BATCH_ROOMS, BATCH_WINDOW_MS, BATCH_MAX)
+
+limiter = RateLimiter(RATE_BUDGETS, db.pending_writes, MAX_PENDING_WRITES, metrics=metrics)
+
+def throttled(event, action, username=None):
+    """Send rate_limited and return True when the client is over budget or the database is backed up"""
+    keys = (request.sid, f"user:{username}") if username is not None else (request.sid,)
+    refused = limiter.check(action, keys)
+    if refused is None:
+        return False
+    reason, retry_after = refused
+    emit('rate_limited', {'event': event, 'reason': reason, 'retry_after': retry_after})
+    return True
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/admin/stats')
 def admin_stats():
-    """Admin endpoint to view database statistics"""
-    stats = db.get_stats()
-    db_info = db.get_database_info()
-    return {
-        'stats': stats,
-        'database_info': db_info,
-        'groups': db.get_all_groups()
+    """Admin endpoint to view database statistics; ?groups_limit=N[&groups_offset=M] adds a page of groups"""
+    response = {
+        'stats': db.get_stats(),
+        'database_info': db.get_database_info(),
+        'rate_limits': limiter.get_stats()
     }
+    limit = request.args.get('groups_limit', 0, type=int)
+    if limit > 0:
+        offset = request.args.get('groups_offset', 0, type=int)
+        response['groups'] = db.get_groups_page(offset, min(limit, MAX_GROUPS_PAGE_SIZE))
+    return response
 
-@socketio.on('connect')
-def handle_connect():
+@on_event('connect')
+def handle_connect(auth=None):
     print(f'User connected: {request.sid}')
 
-@socketio.on('disconnect')
+@on_event('disconnect')
 def handle_disconnect():
     print(f'User disconnected: {request.sid}')
     # Remove user from all rooms and clean up
@@ -51,12 +191,19 @@ def handle_disconnect():
         for room in rooms(request.sid):
             if room != request.sid:  # Don't leave own room
                 leave_room(room)
+                record_fanout('user_left', room)
                 emit('user_left', {'username': username}, room=room)
         db.remove_session(request.sid)
+    # The username's buckets stay until they refill, so a reconnect starts where it left off
+    limiter.forget(request.sid)
 
-@socketio.on('join_chat')
+@on_event('join_chat')
 def handle_join_chat(data):
     username = data['username']
+    # Charged to the name too, so reconnecting does not buy a fresh burst of joins
+    if throttled('join_chat', 'join', username):
+        return
+    
     user_id = str(uuid.uuid4())
     
     # Store user in database
@@ -70,30 +217,35 @@ def handle_join_chat(data):
     }
     db.add_session(request.sid, session_data)
     
-    # Join public room by default
+    # Join public room by default. Usernames are not authenticated, so nothing about
+    # the groups this name belongs to is revealed; the client re-enters them through
+    # join_group, which checks the group password
     join_room('public')
     
     # Get recent messages and groups
-    public_messages = db.get_public_messages(50)
-    available_groups = list(db.get_all_groups().keys())
+    history = db.get_messages_page('public', limit=HISTORY_PAGE_SIZE)
+    group_list = db.get_group_list()
     
     emit('chat_joined', {
         'user_id': user_id,
         'username': username,
-        'public_messages': public_messages,
-        'available_groups': available_groups
+        'public_messages': history['messages'],
+        'has_more_history': history['has_more'],
+        'available_groups': group_list['available_groups'],
+        'group_list_version': group_list['version']
     })
     
     # Notify others in public room
+    record_fanout('user_joined', 'public')
     emit('user_joined', {
         'username': username,
         'room': 'public'
     }, room='public', include_self=False)
 
-@socketio.on('send_public_message')
+@on_event('send_public_message')
 def handle_public_message(data):
     session_data = db.get_session(request.sid)
-    if not session_data:
+    if not session_data or throttled('send_public_message', 'message', session_data['username']):
         return
     
     message_data = {
@@ -111,25 +263,27 @@ def handle_public_message(data):
     
     # Update user activity
     db.update_user_activity(session_data['user_id'])
+    db.touch_session(request.sid)
     
-    # Emit to all users in public room
-    emit('new_message', message_data, room='public')
+    # Emit to all users in public room, batched while it is busy if configured
+    outbound.send('public', message_data)
 
-@socketio.on('create_group')
+@on_event('create_group')
 def handle_create_group(data):
     session_data = db.get_session(request.sid)
-    if not session_data:
+    if not session_data or throttled('create_group', 'create_group', session_data['username']):
         return
     
     group_name = data['group_name']
     password = data.get('password', '')
     
     # Check if group already exists
-    if db.get_group(group_name):
+    if db.has_group(group_name):
         emit('error', {'message': 'Group already exists'})
         return
     
     # Create group in database
+    version_before = db.get_group_list_version()
     group_data = db.create_group(group_name, session_data['username'], password)
     if not group_data:
         emit('error', {'message': 'Failed to create group'})
@@ -142,15 +296,21 @@ def handle_create_group(data):
         'group_id': group_data['id']
     })
     
-    # Notify all users about new group
-    emit('group_list_updated', {
-        'available_groups': list(db.get_all_groups().keys())
-    }, broadcast=True)
+    # Notify all users about the new group with a delta, not the whole list
+    changes = db.get_group_list_changes(version_before)
+    if changes:
+        emit('group_list_updated', changes, broadcast=True)
 
-@socketio.on('join_group')
+@on_event('sync_group_list')
+def handle_sync_group_list(data):
+    """Catch a client up from its group list version, with a full list if it is too stale"""
+    changes = db.get_group_list_changes((data or {}).get('version'))
+    emit('group_list_updated', changes or db.get_group_list())
+
+@on_event('join_group')
 def handle_join_group(data):
     session_data = db.get_session(request.sid)
-    if not session_data:
+    if not session_data or throttled('join_group', 'join', session_data['username']):
         return
     
     group_name = data['group_name']
@@ -164,31 +324,33 @@ def handle_join_group(data):
     join_room(group_name)
     
     # Get group messages
-    group_messages = db.get_group_messages(group_name, 50)
+    history = db.get_messages_page(group_name, limit=HISTORY_PAGE_SIZE)
     group_data = db.get_group(group_name)
     
     emit('group_joined', {
         'group_name': group_name,
-        'messages': group_messages,
+        'messages': history['messages'],
+        'has_more_history': history['has_more'],
         'members': group_data['members'] if group_data else []
     })
     
     # Notify others in the group
+    record_fanout('user_joined', group_name)
     emit('user_joined', {
         'username': session_data['username'],
         'room': group_name
     }, room=group_name, include_self=False)
 
-@socketio.on('send_group_message')
+@on_event('send_group_message')
 def handle_group_message(data):
     session_data = db.get_session(request.sid)
-    if not session_data:
+    if not session_data or throttled('send_group_message', 'message', session_data['username']):
         return
     
     group_name = data['group_name']
     
     # Check if group exists
-    if not db.get_group(group_name):
+    if not db.has_group(group_name):
         emit('error', {'message': 'Group does not exist'})
         return
     
@@ -207,11 +369,46 @@ def handle_group_message(data):
     
     # Update user activity
     db.update_user_activity(session_data['user_id'])
+    db.touch_session(request.sid)
     
-    # Emit to all users in the group
-    emit('new_message', message_data, room=group_name)
+    # Emit to all users in the group, batched while it is busy if configured
+    outbound.send(group_name, message_data)
 
-@socketio.on('leave_group')
+@on_event('load_history')
+def handle_load_history(data=None):
+    """Page older messages of a joined room, newest page first"""
+    session_data = db.get_session(request.sid)
+    if not session_data:
+        return
+    
+    data = data or {}
+    room = data.get('room', 'public')
+    
+    # Only rooms this connection has actually joined
+    if room not in rooms(request.sid):
+        return
+    
+    try:
+        limit = min(int(data.get('limit', HISTORY_PAGE_SIZE)), MAX_HISTORY_PAGE_SIZE)
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    
+    history = db.get_messages_page(
+        room,
+        before_message_id=data.get('before_message_id'),
+        before_timestamp=data.get('before_timestamp'),
+        limit=max(limit, 1)
+    )
+    
+    emit('history_loaded', {
+        'room': room,
+        'messages': history['messages'],
+        'has_more': history['has_more'],
+        'before_message_id': data.get('before_message_id'),
+        'before_timestamp': data.get('before_timestamp')
+    })
+
+@on_event('leave_group')
 def handle_leave_group(data):
     session_data = db.get_session(request.sid)
     if not session_data:
@@ -226,12 +423,13 @@ def handle_leave_group(data):
         emit('group_left', {'group_name': group_name})
         
         # Notify others in the group
+        record_fanout('user_left', group_name)
         emit('user_left', {
             'username': session_data['username'],
             'room': group_name
         }, room=group_name)
 
-@socketio.on('get_user_stats')
+@on_event('get_user_stats')
 def handle_get_user_stats():
     """Get user statistics"""
     session_data = db.get_session(request.sid)
@@ -242,13 +440,13 @@ def handle_get_user_stats():
     if user_data:
         emit('user_stats', {
             'message_count': user_data.get('message_count', 0),
-            'groups_joined': len(user_data.get('groups_joined', [])),
+            'groups_joined': len(db.get_user_groups(session_data['username'])),
             'created_at': user_data.get('created_at'),
             'last_active': user_data.get('last_active')
         })
 
-@socketio.on('backup_database')
-def handle_backup_database():
+@on_event('backup_database')
+def handle_backup_database(data=None):
     """Create database backup (admin function)"""
     session_data = db.get_session(request.sid)
     if not session_data:
@@ -256,13 +454,30 @@ def handle_backup_database():
     
     # Simple admin check (in production, implement proper admin authentication)
     if session_data['username'] == 'admin':
-        backup_file = db.create_backup()
-        if backup_file:
-            emit('backup_created', {'backup_file': backup_file})
-        else:
-            emit('error', {'message': 'Failed to create backup'})
+        # The snapshot is taken now; encryption and writing happen off this handler
+        job = db.start_backup(incremental=bool((data or {}).get('incremental')))
+        emit('backup_started', job)
+        socketio.start_background_task(report_backup_progress, request.sid, job['backup_id'])
+
+def report_backup_progress(sid, backup_id):
+    """Relay a running backup's progress to the admin who started it"""
+    reported = 0.0
+    while True:
+        socketio.sleep(BACKUP_POLL_INTERVAL)
+        job = db.get_backup_status(backup_id)
+        if not job:
+            return
+        if job['status'] == 'done':
+            socketio.emit('backup_created', job, to=sid)
+            return
+        if job['status'] == 'failed':
+            socketio.emit('error', {'message': 'Failed to create backup'}, to=sid)
+            return
+        if job['progress'] > reported:
+            reported = job['progress']
+            socketio.emit('backup_progress', job, to=sid)
 
-# Periodic cleanup task (run every hour)
+# Periodic cleanup task (run every minute)
 import threading
 import time
 
@@ -270,22 +485,25 @@ def periodic_cleanup():
     """Periodic cleanup of old sessions and maintenance"""
     while True:
         try:
-            # Clean up old sessions every hour
-            time.sleep(3600)  # 1 hour
-            removed_sessions = db.cleanup_old_sessions(24)
+            # Expiry pops idle sessions off a heap, so sweeping often is cheap
+            time.sleep(60)
+            removed_sessions = db.cleanup_old_sessions(24, limit=1000)
             if removed_sessions > 0:
                 print(f"Cleaned up {removed_sessions} old sessions")
         except Exception as e:
             print(f"Error in periodic cleanup: {e}")
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
-cleanup_thread.start()
+# Start cleanup thread and rewrite old-schema history in the background;
+# the database server does both for cluster workers
+if not DB_ADDRESS:
+    cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
+    cleanup_thread.start()
+    threading.Thread(target=db.migrate_messages, daemon=True).start()
 
 if __name__ == '__main__':
     print("Starting Encrypted Chat Server...")
     print(f"Database initialized with {len(db.get_all_users())} users")
-    print(f"Database file: {db.db_file}")
+    print(f"Database file: {db.get_database_info()['file_path']}")
     
     # Print startup statistics
     stats = db.get_stats()
@@ -294,7 +512,11 @@ if __name__ == '__main__':
         print(f"{key}: {value}")
     print("===========================\n")
     
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
+    if DB_ADDRESS or not DEBUG:
+        # Cluster workers and benchmark servers run unattended, without the reloader
+        socketio.run(app, host='0.0.0.0', port=PORT, allow_unsafe_werkzeug=True)
+    else:
+        socketio.run(app, debug=True, host='0.0.0.0', port=PORT)
 
 @socketio.on('join_chat')
 def handle_join_chat(data):
@@ -314,7 +536,7 @@ def handle_join_chat(data):
     emit('chat_joined', {
         'user_id': user_id,
         'username': username,
-        'public_messages': public_messages[-50:],  # Last 50 messages
+        'public_messages': public_messages.tail(50),  # Last 50 messages
         'available_groups': list(group_rooms.keys())
     })
     
@@ -339,12 +561,9 @@ def handle_public_message(data):
         'room': 'public'
     }
     
+    # Ring buffer drops the oldest of the last 1000 messages
     public_messages.append(message)
     
-    # Keep only last 1000 messages
-    if len(public_messages) > 1000:
-        public_messages.pop(0)
-    
     emit('new_message', message, room='public')
 
 @socketio.on('create_group')
@@ -367,7 +586,7 @@ def handle_create_group(data):
         'creator': user_info['username'],
         'password': password,
         'members': [user_info['username']],
-        'messages': []
+        'messages': MessageRing(1000)
     }
     
     join_room(group_name)
@@ -412,7 +631,7 @@ def handle_join_group(data):
     
     emit('group_joined', {
         'group_name': group_name,
-        'messages': group['messages'][-50:],  # Last 50 messages
+        'messages': group['messages'].tail(50),  # Last 50 messages
         'members': group['members']
     })
     
@@ -443,12 +662,9 @@ def handle_group_message(data):
         'room': group_name
     }
     
+    # Ring buffer keeps only the last 1000 messages per group
     group_rooms[group_name]['messages'].append(message)
     
-    # Keep only last 1000 messages per group
-    if len(group_rooms[group_name]['messages']) > 1000:
-        group_rooms[group_name]['messages'].pop(0)
-    
     emit('new_message', message, room=group_name)
 
 @socketio.on('leave_group')
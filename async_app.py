@@ -0,0 +1,484 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime
+from aiohttp import web  # type: ignore
+import socketio  # type: ignore
+from encrypted_chat_app.encrypted_database import AsyncEncryptedDatabase
+from encrypted_chat_app.metrics import CONTENT_TYPE, COUNT_BUCKETS, MetricsRegistry
+from encrypted_chat_app.delivery import RoomBatcher, parse_batch_rooms
+from encrypted_chat_app.ratelimit import RateLimiter, parse_budget
+
+# asyncio entry point: the same Socket.IO events as app.py, served by
+# python-socketio's AsyncServer on aiohttp. Idle websockets cost no threads,
+# and database work runs in AsyncEncryptedDatabase's thread pool.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins="*")
+app = web.Application()
+sio.attach(app)
+
+# Same settings as app.py's single-process server
+PORT = int(os.environ.get('CHAT_PORT', 5000))
+DB_FILE = os.environ.get('CHAT_DB_FILE', 'chat_data.db')
+STORAGE_MODE = os.environ.get('CHAT_STORAGE_MODE', 'snapshot')
+BATCH_ROOMS = parse_batch_rooms(os.environ.get('CHAT_BATCH_ROOMS'))
+BATCH_WINDOW_MS = int(os.environ.get('CHAT_BATCH_WINDOW_MS', 25))
+BATCH_MAX = int(os.environ.get('CHAT_BATCH_MAX', 50))
+RATE_BUDGETS = {
+    'message': parse_budget(os.environ.get('CHAT_RATE_MESSAGES'), (5.0, 20.0)),
+    'create_group': parse_budget(os.environ.get('CHAT_RATE_GROUPS'), (0.1, 3.0)),
+    'join': parse_budget(os.environ.get('CHAT_RATE_JOINS'), (1.0, 10.0))
+}
+MAX_PENDING_WRITES = int(os.environ.get('CHAT_MAX_PENDING_WRITES', 5000))
+
+# Prometheus metrics at /metrics; CHAT_METRICS=0 turns all instrumentation off
+metrics = MetricsRegistry() if os.environ.get('CHAT_METRICS', '1') != '0' else None
+
+# Initialize encrypted database
+# Writes are group-committed by a background flusher so handlers never wait on disk
+db = AsyncEncryptedDatabase(
+    DB_FILE,
+    "your-super-secure-database-password-2024",
+    storage_mode=STORAGE_MODE,
+    write_behind=True,
+    flush_interval_ms=100,
+    flush_max_ops=200,
+    metrics=metrics
+)
+
+# Messages sent on join and per load_history request; older history is paged in on scroll
+HISTORY_PAGE_SIZE = 30
+MAX_HISTORY_PAGE_SIZE = 100
+
+# Largest page of group summaries /admin/stats returns
+MAX_GROUPS_PAGE_SIZE = 500
+
+# How often a running backup's progress is relayed to the admin who started it
+BACKUP_POLL_INTERVAL = 0.5
+
+async def index(request):
+    return web.FileResponse(os.path.join(BASE_DIR, 'templates', 'index.html'))
+
+def query_int(request, name, default=0):
+    try:
+        return int(request.query.get(name, default))
+    except ValueError:
+        return default
+
+async def admin_stats(request):
+    """Admin endpoint to view database statistics; ?groups_limit=N[&groups_offset=M] adds a page of groups"""
+    response = {
+        'stats': db.get_stats(),
+        'database_info': await db.get_database_info(),
+        'rate_limits': limiter.get_stats()
+    }
+    limit = query_int(request, 'groups_limit')
+    if limit > 0:
+        offset = query_int(request, 'groups_offset')
+        response['groups'] = await db.get_groups_page(offset, min(limit, MAX_GROUPS_PAGE_SIZE))
+    return web.json_response(response)
+
+def room_size(room):
+    """Connections in a room of the default namespace"""
+    return len(sio.manager.rooms.get('/', {}).get(room, ()))
+
+def socket_counts():
+    """Connected clients and shared rooms (every client also has a room of its own)"""
+    namespace = sio.manager.rooms.get('/', {})
+    connected = namespace.get(None, {})
+    return len(connected), sum(1 for room in list(namespace) if room is not None and room not in connected)
+
+if metrics is not None:
+    event_seconds = metrics.histogram('chat_event_seconds', 'Socket.IO handler latency', ('event',))
+    emit_fanout = metrics.histogram(
+        'chat_emit_fanout', 'Connections a room emit is delivered to', ('event', 'room'), COUNT_BUCKETS
+    )
+    metrics.gauge('chat_connected_sids', 'Connected Socket.IO clients', function=lambda: socket_counts()[0])
+    metrics.gauge('chat_rooms', 'Rooms with at least one client', function=lambda: socket_counts()[1])
+    
+    async def metrics_endpoint(request):
+        """Prometheus scrape endpoint"""
+        return web.Response(body=metrics.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+    
+    app.router.add_get('/metrics', metrics_endpoint)
+
+def timed_event(handler):
+    """sio.event that also records the handler's latency when metrics are on"""
+    if metrics is not None:
+        handler = event_seconds.time(handler, (handler.__name__,))
+    return sio.event(handler)
+
+def record_fanout(event, room):
+    """Record how many connections a room emit reaches; group rooms share one series"""
+    if metrics is not None:
+        emit_fanout.observe(room_size(room), (event, 'public' if room == 'public' else 'group'))
+
+def emit_message(room, message):
+    record_fanout('new_message', room)
+    sio.start_background_task(sio.emit, 'new_message', message, room=room)
+
+def emit_messages(room, messages):
+    record_fanout('new_messages', room)
+    sio.start_background_task(sio.emit, 'new_messages', {'room': room, 'messages': messages}, room=room)
+
+# Batches are emitted from tasks so the batcher never awaits under its lock
+outbound = RoomBatcher(
+    emit_message, emit_messages, lambda delay, callback: asyncio.get_running_loop().call_later(delay, callback),
+    BATCH_ROOMS, BATCH_WINDOW_MS, BATCH_MAX
+)
+
+limiter = RateLimiter(RATE_BUDGETS, db.pending_writes, MAX_PENDING_WRITES, metrics=metrics)
+
+async def throttled(sid, event, action, username=None):
+    """Send rate_limited and return True when the client is over budget or the database is backed up"""
+    keys = (sid, f"user:{username}") if username is not None else (sid,)
+    refused = limiter.check(action, keys)
+    if refused is None:
+        return False
+    reason, retry_after = refused
+    await sio.emit('rate_limited', {'event': event, 'reason': reason, 'retry_after': retry_after}, to=sid)
+    return True
+
+async def deliver(room, message):
+    """Emit a new message, or hand it to the batcher in rooms that batch"""
+    if outbound.batches(room):
+        outbound.send(room, message)
+    else:
+        record_fanout('new_message', room)
+        await sio.emit('new_message', message, room=room)
+
+app.router.add_get('/', index)
+app.router.add_get('/admin/stats', admin_stats)
+app.router.add_static('/static/', os.path.join(BASE_DIR, 'static'))
+
+@timed_event
+async def connect(sid, environ, auth=None):
+    print(f'User connected: {sid}')
+
+@timed_event
+async def disconnect(sid):
+    print(f'User disconnected: {sid}')
+    session_data = db.get_session(sid)
+    if session_data:
+        username = session_data['username']
+        # Leave all rooms
+        for room in sio.rooms(sid):
+            if room != sid:  # Don't leave own room
+                sio.leave_room(sid, room)
+                record_fanout('user_left', room)
+                await sio.emit('user_left', {'username': username}, room=room)
+        await db.remove_session(sid)
+    # The username's buckets stay until they refill, so a reconnect starts where it left off
+    limiter.forget(sid)
+
+@timed_event
+async def join_chat(sid, data):
+    username = data['username']
+    # Charged to the name too, so reconnecting does not buy a fresh burst of joins
+    if await throttled(sid, 'join_chat', 'join', username):
+        return
+    
+    user_id = str(uuid.uuid4())
+    
+    # Store user in database
+    await db.add_user(user_id, username, data.get('public_key', ''))
+    
+    # Store user session
+    await db.add_session(sid, {
+        'username': username,
+        'user_id': user_id,
+        'public_key': data.get('public_key', '')
+    })
+    
+    # Join public room by default. Usernames are not authenticated, so nothing about
+    # the groups this name belongs to is revealed; the client re-enters them through
+    # join_group, which checks the group password
+    sio.enter_room(sid, 'public')
+    
+    # Get recent messages and groups
+    history = await db.get_messages_page('public', limit=HISTORY_PAGE_SIZE)
+    group_list = await db.get_group_list()
+    
+    await sio.emit('chat_joined', {
+        'user_id': user_id,
+        'username': username,
+        'public_messages': history['messages'],
+        'has_more_history': history['has_more'],
+        'available_groups': group_list['available_groups'],
+        'group_list_version': group_list['version']
+    }, to=sid)
+    
+    # Notify others in public room
+    record_fanout('user_joined', 'public')
+    await sio.emit('user_joined', {
+        'username': username,
+        'room': 'public'
+    }, room='public', skip_sid=sid)
+
+@timed_event
+async def send_public_message(sid, data):
+    session_data = db.get_session(sid)
+    if not session_data or await throttled(sid, 'send_public_message', 'message', session_data['username']):
+        return
+    
+    message_data = {
+        'id': str(uuid.uuid4()),
+        'user_id': session_data['user_id'],
+        'username': session_data['username'],
+        'message': data['message'],
+        'encrypted_content': data.get('encrypted_content', ''),
+        'timestamp': datetime.now().isoformat(),
+        'room': 'public'
+    }
+    
+    # Store message in encrypted database
+    await db.add_public_message(message_data)
+    
+    # Update user activity
+    await db.update_user_activity(session_data['user_id'])
+    await db.touch_session(sid)
+    
+    # Emit to all users in public room, batched while it is busy if configured
+    await deliver('public', message_data)
+
+@timed_event
+async def create_group(sid, data):
+    session_data = db.get_session(sid)
+    if not session_data or await throttled(sid, 'create_group', 'create_group', session_data['username']):
+        return
+    
+    group_name = data['group_name']
+    password = data.get('password', '')
+    
+    # Check if group already exists
+    if db.has_group(group_name):
+        await sio.emit('error', {'message': 'Group already exists'}, to=sid)
+        return
+    
+    # Create group in database
+    version_before = db.get_group_list_version()
+    group_data = await db.create_group(group_name, session_data['username'], password)
+    if not group_data:
+        await sio.emit('error', {'message': 'Failed to create group'}, to=sid)
+        return
+    
+    sio.enter_room(sid, group_name)
+    
+    await sio.emit('group_created', {
+        'group_name': group_name,
+        'group_id': group_data['id']
+    }, to=sid)
+    
+    # Notify all users about the new group with a delta, not the whole list
+    changes = await db.get_group_list_changes(version_before)
+    if changes:
+        await sio.emit('group_list_updated', changes)
+
+@timed_event
+async def sync_group_list(sid, data):
+    """Catch a client up from its group list version, with a full list if it is too stale"""
+    changes = await db.get_group_list_changes((data or {}).get('version'))
+    await sio.emit('group_list_updated', changes or await db.get_group_list(), to=sid)
+
+@timed_event
+async def join_group(sid, data):
+    session_data = db.get_session(sid)
+    if not session_data or await throttled(sid, 'join_group', 'join', session_data['username']):
+        return
+    
+    group_name = data['group_name']
+    password = data.get('password', '')
+    
+    # Try to join group in database
+    if not await db.join_group(group_name, session_data['username'], password):
+        await sio.emit('error', {'message': 'Failed to join group. Check password.'}, to=sid)
+        return
+    
+    sio.enter_room(sid, group_name)
+    
+    # Get group messages
+    history = await db.get_messages_page(group_name, limit=HISTORY_PAGE_SIZE)
+    group_data = await db.get_group(group_name)
+    
+    await sio.emit('group_joined', {
+        'group_name': group_name,
+        'messages': history['messages'],
+        'has_more_history': history['has_more'],
+        'members': group_data['members'] if group_data else []
+    }, to=sid)
+    
+    # Notify others in the group
+    record_fanout('user_joined', group_name)
+    await sio.emit('user_joined', {
+        'username': session_data['username'],
+        'room': group_name
+    }, room=group_name, skip_sid=sid)
+
+@timed_event
+async def send_group_message(sid, data):
+    session_data = db.get_session(sid)
+    if not session_data or await throttled(sid, 'send_group_message', 'message', session_data['username']):
+        return
+    
+    group_name = data['group_name']
+    
+    # Check if group exists
+    if not db.has_group(group_name):
+        await sio.emit('error', {'message': 'Group does not exist'}, to=sid)
+        return
+    
+    message_data = {
+        'id': str(uuid.uuid4()),
+        'user_id': session_data['user_id'],
+        'username': session_data['username'],
+        'message': data['message'],
+        'encrypted_content': data.get('encrypted_content', ''),
+        'timestamp': datetime.now().isoformat(),
+        'room': group_name
+    }
+    
+    # Store message in encrypted database
+    await db.add_group_message(group_name, message_data)
+    
+    # Update user activity
+    await db.update_user_activity(session_data['user_id'])
+    await db.touch_session(sid)
+    
+    # Emit to all users in the group, batched while it is busy if configured
+    await deliver(group_name, message_data)
+
+@timed_event
+async def load_history(sid, data=None):
+    """Page older messages of a joined room, newest page first"""
+    session_data = db.get_session(sid)
+    if not session_data:
+        return
+    
+    data = data or {}
+    room = data.get('room', 'public')
+    
+    # Only rooms this connection has actually joined
+    if room not in sio.rooms(sid):
+        return
+    
+    try:
+        limit = min(int(data.get('limit', HISTORY_PAGE_SIZE)), MAX_HISTORY_PAGE_SIZE)
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    
+    history = await db.get_messages_page(
+        room,
+        before_message_id=data.get('before_message_id'),
+        before_timestamp=data.get('before_timestamp'),
+        limit=max(limit, 1)
+    )
+    
+    await sio.emit('history_loaded', {
+        'room': room,
+        'messages': history['messages'],
+        'has_more': history['has_more'],
+        'before_message_id': data.get('before_message_id'),
+        'before_timestamp': data.get('before_timestamp')
+    }, to=sid)
+
+@timed_event
+async def leave_group(sid, data):
+    session_data = db.get_session(sid)
+    if not session_data:
+        return
+    
+    group_name = data['group_name']
+    
+    # Remove user from group in database
+    if await db.leave_group(group_name, session_data['username']):
+        sio.leave_room(sid, group_name)
+        
+        await sio.emit('group_left', {'group_name': group_name}, to=sid)
+        
+        # Notify others in the group
+        record_fanout('user_left', group_name)
+        await sio.emit('user_left', {
+            'username': session_data['username'],
+            'room': group_name
+        }, room=group_name)
+
+@timed_event
+async def get_user_stats(sid):
+    """Get user statistics"""
+    session_data = db.get_session(sid)
+    if not session_data:
+        return
+    
+    user_data = await db.get_user(session_data['user_id'])
+    if user_data:
+        await sio.emit('user_stats', {
+            'message_count': user_data.get('message_count', 0),
+            'groups_joined': len(await db.get_user_groups(session_data['username'])),
+            'created_at': user_data.get('created_at'),
+            'last_active': user_data.get('last_active')
+        }, to=sid)
+
+@timed_event
+async def backup_database(sid, data=None):
+    """Create database backup (admin function)"""
+    session_data = db.get_session(sid)
+    if not session_data:
+        return
+    
+    # Simple admin check (in production, implement proper admin authentication)
+    if session_data['username'] == 'admin':
+        # The snapshot is taken now; encryption and writing happen off the event loop
+        job = await db.start_backup(incremental=bool((data or {}).get('incremental')))
+        await sio.emit('backup_started', job, to=sid)
+        sio.start_background_task(report_backup_progress, sid, job['backup_id'])
+
+async def report_backup_progress(sid, backup_id):
+    """Relay a running backup's progress to the admin who started it"""
+    reported = 0.0
+    while True:
+        await asyncio.sleep(BACKUP_POLL_INTERVAL)
+        job = db.get_backup_status(backup_id)
+        if not job:
+            return
+        if job['status'] == 'done':
+            await sio.emit('backup_created', job, to=sid)
+            return
+        if job['status'] == 'failed':
+            await sio.emit('error', {'message': 'Failed to create backup'}, to=sid)
+            return
+        if job['progress'] > reported:
+            reported = job['progress']
+            await sio.emit('backup_progress', job, to=sid)
+
+async def periodic_cleanup():
+    """Periodic cleanup of old sessions"""
+    while True:
+        try:
+            await asyncio.sleep(60)
+            removed_sessions = await db.cleanup_old_sessions(24, limit=1000)
+            if removed_sessions > 0:
+                print(f"Cleaned up {removed_sessions} old sessions")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in periodic cleanup: {e}")
+
+async def start_background_tasks(app):
+    await db.cleanup_old_sessions(24)
+    app['cleanup_task'] = asyncio.create_task(periodic_cleanup())
+    # Rewrite old-schema history in the background
+    app['migration_task'] = asyncio.create_task(db.migrate_messages())
+
+async def stop_background_tasks(app):
+    app['cleanup_task'].cancel()
+    app['migration_task'].cancel()
+    await db.close()
+
+app.on_startup.append(start_background_tasks)
+app.on_cleanup.append(stop_background_tasks)
+
+if __name__ == '__main__':
+    print("Starting Encrypted Chat Server (asyncio)...")
+    web.run_app(app, host='0.0.0.0', port=PORT)
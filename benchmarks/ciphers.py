@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import time
+from cryptography.fernet import Fernet  # type: ignore
+from encrypted_chat_app.encrypted_database import CIPHERS, CipherSuite
+
+# Compares encrypt/decrypt throughput and token overhead of each cipher for
+# message-sized payloads up to a full file chunk. "raw" is the binary token
+# kept in file frames, log records, SQLite rows and msgpack; "text" is the
+# base64 token kept in JSON.
+#
+#   python -m encrypted_chat_app.benchmarks.ciphers --sizes 64 256 1024 65536
+
+def measure(suite, payload, seconds):
+    """Best-of-three ops/s for encrypt_raw, encrypt and decrypt of one payload size"""
+    def rate(function, argument):
+        best = 0.0
+        for _ in range(3):
+            count, start = 0, time.perf_counter()
+            while time.perf_counter() - start < seconds / 3:
+                for _ in range(100):
+                    function(argument)
+                count += 100
+            best = max(best, count / (time.perf_counter() - start))
+        return best
+    
+    raw = suite.encrypt_raw(payload)
+    text = suite.encrypt(payload)
+    return {
+        'raw_bytes': len(raw),
+        'text_bytes': len(text),
+        'encrypt_raw_ops': rate(suite.encrypt_raw, payload),
+        'encrypt_text_ops': rate(suite.encrypt, payload),
+        'decrypt_raw_ops': rate(suite.decrypt, raw),
+        'decrypt_text_ops': rate(suite.decrypt, text)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the database ciphers")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 256, 1024, 4096, 65536],
+                        help="payload sizes in bytes")
+    parser.add_argument('--seconds', type=float, default=0.5, help="time per measurement")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    
+    key = Fernet.generate_key()
+    results = []
+    for name in CIPHERS:
+        suite = CipherSuite(key, name)
+        for size in args.sizes:
+            results.append({'cipher': name, 'size': size, **measure(suite, os.urandom(size), args.seconds)})
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"{'cipher':18} {'size':>6} {'raw':>7} {'text':>7} {'enc/s':>9} {'dec/s':>9} {'enc MB/s':>9} {'dec MB/s':>9}")
+    for result in results:
+        size = result['size']
+        print(f"{result['cipher']:18} {size:>6} {result['raw_bytes'] - size:>+7} {result['text_bytes'] - size:>+7} "
+              f"{result['encrypt_raw_ops']:>9,.0f} {result['decrypt_raw_ops']:>9,.0f} "
+              f"{result['encrypt_raw_ops'] * size / 1e6:>9.1f} {result['decrypt_raw_ops'] * size / 1e6:>9.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from encrypted_chat_app.encrypted_database import STORAGE_BACKENDS, EncryptedDatabase
+
+# Drives EncryptedDatabase from many threads with the same calls the Socket.IO
+# handlers make (joins, sends to several rooms, history reads, group churn,
+# session cleanup, saves and backups), then checks nothing was lost and that
+# the files on disk load back to the same state.
+#
+#   python -m encrypted_chat_app.benchmarks.concurrency_stress --threads 16 --seconds 5
+
+def handler_thread(db, index, rooms, deadline, counts, counts_lock, errors):
+    """One simulated client: join, then a random mix of handler calls until the deadline"""
+    rng = random.Random(index)
+    user_id = str(uuid.uuid4())
+    username = f'user{index}'
+    session_id = f'sid{index}'
+    sent = {room: 0 for room in rooms}
+    try:
+        db.add_user(user_id, username)
+        db.add_session(session_id, {'username': username, 'user_id': user_id})
+        for room in rooms[1:]:
+            db.join_group(room, username)
+        
+        while time.time() < deadline:
+            action = rng.random()
+            room = rng.choice(rooms)
+            if action < 0.5:
+                message = {
+                    'id': str(uuid.uuid4()),
+                    'user_id': user_id,
+                    'username': username,
+                    'message': f'{username} says {sent[room]}',
+                    'encrypted_content': '',
+                    'timestamp': datetime.now().isoformat()
+                }
+                if room == 'public':
+                    db.add_public_message(message)
+                else:
+                    db.add_group_message(room, message)
+                sent[room] += 1
+                db.update_user_activity(user_id)
+                db.touch_session(session_id)
+            elif action < 0.8:
+                page = db.get_messages_page(room, limit=20)
+                if page['messages'] and any('message' not in message for message in page['messages']):
+                    raise AssertionError(f"undecryptable message in {room}")
+            elif action < 0.85:
+                scratch = f'scratch{index % 4}'
+                db.create_group(scratch, username)
+                db.join_group(scratch, username)
+                db.leave_group(scratch, username)
+            elif action < 0.9:
+                db.get_all_groups()
+                db.get_group_list_changes(0)
+                db.get_user_groups(username)
+            elif action < 0.95:
+                db.get_stats()
+                db.get_group(rng.choice(rooms[1:]))
+            else:
+                db.get_session(session_id)
+                db.get_user(user_id)
+    except Exception as e:
+        errors.append(f"handler {index}: {e!r}")
+    finally:
+        with counts_lock:
+            for room, count in sent.items():
+                counts['rooms'][room] = counts['rooms'].get(room, 0) + count
+            counts['users'][user_id] = sum(sent.values())
+
+def maintenance_thread(db, deadline, directory, errors):
+    """Saves, cleanup sweeps and backups running next to the handlers"""
+    backups = 0
+    try:
+        while time.time() < deadline:
+            db.save()
+            db.cleanup_old_sessions(24, limit=100)
+            db.create_backup(os.path.join(directory, f'backup{backups}.db'), incremental=backups > 0)
+            backups += 1
+            time.sleep(0.05)
+    except Exception as e:
+        errors.append(f"maintenance: {e!r}")
+
+def run(storage_mode, threads, seconds, rooms, write_behind):
+    with tempfile.TemporaryDirectory() as directory:
+        db_file = os.path.join(directory, 'stress.db')
+        options = {'storage_mode': storage_mode, 'write_behind': write_behind, 'max_room_messages': 10 ** 6}
+        db = EncryptedDatabase(db_file, 'stress-password', **options)
+        room_names = ['public'] + [f'room{index}' for index in range(rooms)]
+        for room in room_names[1:]:
+            db.create_group(room, 'admin')
+        
+        counts = {'rooms': {}, 'users': {}}
+        counts_lock = threading.Lock()
+        errors = []
+        deadline = time.time() + seconds
+        workers = [
+            threading.Thread(target=handler_thread, args=(db, index, room_names, deadline, counts, counts_lock, errors))
+            for index in range(threads)
+        ]
+        workers.append(threading.Thread(target=maintenance_thread, args=(db, deadline, directory, errors)))
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        
+        # A last message per user with nothing else after it: in sharded mode these
+        # counters only reach disk when close() writes the held-back metadata
+        for user_id in list(counts['users']):
+            db.add_public_message({
+                'id': str(uuid.uuid4()),
+                'user_id': user_id,
+                'username': 'stress',
+                'message': 'last word',
+                'encrypted_content': '',
+                'timestamp': datetime.now().isoformat()
+            })
+            counts['users'][user_id] += 1
+            counts['rooms']['public'] = counts['rooms'].get('public', 0) + 1
+        
+        # Every send is in memory and every user's counter matches what it sent
+        for room in room_names:
+            stored = len(db.get_messages_page(room, limit=10 ** 6)['messages'])
+            if stored != counts['rooms'].get(room, 0):
+                errors.append(f"{room}: sent {counts['rooms'].get(room, 0)}, stored {stored}")
+        for user_id, sent in counts['users'].items():
+            if db.get_user(user_id)['message_count'] != sent:
+                errors.append(f"user {user_id}: sent {sent}, counted {db.get_user(user_id)['message_count']}")
+        
+        # ...and the same state comes back from disk
+        expected = {room: len(db.get_messages_page(room, limit=10 ** 6)['messages']) for room in room_names}
+        expected_groups = sorted(db.get_all_groups())
+        db.close()
+        reloaded = EncryptedDatabase(db_file, 'stress-password', **options)
+        for room in room_names:
+            stored = len(reloaded.get_messages_page(room, limit=10 ** 6)['messages'])
+            if stored != expected[room]:
+                errors.append(f"{room} after reload: expected {expected[room]}, loaded {stored}")
+        if sorted(reloaded.get_all_groups()) != expected_groups:
+            errors.append("group list differs after reload")
+        for user_id, sent in counts['users'].items():
+            counted = reloaded.get_user(user_id)['message_count']
+            if counted != sent:
+                errors.append(f"user {user_id} after reload: sent {sent}, counted {counted}")
+        reloaded.close()
+        
+        messages = sum(counts['rooms'].values())
+        return {'messages': messages, 'elapsed': elapsed, 'errors': errors}
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent handler stress test for EncryptedDatabase")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--modes', nargs='+', default=list(STORAGE_BACKENDS), choices=list(STORAGE_BACKENDS))
+    parser.add_argument('--write-behind', action='store_true')
+    args = parser.parse_args()
+    
+    failed = False
+    for mode in args.modes:
+        result = run(mode, args.threads, args.seconds, args.rooms, args.write_behind)
+        status = "ok" if not result['errors'] else "FAILED"
+        print(f"{mode:9} {result['messages']:>7} messages in {result['elapsed']:.1f}s "
+              f"({result['messages'] / result['elapsed']:.0f}/s) {status}")
+        for error in result['errors'][:10]:
+            print(f"  {error}")
+        failed = failed or bool(result['errors'])
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
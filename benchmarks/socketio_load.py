@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import socketio  # type: ignore
+from encrypted_chat_app.encrypted_database import STORAGE_BACKENDS
+
+# End-to-end load test: starts app.py (or async_app.py) on localhost against a
+# scratch database, connects simulated python-socketio clients that join,
+# create/join groups and send at a fixed rate, then reports send and delivery
+# throughput, new_message latency percentiles, join latency as a room's history
+# grows, and the server's resident memory. Emit --json to compare runs across
+# commits and storage modes.
+#
+#   python -m encrypted_chat_app.benchmarks.socketio_load --clients 50 --rate 2 --seconds 20 --json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {'app': 'app.py', 'async': 'async_app.py'}
+
+def percentiles(values):
+    """p50/p95/p99/max of a list of milliseconds"""
+    if not values:
+        return {'count': 0, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    ordered = sorted(values)
+    pick = lambda fraction: round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+    return {'count': len(ordered), 'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(ordered[-1], 3)}
+
+def read_rss(pid):
+    """Resident set size of a process in MiB, or None where /proc is not available"""
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def start_server(server, storage_mode, port, directory, verbose=False, batch_rooms='', rate_limits=False):
+    """Run the chat server in a subprocess against a scratch database; returns the Popen"""
+    env = dict(
+        os.environ,
+        CHAT_PORT=str(port),
+        CHAT_DB_FILE=os.path.join(directory, 'load.db'),
+        CHAT_STORAGE_MODE=storage_mode,
+        CHAT_DEBUG='0',
+        CHAT_BATCH_ROOMS=batch_rooms
+    )
+    if not rate_limits:
+        # Simulated clients share budgets meant for people; backpressure stays on
+        env.update(CHAT_RATE_MESSAGES='0', CHAT_RATE_GROUPS='0', CHAT_RATE_JOINS='0')
+    output = None if verbose else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, SERVERS[server])], env=env, cwd=directory,
+                               stdout=output, stderr=output)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{SERVERS[server]} exited with status {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{SERVERS[server]} did not start listening on port {port}")
+
+class LoadClient:
+    """One simulated user: a Socket.IO client that records new_message latencies"""
+    
+    def __init__(self, url, name, transports, latencies):
+        self.url = url
+        self.name = name
+        self.transports = transports
+        self.latencies = latencies
+        self.received = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.waiters = {}
+        self.client = socketio.AsyncClient()
+        self.client.on('new_message', self.on_new_message)
+        self.client.on('new_messages', self.on_new_messages)
+        self.client.on('*', self.on_event)
+    
+    async def on_new_message(self, data):
+        self.received += 1
+        # Messages carry their send time; every client runs in this process's clock
+        try:
+            sent_at = float(data['message'].rsplit(' ', 1)[1])
+        except (KeyError, IndexError, ValueError, AttributeError):
+            return
+        if self.latencies is not None:
+            self.latencies.append((time.perf_counter() - sent_at) * 1000)
+    
+    async def on_new_messages(self, data):
+        # A batch from a room with CHAT_BATCH_ROOMS set on the server
+        for message in data.get('messages', []):
+            await self.on_new_message(message)
+    
+    async def on_event(self, event, data=None):
+        if event == 'error':
+            self.errors += 1
+        elif event == 'rate_limited':
+            self.rate_limited += 1
+        for future in self.waiters.pop(event, []):
+            if not future.done():
+                future.set_result(data)
+    
+    async def call(self, event, data, reply, timeout=30):
+        """Emit an event and wait for the server's reply event; returns (data, milliseconds)"""
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(reply, []).append(future)
+        start = time.perf_counter()
+        await self.client.emit(event, data)
+        result = await asyncio.wait_for(future, timeout)
+        return result, (time.perf_counter() - start) * 1000
+    
+    async def connect(self):
+        await self.client.connect(self.url, transports=self.transports)
+        _, elapsed = await self.call('join_chat', {'username': self.name}, 'chat_joined')
+        return elapsed
+    
+    async def send(self, room, sequence):
+        text = f'{self.name} #{sequence} {time.perf_counter()!r}'
+        if room == 'public':
+            await self.client.emit('send_public_message', {'message': text})
+        else:
+            await self.client.emit('send_group_message', {'group_name': room, 'message': text})
+    
+    async def disconnect(self):
+        await self.client.disconnect()
+
+async def send_loop(client, rooms, rate, public_fraction, deadline, rng):
+    """Send at `rate` messages per second with jittered spacing until the deadline"""
+    sent = 0
+    while time.perf_counter() < deadline:
+        room = 'public' if not rooms or rng.random() < public_fraction else rng.choice(rooms)
+        await client.send(room, sent)
+        sent += 1
+        await asyncio.sleep(rng.expovariate(rate))
+    return sent
+
+async def sample_rss(pid, samples, interval=0.25):
+    while True:
+        rss = read_rss(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(interval)
+
+async def measure_joins(url, transports, history_sizes, samples):
+    """join_chat and join_group latency after filling one room to each history size"""
+    filler = LoadClient(url, 'filler', transports, None)
+    await filler.connect()
+    await filler.call('create_group', {'group_name': 'history'}, 'group_created')
+    results = []
+    stored = 0
+    for size in history_sizes:
+        # Fill to `size` and wait until the last message has come back to the sender
+        for sequence in range(stored, size):
+            await filler.send('history', sequence)
+        while filler.received < size:
+            await asyncio.sleep(0.01)
+        stored = max(stored, size)
+        
+        join_chat, join_group = [], []
+        for index in range(samples):
+            client = LoadClient(url, f'joiner{size}_{index}', transports, None)
+            join_chat.append(await client.connect())
+            _, elapsed = await client.call('join_group', {'group_name': 'history'}, 'group_joined')
+            join_group.append(elapsed)
+            await client.disconnect()
+        results.append({
+            'history': size,
+            'join_chat_ms': percentiles(join_chat)['p50'],
+            'join_group_ms': percentiles(join_group)['p50']
+        })
+    await filler.disconnect()
+    return results
+
+async def run_load(url, pid, args):
+    latencies = []
+    rss_samples = []
+    rss_task = asyncio.create_task(sample_rss(pid, rss_samples))
+    rss_start = read_rss(pid)
+    rng = random.Random(args.seed)
+    transports = [args.transport] if args.transport != 'any' else None
+    
+    # Connect and join, with one creator per group and everyone else joining after
+    clients = [LoadClient(url, f'user{index}', transports, latencies) for index in range(args.clients)]
+    connect_ms = await asyncio.gather(*(client.connect() for client in clients))
+    groups = [f'group{index}' for index in range(min(args.groups, args.clients))]
+    memberships = {client: [] for client in clients}
+    for index, group in enumerate(groups):
+        await clients[index].call('create_group', {'group_name': group}, 'group_created')
+        memberships[clients[index]].append(group)
+    join_ms = []
+    for index, client in enumerate(clients):
+        for group in groups:
+            if group not in memberships[client] and rng.random() < args.group_share:
+                _, elapsed = await client.call('join_group', {'group_name': group}, 'group_joined')
+                join_ms.append(elapsed)
+                memberships[client].append(group)
+    
+    # Load phase
+    latencies.clear()
+    received_before = sum(client.received for client in clients)
+    start = time.perf_counter()
+    deadline = start + args.seconds
+    sent = await asyncio.gather(*(
+        send_loop(client, memberships[client], args.rate, args.public_fraction, deadline, random.Random(rng.random()))
+        for client in clients
+    ))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(args.drain)
+    delivered = sum(client.received for client in clients) - received_before
+    load_latencies = list(latencies)
+    
+    joins = await measure_joins(url, transports, args.history_sizes, args.join_samples) if args.history_sizes else []
+    errors = sum(client.errors for client in clients)
+    rate_limited = sum(client.rate_limited for client in clients)
+    for client in clients:
+        await client.disconnect()
+    rss_task.cancel()
+    rss_end = read_rss(pid)
+    
+    return {
+        'sent': sum(sent),
+        'delivered': delivered,
+        'errors': errors,
+        'rate_limited': rate_limited,
+        'elapsed': round(elapsed, 3),
+        'send_per_second': round(sum(sent) / elapsed, 1),
+        'deliver_per_second': round(delivered / elapsed, 1),
+        'latency_ms': percentiles(load_latencies),
+        'connect_ms': percentiles(connect_ms),
+        'join_group_ms': percentiles(join_ms),
+        'join_with_history': joins,
+        'rss_mb': {
+            'start': rss_start and round(rss_start, 1),
+            'peak': rss_samples and round(max(rss_samples), 1) or None,
+            'end': rss_end and round(rss_end, 1)
+        }
+    }
+
+def run(storage_mode, args):
+    with tempfile.TemporaryDirectory() as directory:
+        port = args.port or free_port()
+        process = start_server(args.server, storage_mode, port, directory, args.verbose, args.batch_rooms,
+                               args.rate_limits)
+        try:
+            result = asyncio.run(run_load(f'http://127.0.0.1:{port}', process.pid, args))
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+    return {
+        'commit': git_commit(),
+        'server': args.server,
+        'storage_mode': storage_mode,
+        'clients': args.clients,
+        'groups': args.groups,
+        'rate': args.rate,
+        'seconds': args.seconds,
+        'transport': args.transport,
+        'batch_rooms': args.batch_rooms,
+        'rate_limits': args.rate_limits,
+        **result
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket.IO end-to-end load benchmark")
+    parser.add_argument('--server', choices=list(SERVERS), default='app')
+    parser.add_argument('--modes', nargs='+', default=['snapshot'], choices=list(STORAGE_BACKENDS),
+                        help="storage modes to run the server with, one run each")
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=4)
+    parser.add_argument('--group-share', type=float, default=0.5, help="chance a client joins each group")
+    parser.add_argument('--public-fraction', type=float, default=0.2, help="share of sends to the public room")
+    parser.add_argument('--rate', type=float, default=2.0, help="messages per second per client")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--drain', type=float, default=1.0, help="seconds to wait for in-flight deliveries")
+    parser.add_argument('--history-sizes', type=int, nargs='*', default=[0, 100, 1000],
+                        help="room history sizes to measure join latency at")
+    parser.add_argument('--join-samples', type=int, default=5)
+    parser.add_argument('--transport', choices=['websocket', 'polling', 'any'], default='websocket')
+    parser.add_argument('--batch-rooms', default='', help="CHAT_BATCH_ROOMS for the server, e.g. public or '*'")
+    parser.add_argument('--rate-limits', action='store_true', help="keep the server's per-client rate limits on")
+    parser.add_argument('--port', type=int, default=0, help="server port (default: any free port)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="show the server's output")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--output', help="also write the JSON results to this file")
+    args = parser.parse_args()
+    
+    results = [run(mode, args) for mode in args.modes]
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    for result in results:
+        latency = result['latency_ms']
+        rss = result['rss_mb']
+        print(f"{result['server']}/{result['storage_mode']}: {result['clients']} clients, "
+              f"{result['send_per_second']:.0f} sends/s, {result['deliver_per_second']:.0f} deliveries/s, "
+              f"{result['errors']} errors, {result['rate_limited']} rate limited")
+        print(f"  new_message latency ms  p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  "
+              f"max {latency['max']}")
+        for join in result['join_with_history']:
+            print(f"  history {join['history']:>6}: join_chat {join['join_chat_ms']} ms, "
+                  f"join_group {join['join_group_ms']} ms")
+        print(f"  server RSS MiB  start {rss['start']}  peak {rss['peak']}  end {rss['end']}")
+
+if __name__ == '__main__':
+    main()
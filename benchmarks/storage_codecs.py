@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from cryptography.fernet import Fernet  # type: ignore
+from encrypted_chat_app.encrypted_database import (
+    CipherSuite, MessageRing, _json_default, check_file_options, encrypt_message_fields, read_encrypted_file,
+    write_encrypted_file
+)
+
+# Compares database file size and save/load time of each file codec and
+# compression against the v1 format (indented JSON in a single Fernet token).
+#
+#   python -m encrypted_chat_app.benchmarks.storage_codecs --messages 20000
+
+def build_dataset(cipher, users=500, messages=10000, groups=50):
+    """A dataset shaped like EncryptedDatabase.data, with real encrypted message fields"""
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+    now = datetime.now().isoformat()
+    
+    def message(index, room):
+        user_id = user_ids[index % users]
+        return encrypt_message_fields(cipher, {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'username': f'user{index % users}',
+            'message': f'Message number {index} with a little bit of ordinary chat text',
+            'encrypted_content': f'client-side-ciphertext-{index}',
+            'timestamp': now,
+            'room': room
+        })
+    
+    group_messages = messages // 2
+    data = {
+        'users': {
+            user_id: {
+                'user_id': user_id,
+                'username': f'user{index}',
+                'public_key': 'demo-public-key',
+                'created_at': now,
+                'last_active': now,
+                'message_count': 0,
+                'groups_joined': [],
+                'metadata': {}
+            } for index, user_id in enumerate(user_ids)
+        },
+        'public_messages': MessageRing(messages, (message(i, 'public') for i in range(messages - group_messages))),
+        'groups': {},
+        'user_sessions': {},
+        'metadata': {'created_at': now, 'last_updated': now, 'version': '2.0'}
+    }
+    for index in range(groups):
+        name = f'group{index}'
+        data['groups'][name] = {
+            'id': uuid.uuid4().hex[:16],
+            'name': name,
+            'creator': 'user0',
+            'encrypted_password': '',
+            'created_at': now,
+            'members': {f'user{i}' for i in range(index, users, groups)},
+            'messages': MessageRing(messages, (message(i, name) for i in range(group_messages // groups))),
+            'metadata': {}
+        }
+    return data
+
+def write_v1(path, cipher, data):
+    with open(path, 'wb') as file:
+        file.write(cipher.encrypt(json.dumps(data, indent=2, default=_json_default).encode()))
+
+def write_v2(codec, compression):
+    return lambda path, cipher, data: write_encrypted_file(path, cipher, data, codec, compression)
+
+def measure(write, path, cipher, data, repeat):
+    save_times, load_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        write(path, cipher, data)
+        save_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        read_encrypted_file(path, cipher)
+        load_times.append(time.perf_counter() - start)
+    return {'size_bytes': os.path.getsize(path), 'save_s': min(save_times), 'load_s': min(load_times)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark database file codecs and compression")
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+    
+    cipher = CipherSuite(Fernet.generate_key())
+    data = build_dataset(cipher, args.users, args.messages, args.groups)
+    
+    variants = [('v1 json (indented, single token)', write_v1)]
+    for codec in ('json', 'msgpack'):
+        for compression in (None, 'zlib', 'zstd'):
+            try:
+                check_file_options(codec, compression)
+            except ValueError as e:
+                print(f"Skipping {codec}+{compression}: {e}")
+                continue
+            variants.append((f"v2 {codec}" + (f"+{compression}" if compression else ""), write_v2(codec, compression)))
+    
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        for name, write in variants:
+            results.append({'format': name, **measure(write, path, cipher, data, args.repeat)})
+    
+    baseline = results[0]
+    for result in results:
+        result['size_ratio'] = result['size_bytes'] / baseline['size_bytes']
+        result['save_speedup'] = baseline['save_s'] / result['save_s']
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"{'format':36} {'size':>12} {'vs v1':>7} {'save':>9} {'speedup':>8} {'load':>9}")
+    for result in results:
+        print(f"{result['format']:36} {result['size_bytes']:>12,} {result['size_ratio']:>6.0%} "
+              f"{result['save_s'] * 1000:>7.0f}ms {result['save_speedup']:>7.2f}x {result['load_s'] * 1000:>7.0f}ms")
+
+if __name__ == '__main__':
+    main()
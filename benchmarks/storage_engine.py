@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+from encrypted_chat_app.encrypted_database import (
+    STORAGE_BACKENDS, EncryptedDatabase, MessageRing, encrypt_message_fields, write_encrypted_file
+)
+
+# Times EncryptedDatabase's hot and maintenance operations on a production-sized
+# dataset (10k users, 500 groups with full 1000-message histories, thousands of
+# sessions): ops/s, latency percentiles and tracemalloc peak memory per call.
+# Save a run with --output and gate an upgrade on it with --baseline, which
+# exits 1 when any operation regressed by more than --threshold.
+#
+#   python -m encrypted_chat_app.benchmarks.storage_engine --output before.json
+#   python -m encrypted_chat_app.benchmarks.storage_engine --baseline before.json --threshold 0.25
+
+PASSWORD = 'benchmark-password'
+
+def build_backup(cipher, users, groups, group_messages, public_messages):
+    """A full backup payload of the requested size, with real v2 message records"""
+    now = datetime.now()
+    usernames = [f'user{index}' for index in range(users)]
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+    
+    def message(index, room):
+        return encrypt_message_fields(cipher, {
+            'id': str(uuid.uuid4()),
+            'user_id': user_ids[index % users],
+            'username': usernames[index % users],
+            'message': f'Message number {index} with a little bit of ordinary chat text',
+            'encrypted_content': f'client-side-ciphertext-{index}',
+            'timestamp': (now - timedelta(seconds=group_messages - index)).isoformat(),
+            'room': room
+        })
+    
+    data = {
+        'users': {
+            user_id: {
+                'user_id': user_id,
+                'username': usernames[index],
+                'public_key': 'demo-public-key',
+                'created_at': now.isoformat(),
+                'last_active': now.isoformat(),
+                'message_count': 0,
+                'groups_joined': [],
+                'metadata': {}
+            } for index, user_id in enumerate(user_ids)
+        },
+        'public_messages': MessageRing(max(public_messages, 1), (message(i, 'public') for i in range(public_messages))),
+        'groups': {},
+        'user_sessions': {},
+        'metadata': {'created_at': now.isoformat(), 'last_updated': now.isoformat()}
+    }
+    for index in range(groups):
+        name = f'group{index}'
+        data['groups'][name] = {
+            'id': uuid.uuid4().hex[:16],
+            'name': name,
+            'creator': usernames[index % users],
+            'encrypted_password': '',
+            'created_at': now.isoformat(),
+            'members': {usernames[i] for i in range(index % users, users, max(groups // 10, 1))},
+            'messages': MessageRing(max(group_messages, 1), (message(i, name) for i in range(group_messages))),
+            'metadata': {}
+        }
+    return data
+
+def summarize(latencies, peak_bytes):
+    ordered = sorted(latencies)
+    pick = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+    total = sum(ordered)
+    return {
+        'iterations': len(ordered),
+        'ops_per_second': round(len(ordered) / total, 2) if total else None,
+        'latency_ms': {
+            'mean': round(total / len(ordered) * 1000, 4),
+            'p50': round(pick(0.5), 4),
+            'p95': round(pick(0.95), 4),
+            'p99': round(pick(0.99), 4),
+            'max': round(ordered[-1] * 1000, 4)
+        },
+        'peak_memory_kib': round(peak_bytes / 1024, 1)
+    }
+
+def measure(function, iterations, memory_iterations, setup=None):
+    """Time iterations calls, then trace memory over a few more; setup runs untimed before each call"""
+    latencies = []
+    for index in range(iterations):
+        argument = setup(index) if setup else None
+        start = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - start)
+    
+    # tracemalloc slows allocation-heavy code several times over, so it gets
+    # its own pass: the peak is the most any one call held above its baseline
+    peak = 0
+    tracemalloc.start()
+    try:
+        for index in range(memory_iterations):
+            argument = setup(iterations + index) if setup else None
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            function(argument)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return summarize(latencies, peak)
+
+def run(args, storage_mode, directory):
+    db_file = os.path.join(directory, f'engine-{storage_mode}.db')
+    options = {
+        'storage_mode': storage_mode,
+        'write_behind': not args.sync,
+        'flush_interval_ms': 100,
+        'flush_max_ops': 200,
+        'max_room_messages': args.group_messages
+    }
+    
+    # Seed through a restore so every storage mode gets the same dataset
+    db = EncryptedDatabase(db_file, PASSWORD, **options)
+    seed_start = time.perf_counter()
+    seed_file = os.path.join(directory, 'seed.backup')
+    write_encrypted_file(seed_file, db.cipher, build_backup(
+        db.cipher, args.users, args.groups, args.group_messages, args.public_messages
+    ))
+    if not db.restore_from_backup(seed_file):
+        raise RuntimeError("Could not seed the database")
+    os.remove(seed_file)
+    seed_seconds = time.perf_counter() - seed_start
+    
+    rng = random.Random(args.seed)
+    users = list(db.get_all_users().values())
+    groups = list(db.get_all_groups())
+    fast, slow, memory = args.iterations, args.slow_iterations, args.memory_iterations
+    
+    def new_message(index):
+        user = users[index % len(users)]
+        return {
+            'id': str(uuid.uuid4()),
+            'user_id': user['user_id'],
+            'username': user['username'],
+            'message': f'Benchmark message {index}',
+            'encrypted_content': '',
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    def add_sessions(index):
+        # Each sweep starts from a full table of idle sessions
+        if len(db.sessions) < args.cleanup_batch:
+            for number in range(args.sessions):
+                user = users[number % len(users)]
+                db.add_session(f'sid{index}-{number}', {'username': user['username'], 'user_id': user['user_id']})
+    
+    def backup_path(index):
+        return os.path.join(directory, f'backup{index}.db')
+    
+    def timed_backup(path):
+        db.create_backup(path)
+        os.remove(path)
+    
+    def startup(_):
+        EncryptedDatabase(db_file, PASSWORD, **options).close()
+    
+    results = {
+        'add_public_message': measure(db.add_public_message, fast, memory, new_message),
+        'add_group_message': measure(
+            lambda message: db.add_group_message(rng.choice(groups), message), fast, memory, new_message
+        ),
+        'get_group_messages': measure(lambda _: db.get_group_messages(rng.choice(groups)), fast, memory),
+        'get_all_groups': measure(lambda _: db.get_all_groups(), max(fast // 10, 1), memory),
+        'cleanup_old_sessions': measure(
+            lambda _: db.cleanup_old_sessions(0, limit=args.cleanup_batch), max(fast // 10, 1), memory, add_sessions
+        ),
+        'save': measure(lambda _: db.save(), slow, 1),
+        'create_backup': measure(timed_backup, slow, 1, backup_path)
+    }
+    db.close()
+    
+    # Startup on the file that was just saved: backend load, then the whole constructor
+    backend = STORAGE_BACKENDS[storage_mode](db_file, db.cipher, codec='json', compression=None)
+    results['load'] = measure(lambda _: backend.load(), slow, 1)
+    backend.close()
+    results['startup'] = measure(startup, slow, 1)
+    
+    return {
+        'storage_mode': storage_mode,
+        'write_behind': not args.sync,
+        'dataset': {
+            'users': args.users,
+            'groups': args.groups,
+            'group_messages': args.group_messages,
+            'public_messages': args.public_messages,
+            'sessions': args.sessions
+        },
+        'seed_seconds': round(seed_seconds, 2),
+        # Backups are deleted as they are timed, so the directory holds only the database
+        'file_bytes': sum(
+            os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names
+        ),
+        'operations': results
+    }
+
+def compare(results, baseline, threshold):
+    """Regressions beyond threshold (a fraction) against a baseline run, as messages"""
+    regressions = []
+    previous = {(run['storage_mode'], run['write_behind']): run for run in baseline}
+    for result in results:
+        base = previous.get((result['storage_mode'], result['write_behind']))
+        if base is None:
+            print(f"No baseline for {result['storage_mode']}, skipped")
+            continue
+        if base['dataset'] != result['dataset']:
+            print(f"Baseline dataset for {result['storage_mode']} differs: {base['dataset']}")
+        for name, current in result['operations'].items():
+            old = base['operations'].get(name)
+            if not old:
+                continue
+            # Changes smaller than the noise floor (a write-behind flush landing
+            # in one timed call, say) never count, however large in relative terms
+            checks = [
+                ('ops/s', old['ops_per_second'], current['ops_per_second'], True, 0),
+                ('p95 ms', old['latency_ms']['p95'], current['latency_ms']['p95'], False, 0.5),
+                ('peak KiB', old['peak_memory_kib'], current['peak_memory_kib'], False, 1024)
+            ]
+            for label, before, after, higher_is_better, noise in checks:
+                if not before or after is None or abs(after - before) <= noise:
+                    continue
+                change = (after - before) / before
+                if (-change if higher_is_better else change) > threshold:
+                    regressions.append(
+                        f"{result['storage_mode']} {name}: {label} {before} -> {after} ({change:+.0%})"
+                    )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage engine microbenchmarks for EncryptedDatabase")
+    parser.add_argument('--modes', nargs='+', default=['snapshot'], choices=list(STORAGE_BACKENDS))
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=500)
+    parser.add_argument('--group-messages', type=int, default=1000, help="history length of every group")
+    parser.add_argument('--public-messages', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=1000, help="calls per fast operation")
+    parser.add_argument('--slow-iterations', type=int, default=3, help="calls to save, backup, load and startup")
+    parser.add_argument('--memory-iterations', type=int, default=20, help="traced calls per fast operation")
+    parser.add_argument('--cleanup-batch', type=int, default=1000, help="sessions removed per cleanup call")
+    parser.add_argument('--sync', action='store_true', help="commit every change (default: write-behind, as app.py)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--output', help="write the JSON results to this file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed regression as a fraction")
+    args = parser.parse_args()
+    
+    results = []
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as directory:
+            results.append(run(args, mode, directory))
+    
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"{result['storage_mode']} ({'write-behind' if result['write_behind'] else 'sync'}), "
+                  f"{result['file_bytes'] / 2 ** 20:.1f} MiB on disk, seeded in {result['seed_seconds']}s")
+            print(f"  {'operation':22} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'peak KiB':>10}")
+            for name, stats in result['operations'].items():
+                latency = stats['latency_ms']
+                print(f"  {name:22} {stats['ops_per_second']:>10,.1f} {latency['p50']:>9.3f} {latency['p95']:>9.3f} "
+                      f"{latency['p99']:>9.3f} {latency['max']:>9.3f} {stats['peak_memory_kib']:>10,.1f}")
+    
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import os
+import pickle
+import secrets
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager
+import socketio  # type: ignore
+
+# Multi-worker deployment: N Socket.IO workers (app.py) share room fan-out
+# through a message queue and one writer process owns EncryptedDatabase.
+#
+#   python cluster.py --workers 4            # run a local cluster
+#   python cluster.py --workers 3 --check    # start, verify fan-out, stop
+#
+# Workers are configured through the environment:
+#   CHAT_MESSAGE_QUEUE  local://host:port for the built-in broker, or any
+#                       Flask-SocketIO message_queue URL (redis://, amqp://)
+#   CHAT_DB_ADDRESS     host:port of the database server
+#   CHAT_DB_AUTHKEY     shared secret for the database server
+#   CHAT_PORT           port the worker listens on
+
+FRAME_HEADER = struct.Struct('>I')
+
+def _parse_address(address, scheme=None):
+    """'host:port' (optionally behind scheme://) as a (host, port) tuple"""
+    if scheme and address.startswith(scheme + '://'):
+        address = address[len(scheme) + 3:]
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def _send_frame(sock, payload):
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+def _recv_exactly(sock, size):
+    buffer = b''
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        buffer += chunk
+    return buffer
+
+def _recv_frame(sock):
+    (length,) = FRAME_HEADER.unpack(_recv_exactly(sock, FRAME_HEADER.size))
+    return _recv_exactly(sock, length)
+
+# Local message broker
+class LocalSocketBroker(socketserver.ThreadingTCPServer):
+    """Relays every published frame to every connected worker, sender included
+    
+    A stand-in for Redis in tests and single-host deployments; PubSubManager
+    delivers a worker's own emits when they come back from the broker.
+    """
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, address):
+        self.subscribers = set()
+        self.subscribers_lock = threading.Lock()
+        super().__init__(address, _BrokerHandler)
+    
+    def publish(self, payload):
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                with subscriber[1]:
+                    _send_frame(subscriber[0], payload)
+            except OSError:
+                self.unsubscribe(subscriber)
+    
+    def unsubscribe(self, subscriber):
+        with self.subscribers_lock:
+            self.subscribers.discard(subscriber)
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        subscriber = (self.request, threading.Lock())
+        with self.server.subscribers_lock:
+            self.server.subscribers.add(subscriber)
+        try:
+            while True:
+                self.server.publish(_recv_frame(self.request))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.unsubscribe(subscriber)
+
+class LocalSocketManager(socketio.PubSubManager):
+    """python-socketio client manager that fans out through LocalSocketBroker
+    
+    Usage: SocketIO(app, client_manager=LocalSocketManager('local://127.0.0.1:5200'))
+    """
+    
+    name = 'localsocket'
+    
+    def __init__(self, url='local://127.0.0.1:5200', channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.address = _parse_address(url, 'local')
+        self.sock = None
+        self._send_lock = threading.Lock()
+    
+    def _connect(self):
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.sock
+    
+    def _publish(self, data):
+        payload = pickle.dumps(data)
+        with self._send_lock:
+            for retry in (True, False):
+                try:
+                    _send_frame(self.sock or self._connect(), payload)
+                    return
+                except OSError as e:
+                    self.sock = None
+                    if not retry:
+                        print(f"Error publishing to message broker: {e}")
+    
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                with self._send_lock:
+                    sock = self.sock or self._connect()
+                retry_sleep = 1
+                while True:
+                    yield _recv_frame(sock)
+            except OSError as e:
+                print(f"Error reading from message broker, retrying in {retry_sleep}s: {e}")
+                with self._send_lock:
+                    self.sock = None
+                time.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+
+# Single-writer database server
+class DatabaseManager(BaseManager):
+    """Serves one EncryptedDatabase to worker processes over a local socket"""
+
+def serve_database(address, authkey, db_file="chat_data.db", password="your-super-secure-database-password-2024",
+                   **options):
+    """Own the database in this process and answer worker calls until terminated"""
+    from encrypted_chat_app.encrypted_database import EncryptedDatabase
+    
+    database = EncryptedDatabase(db_file, password, **options)
+    DatabaseManager.register('database', callable=lambda: database)
+    server = DatabaseManager(address=_parse_address(address), authkey=authkey.encode()).get_server()
+    
+    def cleanup_sessions():
+        while True:
+            time.sleep(60)
+            try:
+                database.cleanup_old_sessions(24, limit=1000)
+            except Exception as e:
+                print(f"Error in periodic cleanup: {e}")
+    
+    threading.Thread(target=cleanup_sessions, daemon=True).start()
+    threading.Thread(target=database.migrate_messages, daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        database.close()
+
+def connect_database(address, authkey, retries=50):
+    """Proxy to the EncryptedDatabase served by serve_database()"""
+    DatabaseManager.register('database')
+    manager = DatabaseManager(address=_parse_address(address), authkey=authkey.encode())
+    for attempt in range(retries):
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.1)
+    return manager.database()
+
+# Harness
+def _wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def start_cluster(workers=2, base_port=5001, broker_port=5200, db_port=5100, db_file="chat_data.db",
+                  message_queue=None):
+    """Start the broker, the database server and the workers; returns a stop() callable"""
+    authkey = secrets.token_hex(16)
+    broker = None
+    if message_queue is None:
+        broker = LocalSocketBroker(('127.0.0.1', broker_port))
+        threading.Thread(target=broker.serve_forever, daemon=True).start()
+        message_queue = f"local://127.0.0.1:{broker_port}"
+    
+    database = Process(
+        target=serve_database,
+        args=(f"127.0.0.1:{db_port}", authkey, db_file),
+        kwargs={'write_behind': True, 'flush_interval_ms': 100, 'flush_max_ops': 200}
+    )
+    database.start()
+    
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    processes = []
+    for index in range(workers):
+        env = dict(
+            os.environ,
+            CHAT_MESSAGE_QUEUE=message_queue,
+            CHAT_DB_ADDRESS=f"127.0.0.1:{db_port}",
+            CHAT_DB_AUTHKEY=authkey,
+            CHAT_PORT=str(base_port + index)
+        )
+        processes.append(subprocess.Popen([sys.executable, app_path], env=env))
+    
+    def stop():
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        database.terminate()
+        database.join()
+        if broker:
+            broker.shutdown()
+            broker.server_close()
+    
+    ports = [base_port + index for index in range(workers)]
+    if not all(_wait_for_port(port) for port in ports):
+        stop()
+        raise RuntimeError("Workers did not start listening")
+    return ports, stop
+
+async def check_fan_out(ports, timeout=10):
+    """Connect a client to every worker and check room emits reach all of them"""
+    clients = []
+    received = [asyncio.Queue() for _ in ports]
+    for index, port in enumerate(ports):
+        client = socketio.AsyncClient()
+        client.on('*', lambda event, data, queue=received[index]: queue.put_nowait((event, data)))
+        await client.connect(f"http://127.0.0.1:{port}")
+        clients.append(client)
+    
+    async def expect(index, event, predicate=lambda data: True):
+        while True:
+            name, data = await asyncio.wait_for(received[index].get(), timeout)
+            if name == event and predicate(data):
+                return data
+    
+    # Unique names, so a check never collides with existing data or an earlier run
+    suffix = secrets.token_hex(4)
+    group_name = f'cluster-group-{suffix}'
+    try:
+        for index, client in enumerate(clients):
+            await client.emit('join_chat', {'username': f'worker{index}-user-{suffix}'})
+            await expect(index, 'chat_joined')
+        
+        # Public room: one sender, every worker's client receives it
+        await clients[0].emit('send_public_message', {'message': 'cluster hello'})
+        for index in range(len(clients)):
+            await expect(index, 'new_message', lambda data: data['message'] == 'cluster hello')
+        
+        # Group rooms: created on one worker, joined and used on the others
+        await clients[0].emit('create_group', {'group_name': group_name})
+        await expect(0, 'group_created')
+        for index in range(1, len(clients)):
+            await clients[index].emit('join_group', {'group_name': group_name})
+            await expect(index, 'group_joined')
+        await clients[-1].emit('send_group_message', {'group_name': group_name, 'message': 'group hello'})
+        for index in range(len(clients)):
+            await expect(index, 'new_message', lambda data: data['message'] == 'group hello')
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        for client in clients:
+            await client.disconnect()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run CyberChat as several workers behind one database server")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--base-port', type=int, default=5001)
+    parser.add_argument('--broker-port', type=int, default=5200)
+    parser.add_argument('--db-port', type=int, default=5100)
+    parser.add_argument('--db-file', default="chat_data.db")
+    parser.add_argument('--message-queue', help="Flask-SocketIO message_queue URL instead of the built-in broker")
+    parser.add_argument('--check', action='store_true', help="verify cross-worker fan-out, then stop")
+    args = parser.parse_args()
+    
+    db_file = args.db_file
+    scratch = None
+    if args.check:
+        # The check runs against a throwaway database, removed when the cluster stops
+        scratch = tempfile.TemporaryDirectory()
+        db_file = os.path.join(scratch.name, 'cluster-check.db')
+    
+    ports, stop = start_cluster(args.workers, args.base_port, args.broker_port, args.db_port, db_file,
+                                args.message_queue)
+    try:
+        if args.check:
+            ok = asyncio.run(check_fan_out(ports))
+            print("Cluster fan-out check " + ("passed" if ok else "FAILED"))
+            return 0 if ok else 1
+        
+        print(f"Workers listening on ports {', '.join(map(str, ports))}")
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        stop()
+        if scratch is not None:
+            scratch.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(main())
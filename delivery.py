@@ -0,0 +1,86 @@
+import threading
+import time
+
+# Outbound message batching for busy rooms. A room that opted in still gets
+# a message delivered at once when nothing was sent to it within the last
+# window; messages that follow closer together are held and go out as one
+# 'new_messages' event at the end of the window, or as soon as max_batch
+# are waiting. A busy room then costs each client one frame and one JSON
+# encode per window instead of one per message, and a quiet one sees no
+# added latency.
+
+class RoomBatcher:
+    """Per-room outbound buffers shared by the threaded and asyncio servers
+    
+    emit_one(room, message) and emit_many(room, messages) deliver to the
+    room; schedule(delay, callback) runs callback after delay seconds. Both
+    emit callbacks are called with the room's lock held so a room's events
+    leave in order, so they should hand off to the transport, not block.
+    """
+    
+    def __init__(self, emit_one, emit_many, schedule, rooms=None, window_ms=25, max_batch=50):
+        self.emit_one = emit_one
+        self.emit_many = emit_many
+        self.schedule = schedule
+        # None batches every room; otherwise only the named ones
+        self.rooms = rooms
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._states = {}
+        self._lock = threading.Lock()
+    
+    def batches(self, room):
+        return self.rooms is None or room in self.rooms
+    
+    def _state(self, room):
+        state = self._states.get(room)
+        if state is None:
+            with self._lock:
+                state = self._states.setdefault(room, {
+                    'lock': threading.Lock(), 'last_emit': 0.0, 'pending': [], 'scheduled': False
+                })
+        return state
+    
+    def send(self, room, message):
+        """Deliver now if the room is quiet, else queue it for the room's next batch"""
+        if not self.batches(room):
+            self.emit_one(room, message)
+            return
+        
+        state = self._state(room)
+        with state['lock']:
+            now = time.monotonic()
+            if not state['pending'] and now - state['last_emit'] >= self.window:
+                state['last_emit'] = now
+                self.emit_one(room, message)
+                return
+            
+            state['pending'].append(message)
+            if len(state['pending']) >= self.max_batch:
+                self._emit_pending(room, state, now)
+            elif not state['scheduled']:
+                state['scheduled'] = True
+                self.schedule(max(self.window - (now - state['last_emit']), 0), lambda: self.flush(room))
+    
+    def flush(self, room):
+        """Deliver whatever is queued for a room"""
+        state = self._state(room)
+        with state['lock']:
+            state['scheduled'] = False
+            if state['pending']:
+                self._emit_pending(room, state, time.monotonic())
+    
+    def _emit_pending(self, room, state, now):
+        messages, state['pending'] = state['pending'], []
+        state['last_emit'] = now
+        if len(messages) == 1:
+            self.emit_one(room, messages[0])
+        else:
+            self.emit_many(room, messages)
+
+def parse_batch_rooms(setting):
+    """CHAT_BATCH_ROOMS: '*' for every room, else comma-separated room names ('' batches none)"""
+    setting = (setting or '').strip()
+    if setting == '*':
+        return None
+    return {room.strip() for room in setting.split(',') if room.strip()}
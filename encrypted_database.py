@@ -1,34 +1,1661 @@
+import asyncio
+import functools
 import json
+import mmap
 import os
+import sqlite3
+import heapq
+import itertools
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from cryptography.fernet import Fernet  # type: ignore
+from cryptography.exceptions import InvalidTag  # type: ignore
+from cryptography.fernet import Fernet, InvalidToken  # type: ignore
 from cryptography.hazmat.primitives import hashes  # type: ignore
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305  # type: ignore
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF  # type: ignore
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC  # type: ignore
 import base64
+import binascii
 import hashlib
 
+# Optional compact file codec and compression
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+# Ciphers
+#
+# Every token starts with a byte naming the cipher that produced it, so data
+# written under different ciphers reads back side by side: 0x80 is Fernet's
+# own version byte, and the AEAD ciphers write their tag byte, a 12-byte
+# nonce and the ciphertext with its 16-byte authentication tag. Tokens are
+# kept as raw bytes wherever the container allows (file frames, log records,
+# SQLite rows, msgpack) and as urlsafe base64 text in JSON.
+AEAD_NONCE_BYTES = 12
+
+class FernetCipher:
+    """AES-128-CBC + HMAC-SHA256 via Fernet, the format every earlier file uses"""
+    name = 'fernet'
+    tag = 0x80
+    
+    def __init__(self, key):
+        self._fernet = Fernet(key)
+    
+    def encrypt(self, data):
+        return self._fernet.encrypt(data)
+    
+    def encrypt_raw(self, data):
+        return base64.urlsafe_b64decode(self._fernet.encrypt(data))
+    
+    def decrypt(self, token):
+        return self._fernet.decrypt(token)
+    
+    def decrypt_raw(self, token):
+        return self._fernet.decrypt(base64.urlsafe_b64encode(token))
+
+class AEADCipher:
+    """Tag byte, random nonce and AEAD ciphertext, under a key derived for this cipher alone"""
+    name = None
+    tag = None
+    algorithm = None
+    
+    def __init__(self, key):
+        subkey = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'encrypted_chat_app cipher ' + self.name.encode()
+        ).derive(base64.urlsafe_b64decode(key))
+        self._aead = self.algorithm(subkey)
+        self._header = bytes([self.tag])
+    
+    def encrypt(self, data):
+        return base64.urlsafe_b64encode(self.encrypt_raw(data))
+    
+    def encrypt_raw(self, data):
+        nonce = os.urandom(AEAD_NONCE_BYTES)
+        # The tag byte is authenticated too, so a token cannot be relabelled
+        return self._header + nonce + self._aead.encrypt(nonce, data, self._header)
+    
+    def decrypt_raw(self, token):
+        try:
+            return self._aead.decrypt(token[1:1 + AEAD_NONCE_BYTES], token[1 + AEAD_NONCE_BYTES:], token[:1])
+        except InvalidTag:
+            raise InvalidToken
+
+class AESGCMCipher(AEADCipher):
+    name = 'aes-256-gcm'
+    tag = 0x01
+    algorithm = AESGCM
+
+class ChaCha20Cipher(AEADCipher):
+    name = 'chacha20-poly1305'
+    tag = 0x02
+    algorithm = ChaCha20Poly1305
+
+CIPHERS = {cipher.name: cipher for cipher in (FernetCipher, AESGCMCipher, ChaCha20Cipher)}
+
+class CipherSuite:
+    """Encrypts with one cipher and decrypts tokens of any of them
+    
+    encrypt() and decrypt() work like Fernet's (urlsafe base64 text tokens);
+    encrypt_raw() skips the base64 for containers that hold bytes;
+    decrypt() takes either form and decrypt_raw() only raw tokens.
+    """
+    
+    def __init__(self, key, cipher='fernet'):
+        if cipher not in CIPHERS:
+            raise ValueError(f"Unknown cipher: {cipher}")
+        self.key = key
+        self.name = cipher
+        self._ciphers = {cls.tag: cls(key) for cls in CIPHERS.values()}
+        self._encryptor = self._ciphers[CIPHERS[cipher].tag]
+    
+    def encrypt(self, data):
+        return self._encryptor.encrypt(data)
+    
+    def encrypt_raw(self, data):
+        return self._encryptor.encrypt_raw(data)
+    
+    def decrypt_raw(self, token):
+        cipher = self._ciphers.get(token[0]) if token else None
+        if cipher is None:
+            raise InvalidToken
+        return cipher.decrypt_raw(bytes(token))
+    
+    def decrypt(self, token):
+        if isinstance(token, str):
+            token = token.encode()
+        if not token:
+            raise InvalidToken
+        if token[0] in self._ciphers:
+            return self.decrypt_raw(token)
+        
+        # Text tokens are base64, whose alphabet never collides with a tag byte
+        if token[:1] == b'g':
+            # Fernet's version byte encodes as 'g'; let Fernet decode it itself
+            return self._ciphers[FernetCipher.tag].decrypt(token)
+        try:
+            token = base64.urlsafe_b64decode(token)
+        except (binascii.Error, ValueError):
+            raise InvalidToken
+        return self.decrypt_raw(token)
+
+# Each log record is a 4-byte big-endian length followed by a raw token
+WAL_FRAME_HEADER = struct.Struct('>I')
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    collection TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (collection, key)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    room TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    id TEXT,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (room, seq)
+);
+CREATE INDEX IF NOT EXISTS messages_id ON messages (id);
+DROP INDEX IF EXISTS messages_room_timestamp;
+"""
+
+# First bytes of every SQLite database file
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+class MessageRing:
+    """Fixed-capacity ring buffer of a room's stored messages
+    
+    append() and eviction are O(1), tail reads are O(k), and indexing and
+    slicing work like the list it replaces.
+    """
+    __slots__ = ('capacity', '_items', '_start')
+    
+    def __init__(self, capacity, messages=()):
+        self.capacity = max(int(capacity), 1)
+        self._items = list(messages)[-self.capacity:]
+        self._start = 0
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def __iter__(self):
+        items, start = self._items, self._start
+        for index in range(len(items)):
+            yield items[(start + index) % len(items)]
+    
+    def __getitem__(self, index):
+        size = len(self._items)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(size)
+            return [self._items[(self._start + i) % size] for i in range(start, stop, step)]
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("message index out of range")
+        return self._items[(self._start + index) % size]
+    
+    def append(self, message):
+        """Add a message, returning the evicted oldest one once the ring is full"""
+        if len(self._items) < self.capacity:
+            self._items.append(message)
+            return None
+        evicted = self._items[self._start]
+        self._items[self._start] = message
+        self._start = (self._start + 1) % self.capacity
+        return evicted
+    
+    def __setitem__(self, index, message):
+        size = len(self._items)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("message index out of range")
+        self._items[(self._start + index) % size] = message
+    
+    def tail(self, count):
+        """The newest count messages, oldest first"""
+        return self[max(len(self._items) - count, 0):]
+    
+    def to_list(self):
+        return self[:]
+    
+    def resize(self, capacity):
+        """Change the capacity, returning how many old messages were dropped"""
+        messages = self.to_list()
+        self.capacity = max(int(capacity), 1)
+        self._items = messages[-self.capacity:]
+        self._start = 0
+        return len(messages) - len(self._items)
+
+def _json_default(value):
+    """JSON fallback: rings serialize as plain message lists, member sets as sorted lists"""
+    if isinstance(value, MessageRing):
+        return value.to_list()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+def _op_targets(op):
+    """Entities touched by a mutation record, as (collection, key) pairs"""
+    kind = op['op']
+    if kind in ('put_user', 'touch_user'):
+        return [('users', op['user_id'])]
+    if kind == 'add_message':
+        return [('users', op['message'].get('user_id'))]
+    if kind in ('put_group', 'add_member', 'remove_member'):
+        return [('groups', op['group_name'])]
+    if kind in ('put_session', 'update_session'):
+        return [('user_sessions', op['session_id'])]
+    if kind == 'remove_sessions':
+        return [('user_sessions', session_id) for session_id in op['session_ids']]
+    return []
+
+# On-disk file format
+#
+# v1 files are one Fernet token over the whole JSON document. v2 files are a
+# magic header followed by frames of (type, section name length, token
+# length, section name, cipher token); every token holds a bounded chunk of
+# one top-level section and is authenticated on its own. A trailer frame
+# records the chunk count so dropped or reordered chunks are detected.
+#
+# The frame type byte also says how the chunk was written: bit 2 marks a
+# token stored as raw bytes instead of base64, bits 3-4 the codec and bits
+# 5-6 the compression applied before encryption.
+STORAGE_FORMAT_VERSION = '2.0'
+FILE_MAGIC = b'CCDB\x02\n'
+FRAME_HEADER = struct.Struct('>BHI')
+FRAME_CHUNK = 1
+FRAME_TRAILER = 2
+FRAME_TYPE_MASK = 0x03
+FRAME_RAW_TOKEN = 0x04
+CHUNK_BYTES = 64 * 1024
+
+# msgpack extension type for cipher tokens kept as raw bytes
+TOKEN_EXT = 1
+
+class JSONCodec:
+    """Chunks as compact JSON"""
+    name = 'json'
+    id = 0
+    
+    def encode_entry(self, entry):
+        return json.dumps(entry, separators=(',', ':'), default=_json_default).encode()
+    
+    def encode_chunk(self, seq, section, kind, entries):
+        body = entries[0] if kind == 'value' else b'[' + b','.join(entries) + b']'
+        return b'{"seq":%d,"section":%s,"kind":"%s","entries":%s}' % (
+            seq, json.dumps(section).encode(), kind.encode(), body)
+    
+    def decode_chunk(self, payload):
+        return json.loads(payload)
+
+class MsgpackCodec:
+    """Chunks as msgpack, with cipher token strings stored as raw bytes"""
+    name = 'msgpack'
+    id = 1
+    
+    def encode_entry(self, entry):
+        return msgpack.packb(_msgpack_value(entry))
+    
+    def encode_chunk(self, seq, section, kind, entries):
+        # Header array followed by the already packed entries
+        return msgpack.packb([seq, section, kind, len(entries)]) + b''.join(entries)
+    
+    def decode_chunk(self, payload):
+        unpacker = msgpack.Unpacker(ext_hook=_msgpack_ext, raw=False, strict_map_key=False)
+        unpacker.feed(payload)
+        seq, section, kind, count = next(unpacker)
+        entries = [next(unpacker) for _ in range(count)]
+        return {'seq': seq, 'section': section, 'kind': kind, 'entries': entries[0] if kind == 'value' else entries}
+
+def _msgpack_value(value):
+    """Prepare a value for msgpack the way _json_default prepares it for JSON"""
+    if isinstance(value, str):
+        # Text tokens are base64 of a binary token; store the binary. Fernet
+        # tokens start 'gAAAAA', AEAD tokens 'A' (tag bytes 0x01, 0x02)
+        if (value.startswith('gAAAAA') or value[:1] == 'A' and len(value) >= 40) and len(value) % 4 == 0:
+            try:
+                raw = base64.urlsafe_b64decode(value)
+                if base64.urlsafe_b64encode(raw).decode() == value:
+                    return msgpack.ExtType(TOKEN_EXT, raw)
+            except ValueError:
+                pass
+        return value
+    if isinstance(value, dict):
+        return {key: _msgpack_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, MessageRing)):
+        return [_msgpack_value(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+def _msgpack_ext(code, data):
+    if code == TOKEN_EXT:
+        return base64.urlsafe_b64encode(data).decode()
+    return msgpack.ExtType(code, data)
+
+FILE_CODECS = {codec.name: codec for codec in (JSONCodec(), MsgpackCodec())}
+FILE_CODECS_BY_ID = {codec.id: codec for codec in FILE_CODECS.values()}
+COMPRESSIONS = {None: 0, 'zlib': 1, 'zstd': 2}
+
+def check_file_options(codec, compression):
+    """Raise ValueError for an unknown or uninstalled codec or compression"""
+    if codec not in FILE_CODECS:
+        raise ValueError(f"Unknown file codec: {codec}")
+    if codec == 'msgpack' and msgpack is None:
+        raise ValueError("The msgpack codec needs the msgpack package")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+
+def _compress(payload, compression_id):
+    if compression_id == 1:
+        return zlib.compress(payload, 6)
+    if compression_id == 2:
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return payload
+
+def _decompress(payload, compression_id):
+    if compression_id == 1:
+        return zlib.decompress(payload)
+    if compression_id == 2:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return payload
+
+def _section_chunks(value, codec):
+    """Split a section into (kind, encoded entries) chunks of about CHUNK_BYTES"""
+    if isinstance(value, dict):
+        kind, entries = 'dict', ([key, item] for key, item in value.items())
+    elif isinstance(value, (list, MessageRing)):
+        kind, entries = 'list', iter(value)
+    else:
+        yield 'value', [codec.encode_entry(value)]
+        return
+    
+    chunk, size, emitted = [], 0, False
+    for entry in entries:
+        encoded = codec.encode_entry(entry)
+        chunk.append(encoded)
+        size += len(encoded)
+        if size >= CHUNK_BYTES:
+            yield kind, chunk
+            chunk, size, emitted = [], 0, True
+    # An empty section still gets a chunk so it loads back as {} or []
+    if chunk or not emitted:
+        yield kind, chunk
+
+def write_encrypted_file(path, cipher, value, codec='json', compression=None, progress=None):
+    """Stream value to path as v2 chunk frames, then atomically replace path
+    
+    progress, if given, is called with the number of entries after each chunk.
+    Returns the number of bytes written.
+    """
+    check_file_options(codec, compression)
+    codec = FILE_CODECS[codec]
+    compression_id = COMPRESSIONS[compression]
+    flags = FRAME_RAW_TOKEN | codec.id << 3 | compression_id << 5
+    sections = value.items() if isinstance(value, dict) else [('', value)]
+    
+    # Write to a temporary file and swap it in so a crash never
+    # leaves a half-written file behind
+    temp_file = path + ".tmp"
+    with open(temp_file, 'wb') as file:
+        file.write(FILE_MAGIC)
+        frames = 0
+        for section, section_value in sections:
+            name = section.encode()
+            for kind, entries in _section_chunks(section_value, codec):
+                payload = _compress(codec.encode_chunk(frames, section, kind, entries), compression_id)
+                token = cipher.encrypt_raw(payload)
+                file.write(FRAME_HEADER.pack(FRAME_CHUNK | flags, len(name), len(token)) + name + token)
+                frames += 1
+                if progress:
+                    progress(len(entries))
+        
+        root = 'dict' if isinstance(value, dict) else 'value'
+        token = cipher.encrypt_raw(json.dumps({'frames': frames, 'root': root}).encode())
+        file.write(FRAME_HEADER.pack(FRAME_TRAILER | FRAME_RAW_TOKEN, 0, len(token)) + token)
+        written = file.tell()
+        # The data must be on disk before the rename can point at it
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, path)
+    _fsync_directory(path)
+    return written
+
+def _fsync_directory(path):
+    """Make a rename into path's directory durable (skipped where directories cannot be opened)"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_encrypted_file(path, cipher, sections=None):
+    """Load an encrypted file of either format (None if missing or empty)
+    
+    For v2 files only the named top-level sections are decrypted when
+    sections is given; the others are skipped without touching their chunks.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            if view[:len(FILE_MAGIC)] != FILE_MAGIC:
+                # v1: a single token over the whole document
+                value = json.loads(cipher.decrypt(view[:]).decode())
+                if sections is not None and isinstance(value, dict):
+                    value = {name: value[name] for name in sections if name in value}
+                return value
+            return _read_frames(view, cipher, sections)
+
+def _decrypt_frame(cipher, frame_type, token):
+    if frame_type & FRAME_RAW_TOKEN:
+        return cipher.decrypt_raw(token)
+    # Frames written before raw tokens hold base64 text
+    return cipher.decrypt(token)
+
+def _read_frames(view, cipher, sections):
+    result = {}
+    offset = len(FILE_MAGIC)
+    frames = 0
+    while offset < len(view):
+        frame_type, name_length, token_length = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        name = view[offset:offset + name_length].decode()
+        offset += name_length
+        token_end = offset + token_length
+        if token_end > len(view):
+            raise ValueError("Truncated database file")
+        
+        if frame_type & FRAME_TYPE_MASK == FRAME_TRAILER:
+            trailer = json.loads(_decrypt_frame(cipher, frame_type, view[offset:token_end]))
+            if trailer['frames'] != frames:
+                raise ValueError("Database file is missing chunks")
+            return result if trailer['root'] == 'dict' else result.get('')
+        
+        if sections is None or name in sections:
+            codec = FILE_CODECS_BY_ID[frame_type >> 3 & 0x03]
+            payload = _decompress(_decrypt_frame(cipher, frame_type, view[offset:token_end]), frame_type >> 5 & 0x03)
+            chunk = codec.decode_chunk(payload)
+            if chunk['seq'] != frames or chunk['section'] != name:
+                raise ValueError("Database file chunks are out of order")
+            if chunk['kind'] == 'dict':
+                result.setdefault(name, {}).update(chunk['entries'])
+            elif chunk['kind'] == 'list':
+                result.setdefault(name, []).extend(chunk['entries'])
+            else:
+                result[name] = chunk['entries']
+        frames += 1
+        offset = token_end
+    
+    raise ValueError("Database file has no trailer")
+
+class StorageBackend:
+    """Persistence layer behind EncryptedDatabase"""
+    name = None
+    
+    def __init__(self, db_file, cipher, checkpoint_interval=1000, codec='json', compression=None):
+        self.db_file = db_file
+        self.cipher = cipher
+        self.checkpoint_interval = checkpoint_interval
+        self.codec = codec
+        self.compression = compression
+        # Running total of encrypted bytes handed to the disk, and the change
+        # in disk usage since committed_size() last took it
+        self.bytes_written = 0
+        self.size_delta = 0
+        # Set by load() when the file on disk is in another layout, so the
+        # database checkpoints it in this backend's layout before any commit
+        self.needs_checkpoint = False
+    
+    def load(self):
+        """Return the stored dataset, or None for a new database"""
+        raise NotImplementedError
+    
+    def replay(self, lsn):
+        """Return committed records newer than the loaded dataset"""
+        return []
+    
+    def commit(self, ops, data):
+        """Make a batch of records that were already applied to data durable"""
+        raise NotImplementedError
+    
+    def snapshot_scope(self, ops):
+        """What commit(ops, data) reads from data
+        
+        None for the whole dataset, a set of room names for the entities plus
+        only those rooms' histories, or False if it does not read data at all.
+        """
+        return None
+    
+    def checkpoint(self, data):
+        """Persist the complete dataset"""
+        raise NotImplementedError
+    
+    def size_bytes(self):
+        """Bytes used on disk"""
+        return os.path.getsize(self.db_file) if os.path.exists(self.db_file) else 0
+    
+    def committed_size(self, previous):
+        """Bytes on disk after a commit, from the size before it and what the commit changed"""
+        delta, self.size_delta = self.size_delta, 0
+        return previous + delta
+    
+    def info(self):
+        """Backend-specific details for get_database_info()"""
+        return {}
+    
+    def close(self):
+        """Release files and connections"""
+        pass
+
+    def _read_file(self, path, sections=None):
+        """Load and decrypt one encrypted JSON file (None if missing or empty)"""
+        return read_encrypted_file(path, self.cipher, sections)
+    
+    def _write_file(self, path, value):
+        """Encrypt one value in chunks and atomically replace path with it"""
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        written = write_encrypted_file(path, self.cipher, value, self.codec, self.compression)
+        self.bytes_written += written
+        self.size_delta += written - previous
+
+class SnapshotBackend(StorageBackend):
+    """Whole dataset rewritten as a single encrypted JSON file on every commit"""
+    name = 'snapshot'
+    
+    def load(self):
+        """Load and decrypt data from file"""
+        try:
+            return self._read_file(self.db_file)
+        except Exception as e:
+            print(f"Error loading database: {e}")
+            return None
+    
+    def commit(self, ops, data):
+        return self.checkpoint(data)
+    
+    def checkpoint(self, data):
+        """Encrypt and save data to file"""
+        try:
+            self._write_file(self.db_file, data)
+            return True
+        except Exception as e:
+            print(f"Error saving database: {e}")
+            return False
+
+class WriteAheadLogBackend(SnapshotBackend):
+    """Snapshot plus an append-only log of encrypted, length-framed records
+    
+    Every commit appends to <db_file>.wal; after checkpoint_interval records
+    the log is folded into the snapshot and truncated.
+    """
+    name = 'wal'
+    
+    def __init__(self, db_file, cipher, checkpoint_interval=1000, **options):
+        super().__init__(db_file, cipher, checkpoint_interval, **options)
+        self.wal_file = db_file + ".wal"
+        self._records_since_checkpoint = 0
+        self._handle = None
+    
+    def replay(self, lsn):
+        """Read log records written after the last checkpoint"""
+        if not os.path.exists(self.wal_file):
+            return []
+        
+        with open(self.wal_file, 'rb') as file:
+            log_data = file.read()
+        
+        offset = 0
+        records = []
+        while offset + WAL_FRAME_HEADER.size <= len(log_data):
+            (length,) = WAL_FRAME_HEADER.unpack_from(log_data, offset)
+            end = offset + WAL_FRAME_HEADER.size + length
+            if end > len(log_data):
+                break
+            
+            try:
+                op = json.loads(self.cipher.decrypt(
+                    log_data[offset + WAL_FRAME_HEADER.size:end]
+                ).decode())
+            except (InvalidToken, ValueError) as e:
+                print(f"Error reading write-ahead log record: {e}")
+                break
+            
+            # Records at or below the snapshot LSN were already checkpointed, and
+            # a commit retried after a failure may have appended some twice
+            if op['lsn'] > lsn:
+                records.append(op)
+                lsn = op['lsn']
+            offset = end
+        
+        # Drop a torn tail so new records are not appended after garbage
+        if offset < len(log_data):
+            with open(self.wal_file, 'r+b') as file:
+                file.truncate(offset)
+        
+        self._records_since_checkpoint = len(records)
+        return records
+    
+    def commit(self, ops, data):
+        """Append encrypted, length-framed records to the log in one write"""
+        try:
+            frames = []
+            for op in ops:
+                record = self.cipher.encrypt_raw(
+                    json.dumps(op, separators=(',', ':'), default=_json_default).encode()
+                )
+                frames.append(WAL_FRAME_HEADER.pack(len(record)) + record)
+            if self._handle is None:
+                self._handle = open(self.wal_file, 'ab')
+            payload = b''.join(frames)
+            self._handle.write(payload)
+            self._handle.flush()
+            # One fsync per group commit; without it a power loss can drop acknowledged records
+            os.fsync(self._handle.fileno())
+            self.bytes_written += len(payload)
+            self.size_delta += len(payload)
+        except Exception as e:
+            print(f"Error appending to write-ahead log: {e}")
+            return False
+        
+        self._records_since_checkpoint += len(ops)
+        if self._records_since_checkpoint >= self.checkpoint_interval:
+            return self.checkpoint(data)
+        return True
+    
+    def snapshot_scope(self, ops):
+        # Only a commit that ends in a checkpoint reads the dataset
+        if self._records_since_checkpoint + len(ops) >= self.checkpoint_interval:
+            return None
+        return False
+    
+    def checkpoint(self, data):
+        """Fold the log into a new snapshot and start a fresh log segment"""
+        # The snapshot is fsynced and renamed into place before the log it replaces is emptied
+        if not super().checkpoint(data):
+            return False
+        
+        self._records_since_checkpoint = 0
+        self.close()
+        if os.path.exists(self.wal_file):
+            self.size_delta -= os.path.getsize(self.wal_file)
+            with open(self.wal_file, 'wb'):
+                pass
+        return True
+    
+    def size_bytes(self):
+        wal_size = os.path.getsize(self.wal_file) if os.path.exists(self.wal_file) else 0
+        return super().size_bytes() + wal_size
+    
+    def info(self):
+        return {
+            'wal_file': os.path.abspath(self.wal_file),
+            'wal_size_bytes': os.path.getsize(self.wal_file) if os.path.exists(self.wal_file) else 0,
+            'records_since_checkpoint': self._records_since_checkpoint
+        }
+    
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+class SQLiteBackend(StorageBackend):
+    """One encrypted payload per row, with messages keyed by room and sequence
+    
+    Retention deletes rows in step with the in-memory rings, so the table
+    never holds history that memory does not; pages are served from memory.
+    A db_file written by another mode is read once, moved aside to
+    <db_file>.pre-sqlite and checkpointed into fresh tables.
+    """
+    name = 'sqlite'
+    
+    def __init__(self, db_file, cipher, checkpoint_interval=1000, **options):
+        super().__init__(db_file, cipher, checkpoint_interval, **options)
+        self._imported = None
+        if os.path.exists(db_file) and os.path.getsize(db_file) > 0:
+            with open(db_file, 'rb') as file:
+                if file.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+                    self._imported = self._import_file()
+        # Commits are serialized by EncryptedDatabase, but come from
+        # whichever handler or flusher thread drains the pending records
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+    
+    def _encrypt(self, value):
+        # Every encrypted payload is written to a row
+        payload = self.cipher.encrypt_raw(json.dumps(value, separators=(',', ':'), default=_json_default).encode())
+        self.bytes_written += len(payload)
+        return payload
+    
+    def _decrypt(self, payload):
+        return json.loads(self.cipher.decrypt(payload).decode())
+    
+    def _import_file(self):
+        """Read a db_file written by the file-based modes and move it out of SQLite's way"""
+        wal_file = self.db_file + ".wal"
+        if os.path.exists(wal_file) and os.path.getsize(wal_file) > 0:
+            raise ValueError(f"{self.db_file} has write-ahead log records that are not checkpointed; "
+                             f"open it in wal mode first")
+        backend = ShardedFileBackend if os.path.isdir(self.db_file + ".shards") else SnapshotBackend
+        data = backend(self.db_file, self.cipher).load()
+        if data is None:
+            raise ValueError(f"{self.db_file} is neither a SQLite database nor readable with this password")
+        os.replace(self.db_file, self.db_file + ".pre-sqlite")
+        return data
+    
+    def load(self):
+        """Hydrate the in-memory dataset from the tables"""
+        if self._imported is not None:
+            data, self._imported = self._imported, None
+            self.needs_checkpoint = True
+            return data
+        try:
+            rows = self.conn.execute("SELECT collection, key, payload FROM records").fetchall()
+            if not rows:
+                return None
+            
+            data = {'users': {}, 'public_messages': [], 'groups': {}, 'user_sessions': {}, 'metadata': {}}
+            for collection, key, payload in rows:
+                if collection == 'metadata':
+                    data['metadata'] = self._decrypt(payload)
+                else:
+                    data[collection][key] = self._decrypt(payload)
+            
+            for group in data['groups'].values():
+                group['messages'] = []
+            for room, payload in self.conn.execute("SELECT room, payload FROM messages ORDER BY room, seq"):
+                if room == 'public':
+                    data['public_messages'].append(self._decrypt(payload))
+                elif room in data['groups']:
+                    data['groups'][room]['messages'].append(self._decrypt(payload))
+            
+            return data
+        except Exception as e:
+            print(f"Error loading database: {e}")
+            return None
+    
+    def _put_record(self, data, collection, key):
+        """Upsert one entity from data, or delete its row if it is gone"""
+        value = data[collection].get(key)
+        if value is None:
+            self.conn.execute("DELETE FROM records WHERE collection = ? AND key = ?", (collection, key))
+            return
+        
+        if collection == 'groups':
+            # Group history lives in the messages table
+            value = {k: v for k, v in value.items() if k != 'messages'}
+        self.conn.execute(
+            "INSERT OR REPLACE INTO records (collection, key, payload) VALUES (?, ?, ?)",
+            (collection, key, self._encrypt(value))
+        )
+    
+    def _insert_message(self, room, seq, message):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO messages (room, seq, id, payload) VALUES (?, ?, ?, ?)",
+            (room, seq, message.get('id'), self._encrypt(message))
+        )
+    
+    def commit(self, ops, data):
+        """Insert new messages and upsert only the entities the batch touched"""
+        if self.needs_checkpoint:
+            return self.checkpoint(data)
+        try:
+            with self.conn:
+                touched = set()
+                for op in ops:
+                    if op['op'] == 'add_message':
+                        self._insert_message(op['room'], op['lsn'], op['message'])
+                    elif op['op'] == 'migrate_messages':
+                        # Rows are in ring order, so a ring position is an offset by seq
+                        self.conn.executemany(
+                            "UPDATE messages SET payload = ? WHERE room = ? AND seq = "
+                            "(SELECT seq FROM messages WHERE room = ? ORDER BY seq LIMIT 1 OFFSET ?)",
+                            [(self._encrypt(message), op['room'], op['room'], index)
+                             for index, message in op['messages']]
+                        )
+                    # Mirror the in-memory retention trim
+                    if op.get('evicted'):
+                        self.conn.execute(
+                            "DELETE FROM messages WHERE room = ? AND seq IN "
+                            "(SELECT seq FROM messages WHERE room = ? ORDER BY seq LIMIT ?)",
+                            (op['room'], op['room'], op['evicted'])
+                        )
+                    touched.update(_op_targets(op))
+                
+                for collection, key in touched:
+                    if key is not None:
+                        self._put_record(data, collection, key)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO records (collection, key, payload) VALUES ('metadata', 'metadata', ?)",
+                    (self._encrypt(data['metadata']),)
+                )
+            return True
+        except Exception as e:
+            print(f"Error saving database: {e}")
+            return False
+    
+    def snapshot_scope(self, ops):
+        if self.needs_checkpoint:
+            return None
+        # New messages come from the records themselves
+        return set()
+    
+    def checkpoint(self, data):
+        """Rewrite every table from the in-memory dataset"""
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM records")
+                self.conn.execute("DELETE FROM messages")
+                for collection in ('users', 'groups', 'user_sessions'):
+                    for key in data[collection]:
+                        self._put_record(data, collection, key)
+                self.conn.execute(
+                    "INSERT INTO records (collection, key, payload) VALUES ('metadata', 'metadata', ?)",
+                    (self._encrypt(data['metadata']),)
+                )
+                
+                # Sequence numbers stay below the current LSN so later
+                # inserts (keyed by their record LSN) sort after them
+                lsn = data['metadata'].get('lsn', 0)
+                rooms = [('public', data['public_messages'])]
+                rooms += [(name, group.get('messages', [])) for name, group in data['groups'].items()]
+                for room, messages in rooms:
+                    for index, message in enumerate(messages):
+                        self._insert_message(room, lsn - len(messages) + index + 1, message)
+            self.needs_checkpoint = False
+            return True
+        except Exception as e:
+            print(f"Error saving database: {e}")
+            return False
+    
+    def size_bytes(self):
+        return sum(
+            os.path.getsize(path) for path in (self.db_file, self.db_file + "-wal")
+            if os.path.exists(path)
+        )
+    
+    def committed_size(self, previous):
+        # SQLite grows and reuses pages regardless of payload sizes; two stats are cheap
+        self.size_delta = 0
+        return self.size_bytes()
+    
+    def close(self):
+        self.conn.close()
+
+class ShardedFileBackend(StorageBackend):
+    """Metadata in db_file and each room's history in its own encrypted shard
+    
+    Shards live in <db_file>.shards/ as public.shard and group_<id>.shard, so
+    a message only rewrites the shard of the room it was sent to. Activity
+    counters (message_count, last_active) ride along with the next metadata
+    write, or at the latest after checkpoint_interval commits.
+    """
+    name = 'sharded'
+    
+    # Records that only bump activity counters in the metadata file
+    LAZY_OPS = ('add_message', 'touch_user')
+    
+    def __init__(self, db_file, cipher, checkpoint_interval=1000, **options):
+        super().__init__(db_file, cipher, checkpoint_interval, **options)
+        self.shard_dir = db_file + ".shards"
+        self.shard_count = 0
+        self._lazy_commits = 0
+        # Snapshot of the last commit whose counters are not in the metadata file yet
+        self._lazy_data = None
+    
+    def _shard_path(self, data, room):
+        if room == 'public':
+            return os.path.join(self.shard_dir, "public.shard")
+        return os.path.join(self.shard_dir, f"group_{data['groups'][room]['id']}.shard")
+    
+    def _room_messages(self, data, room):
+        if room == 'public':
+            return data['public_messages']
+        return data['groups'][room].get('messages', [])
+    
+    def load(self):
+        """Load the metadata file, then every room's shard"""
+        try:
+            data = self._read_file(self.db_file)
+            if data is None:
+                return None
+            
+            if os.path.isdir(self.shard_dir):
+                self.shard_count = sum(1 for entry in os.scandir(self.shard_dir) if entry.name.endswith('.shard'))
+            # A room without a shard keeps the history stored in the file itself,
+            # as written by the snapshot and WAL modes or an older version
+            rooms = [('public', data)] + [(name, group) for name, group in data['groups'].items()]
+            for name, holder in rooms:
+                field = 'public_messages' if name == 'public' else 'messages'
+                messages = self._read_file(self._shard_path(data, name))
+                if messages is None:
+                    messages = holder.get(field) or []
+                    self.needs_checkpoint = self.needs_checkpoint or bool(messages)
+                holder[field] = messages
+            return data
+        except Exception as e:
+            print(f"Error loading database: {e}")
+            return None
+    
+    def _write_metadata(self, data):
+        metadata = {
+            'users': data['users'],
+            'groups': {
+                name: {k: v for k, v in group.items() if k != 'messages'}
+                for name, group in data['groups'].items()
+            },
+            'user_sessions': data['user_sessions'],
+            'metadata': data['metadata']
+        }
+        self._write_file(self.db_file, metadata)
+        self._lazy_commits = 0
+        self._lazy_data = None
+    
+    def _write_shard(self, data, room):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        path = self._shard_path(data, room)
+        created = not os.path.exists(path)
+        self._write_file(path, self._room_messages(data, room))
+        if created:
+            self.shard_count += 1
+    
+    def commit(self, ops, data):
+        """Rewrite only the shards of rooms that received messages"""
+        if self.needs_checkpoint:
+            return self.checkpoint(data)
+        try:
+            rooms = {op['room'] for op in ops if 'room' in op}
+            for room in rooms:
+                if room == 'public' or room in data['groups']:
+                    self._write_shard(data, room)
+            
+            self._lazy_commits += 1
+            if (any(op['op'] not in self.LAZY_OPS for op in ops)
+                    or self._lazy_commits >= self.checkpoint_interval):
+                self._write_metadata(data)
+            else:
+                self._lazy_data = data
+            return True
+        except Exception as e:
+            print(f"Error saving database: {e}")
+            return False
+    
+    def snapshot_scope(self, ops):
+        if self.needs_checkpoint:
+            return None
+        return {op['room'] for op in ops if 'room' in op}
+    
+    def checkpoint(self, data):
+        """Rewrite the metadata file and every shard, dropping orphaned shards"""
+        try:
+            # Shards first: until they exist the metadata file is the only copy of their history
+            rooms = ['public'] + list(data['groups'])
+            for room in rooms:
+                self._write_shard(data, room)
+            self._write_metadata(data)
+            
+            live = {os.path.basename(self._shard_path(data, room)) for room in rooms}
+            for entry in os.listdir(self.shard_dir):
+                if entry.endswith('.shard') and entry not in live:
+                    os.remove(os.path.join(self.shard_dir, entry))
+            self.shard_count = len(live)
+            self.needs_checkpoint = False
+            return True
+        except Exception as e:
+            print(f"Error saving database: {e}")
+            return False
+    
+    def size_bytes(self):
+        total = super().size_bytes()
+        if os.path.isdir(self.shard_dir):
+            for entry in os.scandir(self.shard_dir):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    # A temporary file renamed over its shard while scanning
+                    pass
+        return total
+    
+    def info(self):
+        return {
+            'shard_dir': os.path.abspath(self.shard_dir),
+            'shard_count': self.shard_count,
+            'commits_since_metadata_write': self._lazy_commits
+        }
+    
+    def close(self):
+        """Write counters still held back by lazy commits"""
+        if self._lazy_commits > 0 and self._lazy_data is not None:
+            try:
+                self._write_metadata(self._lazy_data)
+            except Exception as e:
+                print(f"Error saving database: {e}")
+
+# Storage modes selectable by name; register a StorageBackend subclass here to add one
+STORAGE_BACKENDS = {
+    SnapshotBackend.name: SnapshotBackend,
+    WriteAheadLogBackend.name: WriteAheadLogBackend,
+    SQLiteBackend.name: SQLiteBackend,
+    ShardedFileBackend.name: ShardedFileBackend
+}
+
+# Records that add or remove users, groups or members, or change retention;
+# they take the metadata lock exclusively
+STRUCTURAL_OPS = ('put_user', 'put_group', 'add_member', 'remove_member', 'set_capacity')
+
+# Records that only touch the session table
+SESSION_OPS = ('put_session', 'update_session', 'remove_sessions')
+
+# Records kept for incremental backups before falling back to a full one
+BACKUP_JOURNAL_MAX_OPS = 100000
+
+# Message records
+#
+# v1 records are the message dict as sent plus 'encrypted_message',
+# 'double_encrypted_content' and 'stored_at', so content is held twice in
+# clear and twice encrypted. v2 records keep only id, user_id, room and an
+# epoch-ms timestamp in clear; everything else is one cipher token in 'ct'.
+MESSAGE_SCHEMA_VERSION = 2
+MESSAGE_METADATA_FIELDS = ('id', 'user_id', 'room')
+LEGACY_MESSAGE_FIELDS = ('encrypted_message', 'double_encrypted_content', 'stored_at')
+
+def _timestamp_ms(value):
+    """Epoch milliseconds of an ISO timestamp, or None if it does not parse"""
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return int(moment.replace(microsecond=0).timestamp()) * 1000 + moment.microsecond // 1000
+
+def _iso_timestamp(milliseconds):
+    return datetime.fromtimestamp(milliseconds / 1000).isoformat(timespec='milliseconds')
+
+def message_time_ms(record):
+    """Sort key of a stored message of either schema"""
+    if record.get('v') == MESSAGE_SCHEMA_VERSION:
+        return record['ts']
+    return _timestamp_ms(record.get('timestamp')) or 0
+
+def _message_view(record, content):
+    """The message as handlers see it, from a v2 record and its decrypted content"""
+    message = {field: record[field] for field in MESSAGE_METADATA_FIELDS if field in record}
+    message['timestamp'] = _iso_timestamp(record['ts'])
+    # An unparseable original timestamp travels in the content and wins
+    message.update(content)
+    return message
+
+def encrypt_message_fields(cipher, message_data):
+    """Encrypt a message into a v2 record"""
+    record = {'v': MESSAGE_SCHEMA_VERSION}
+    content = {}
+    for field, value in message_data.items():
+        if field in MESSAGE_METADATA_FIELDS:
+            record[field] = value
+        elif field not in LEGACY_MESSAGE_FIELDS:
+            content[field] = value
+    
+    record['ts'] = _timestamp_ms(message_data.get('timestamp'))
+    if record['ts'] is None:
+        record['ts'] = int(time.time() * 1000)
+    else:
+        content.pop('timestamp', None)
+    
+    record['ct'] = cipher.encrypt(json.dumps(content, separators=(',', ':')).encode()).decode()
+    return record
+
+def decrypt_message_fields(cipher, encrypted_data):
+    """Decrypt message content"""
+    if encrypted_data.get('v') == MESSAGE_SCHEMA_VERSION:
+        try:
+            content = json.loads(cipher.decrypt(encrypted_data['ct'].encode()))
+        except Exception as e:
+            print(f"Error decrypting message: {e}")
+            content = {}
+        return _message_view(encrypted_data, content)
+    
+    # v1 record
+    decrypted_data = encrypted_data.copy()
+    
+    # Decrypt the message content
+    if 'encrypted_message' in encrypted_data:
+        try:
+            decrypted_data['message'] = cipher.decrypt(
+                encrypted_data['encrypted_message'].encode()
+            ).decode()
+        except Exception as e:
+            print(f"Error decrypting message: {e}")
+    
+    if 'double_encrypted_content' in encrypted_data:
+        try:
+            decrypted_data['encrypted_content'] = cipher.decrypt(
+                encrypted_data['double_encrypted_content'].encode()
+            ).decode()
+        except Exception as e:
+            print(f"Error decrypting content: {e}")
+    
+    return decrypted_data
+
+# Per-process cipher suite for the process crypto pool
+_worker_cipher = None
+
+def _init_crypto_worker(key, cipher):
+    global _worker_cipher
+    _worker_cipher = CipherSuite(key, cipher)
+
+def _crypt_chunk_in_worker(function, messages):
+    return [function(_worker_cipher, message) for message in messages]
+
+class DecryptedMessageCache:
+    """Bounded LRU of decrypted history tails, one contiguous tail per room"""
+    
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rooms = OrderedDict()  # room -> [MessageRing sized to the room, size in bytes]
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _size_of(message):
+        """Rough in-memory footprint of a decrypted message dict"""
+        return 64 + sum(len(str(value)) + 32 for value in message.values())
+    
+    def get(self, room, start, end, total):
+        """Copies of messages[start:end] of a room holding total messages, or None on a miss"""
+        with self._lock:
+            entry = self._rooms.get(room)
+            offset = total - len(entry[0]) if entry else total
+            if entry is None or start < offset:
+                self.misses += 1
+                return None
+            
+            self._rooms.move_to_end(room)
+            self.hits += 1
+            return [dict(message) for message in entry[0][start - offset:end - offset]]
+    
+    def store(self, room, start, messages, total):
+        """Remember a decrypted page if it is, or extends, the cached tail of the room"""
+        if self.max_bytes <= 0:
+            return
+        
+        with self._lock:
+            entry = self._rooms.get(room)
+            end = start + len(messages)
+            if end == total and (entry is None or len(messages) > len(entry[0])):
+                cached = [dict(message) for message in messages]
+            elif entry is not None and start < total - len(entry[0]) <= end:
+                # Older page adjoining the cached tail
+                cached = [dict(message) for message in messages[:total - len(entry[0]) - start]] + entry[0].to_list()
+            else:
+                return
+            
+            self._replace(room, cached, total)
+    
+    def append(self, room, message, capacity):
+        """Extend a cached tail with a newly stored message, evicting past the room's capacity"""
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                return
+            
+            cached = entry[0]
+            dropped = []
+            if cached.capacity != capacity:
+                # Sized to the tail when stored, or the room's retention changed
+                dropped = cached[:max(len(cached) - capacity, 0)]
+                cached.resize(capacity)
+            evicted = cached.append(dict(message))
+            if evicted is not None:
+                dropped.append(evicted)
+            change = self._size_of(message) - sum(self._size_of(old) for old in dropped)
+            entry[1] += change
+            self.bytes += change
+            self._evict()
+    
+    def invalidate(self, room=None):
+        """Forget one room, or everything"""
+        with self._lock:
+            if room is None:
+                self._rooms.clear()
+                self.bytes = 0
+            elif room in self._rooms:
+                self.bytes -= self._rooms.pop(room)[1]
+    
+    def _replace(self, room, messages, total):
+        if room in self._rooms:
+            self.bytes -= self._rooms.pop(room)[1]
+        size = sum(self._size_of(message) for message in messages)
+        self._rooms[room] = [MessageRing(total, messages), size]
+        self.bytes += size
+        self._evict()
+    
+    def _evict(self):
+        # Least recently used rooms go first; the newest entry may exceed the cap alone
+        while self.bytes > self.max_bytes and len(self._rooms) > 1:
+            _, (messages, size) = self._rooms.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+    
+    def stats(self):
+        """Hit/miss counters and memory use"""
+        lookups = self.hits + self.misses
+        return {
+            'rooms': len(self._rooms),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions
+        }
+
+class ReadWriteLock:
+    """Shared/exclusive lock; waiting writers hold off new readers so they are not starved
+    
+    Not re-entrant: a thread must not take either side while holding one.
+    """
+    
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+    
+    @contextmanager
+    def read_lock(self):
+        with self._condition:
+            while self._writer or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+    
+    @contextmanager
+    def write_lock(self):
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+class SessionStore:
+    """Socket session table with a min-heap of last activity for incremental expiry
+    
+    Lookups are O(1) dict reads. Every touch pushes a fresh heap entry and
+    superseded entries are skipped when they surface, so expiring k sessions
+    costs O(k log n) instead of a scan that parses every timestamp.
+    """
+    
+    def __init__(self, sessions=None):
+        self.sessions = sessions if sessions is not None else {}
+        self._last_activity = {}
+        self._heap = []
+        self._lock = threading.Lock()
+        for session_id, session in self.sessions.items():
+            self._track(session_id, self._parse_time(session.get('last_activity')))
+    
+    @staticmethod
+    def _parse_time(value):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except (TypeError, ValueError):
+            # Unparseable sessions expire on the next sweep
+            return 0.0
+    
+    def _track(self, session_id, at):
+        self._last_activity[session_id] = at
+        heapq.heappush(self._heap, (at, session_id))
+        # Drop superseded entries once they dominate the heap
+        if len(self._heap) > 2 * len(self._last_activity) + 64:
+            self._heap = [(t, sid) for sid, t in self._last_activity.items()]
+            heapq.heapify(self._heap)
+    
+    def __len__(self):
+        return len(self.sessions)
+    
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+    
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+    
+    def put(self, session_id, session):
+        with self._lock:
+            self.sessions[session_id] = session
+            self._track(session_id, self._parse_time(session['last_activity']))
+    
+    def update(self, session_id, data, at):
+        """Merge data into a session and mark it active at the ISO time at"""
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            session.update(data)
+            session['last_activity'] = at
+            self._track(session_id, self._parse_time(at))
+            return True
+    
+    def remove(self, session_id):
+        with self._lock:
+            self._last_activity.pop(session_id, None)
+            return self.sessions.pop(session_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self.sessions.clear()
+            self._last_activity.clear()
+            self._heap = []
+    
+    def snapshot(self):
+        """Copies of every session, consistent with concurrent updates"""
+        with self._lock:
+            return {session_id: dict(session) for session_id, session in self.sessions.items()}
+    
+    def expire(self, cutoff, limit=None):
+        """Remove sessions idle since before the epoch time cutoff, oldest first"""
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < cutoff:
+                if limit is not None and len(expired) >= limit:
+                    break
+                at, session_id = heapq.heappop(self._heap)
+                if self._last_activity.get(session_id) != at:
+                    continue
+                del self._last_activity[session_id]
+                self.sessions.pop(session_id, None)
+                expired.append(session_id)
+        return expired
+
+class GroupDirectory:
+    """Maintained group summaries plus a bounded log of directory changes
+    
+    The version is the lsn of the last record that added or removed a group,
+    so it only moves forward and survives restarts. changes_since() answers
+    with the net added/removed names, or None when the log no longer reaches
+    back far enough and the caller needs a full snapshot.
+    """
+    
+    def __init__(self, max_changes=1000):
+        self.summaries = {}
+        self.version = 0
+        self._changes = deque(maxlen=max_changes)
+    
+    @staticmethod
+    def summarize(group):
+        return {
+            'id': group['id'],
+            'name': group['name'],
+            'creator': group['creator'],
+            'created_at': group['created_at'],
+            'member_count': len(group['members']),
+            'message_count': len(group.get('messages', [])),
+            'has_password': bool(group['encrypted_password'])
+        }
+    
+    def rebuild(self, groups, version):
+        """Summarize every group from scratch; earlier versions can only get a snapshot"""
+        self.summaries = {name: self.summarize(group) for name, group in groups.items()}
+        self.version = version
+        self._changes.clear()
+    
+    def add(self, name, group, version):
+        self.summaries[name] = self.summarize(group)
+        self._changes.append((self.version, version, name, True))
+        self.version = version
+    
+    def remove(self, name, version):
+        if self.summaries.pop(name, None) is not None:
+            self._changes.append((self.version, version, name, False))
+            self.version = version
+    
+    def update(self, name, **counts):
+        summary = self.summaries.get(name)
+        if summary is not None:
+            summary.update(counts)
+    
+    def changes_since(self, version):
+        """Net directory changes after version, or None if they are no longer known"""
+        if version == self.version:
+            return {'previous_version': version, 'version': self.version, 'added': [], 'removed': []}
+        if version is None or version > self.version or not self._changes or version < self._changes[0][0]:
+            return None
+        
+        present = {}
+        for _, current, name, added in self._changes:
+            if current > version:
+                present[name] = added
+        return {
+            'previous_version': version,
+            'version': self.version,
+            'added': [name for name, added in present.items() if added],
+            'removed': [name for name, added in present.items() if not added]
+        }
+
 class EncryptedDatabase:
-    def __init__(self, db_file="encrypted_chat.db", password="default-db-password"):
+    def __init__(self, db_file="encrypted_chat.db", password="default-db-password",
+                 storage_mode="snapshot", checkpoint_interval=1000,
+                 write_behind=False, flush_interval_ms=50, flush_max_ops=100,
+                 message_cache_bytes=8 * 1024 * 1024,
+                 crypto_workers=None, crypto_pool="thread", parallel_threshold=64,
+                 max_room_messages=1000, persist_sessions=False, file_codec="json", compression=None,
+                 cipher="fernet", metrics=None):
+        if storage_mode not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown storage mode: {storage_mode}")
+        check_file_options(file_codec, compression)
+        
         self.db_file = db_file
         self.password = password
+        self.storage_mode = storage_mode
         self.key = self._generate_key(password)
-        self.fernet = Fernet(self.key)
-        self.data = self._load_data()
+        # New data is encrypted with the chosen cipher; data written with any
+        # other cipher keeps decrypting
+        self.cipher = CipherSuite(self.key, cipher)
+        self.backend = STORAGE_BACKENDS[storage_mode](
+            db_file, self.cipher, checkpoint_interval, codec=file_codec, compression=compression
+        )
+        
+        # Optional metrics.MetricsRegistry; without one nothing is timed or counted
+        self.metrics = metrics
+        if metrics is not None:
+            self._register_metrics(metrics)
+        
+        # Log sequence number of the last applied mutation
+        self.lsn = 0
+        
+        # Write-behind: mutations are applied in memory right away and a
+        # flusher thread commits them in batches every flush_interval_ms
+        # or as soon as flush_max_ops records are pending
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_max_ops = flush_max_ops
+        self._pending = []
+        
+        # Locking, always taken in this order:
+        #   _meta_lock   readers share it; adding users, groups and members
+        #                or swapping the dataset takes it exclusively
+        #   room locks   one per room, held while its history is appended
+        #                to or read
+        #   _io_lock     serializes backend writes, which run on snapshots
+        #                outside the locks below
+        #   _lock        numbers and applies records, so it is only ever
+        #                held for in-memory work
+        self._meta_lock = ReadWriteLock()
+        self._room_locks = {}
+        self._io_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._flush_requested = threading.Event()
+        self._closed = False
+        self._flusher = None
+        
+        # Backups: records applied since the last successful backup are kept
+        # (serialized) so the next backup can be incremental
+        self._journal = None
+        self._last_backup = None
+        self.backup_jobs = {}
+        
+        # Decrypted tails of recently read rooms, so reconnect storms are memory copies
+        self.message_cache = DecryptedMessageCache(message_cache_bytes)
+        self.group_directory = GroupDirectory()
+        # username -> names of the groups it belongs to
+        self.user_groups = {}
+        
+        # Counters kept up to date by the mutation handlers and backend
+        # writes, so statistics never walk the rooms or stat the disk
+        self._message_count = 0
+        self._disk_bytes = 0
+        
+        # Batches of at least parallel_threshold messages are split across a
+        # thread pool (cryptography releases the GIL) or a process pool
+        if crypto_pool not in ('thread', 'process'):
+            raise ValueError(f"Unknown crypto pool: {crypto_pool}")
+        self.crypto_pool_kind = crypto_pool
+        self.crypto_workers = crypto_workers or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self._crypto_pool = None
+        
+        # Default history retention; set_room_capacity() overrides it per room
+        self.max_room_messages = max_room_messages
+        
+        # Socket.IO sids mean nothing after a restart, so by default sessions
+        # live only in memory and connect/disconnect never touches the disk
+        self.persist_sessions = persist_sessions
+        
+        self.data = self.backend.load()
         
         # Initialize empty structure if new database
         if not self.data:
             self.data = {
                 'users': {},
-                'public_messages': [],
+                'public_messages': MessageRing(max_room_messages),
                 'groups': {},
                 'user_sessions': {},
                 'metadata': {
                     'created_at': datetime.now().isoformat(),
                     'last_updated': datetime.now().isoformat(),
-                    'version': '1.0'
+                    'version': STORAGE_FORMAT_VERSION
                 }
             }
+            self._load_sessions()
+            self._rebuild_group_indexes()
             self.save()
+        else:
+            self.lsn = self.data['metadata'].get('lsn', 0)
+            
+            # Replay under the retention the records were written with, then
+            # switch to the configured one
+            self.max_room_messages = self.data['metadata'].get('max_room_messages', max_room_messages)
+            self._hydrate_rooms()
+            self._load_sessions()
+            self._rebuild_group_indexes()
+            for op in self.backend.replay(self.lsn):
+                self._apply_op(op)
+                self.lsn = op['lsn']
+            self.max_room_messages = max_room_messages
+            if not self.persist_sessions:
+                self.sessions.clear()
+            
+            # A lower retention than the stored history must reach the disk too
+            trimmed = self._hydrate_rooms()
+            if trimmed:
+                self._rebuild_group_indexes()
+            
+            # Files from older versions are rewritten in the current format
+            if (trimmed or self.backend.needs_checkpoint
+                    or self.data['metadata'].get('version') != STORAGE_FORMAT_VERSION):
+                self.save()
+        
+        self._measure_disk_bytes()
+        if self.write_behind:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+    
+    def _register_metrics(self, metrics):
+        """Create this database's instruments in a metrics registry"""
+        from encrypted_chat_app.metrics import CRYPTO_BUCKETS, SIZE_BUCKETS
+        self._write_seconds = metrics.histogram(
+            'chat_db_write_seconds', 'Time to write to the storage backend (commit or full save)', ('kind',)
+        )
+        self._write_bytes = metrics.histogram(
+            'chat_db_write_bytes', 'Encrypted bytes written per commit or full save', ('kind',), SIZE_BUCKETS
+        )
+        self._crypto_seconds = metrics.histogram(
+            'chat_db_crypto_seconds', 'Time to encrypt or decrypt one field', ('operation', 'field'), CRYPTO_BUCKETS
+        )
+        metrics.gauge('chat_db_messages', 'Messages held in memory across all rooms',
+                      function=lambda: self._message_count)
+        metrics.gauge('chat_db_size_bytes', 'Bytes used on disk by the database', function=lambda: self._disk_bytes)
+    
+    def _measure_disk_bytes(self):
+        """Size the backend from scratch; the caller holds _io_lock or is still constructing"""
+        self.backend.size_delta = 0
+        self._disk_bytes = self.backend.size_bytes()
+    
+    def _backend_write(self, kind, write, *args):
+        """Run a backend write under _io_lock, then update the size on disk and record metrics
+        
+        Commits adjust the size by what they changed; only full saves, which
+        can also delete files, measure the backend from scratch.
+        """
+        written = self.backend.bytes_written
+        start = time.perf_counter()
+        result = write(*args)
+        elapsed = time.perf_counter() - start
+        if kind == 'save':
+            self._measure_disk_bytes()
+        else:
+            self._disk_bytes = self.backend.committed_size(self._disk_bytes)
+        if self.metrics is not None:
+            self._write_seconds.observe(elapsed, (kind,))
+            self._write_bytes.observe(self.backend.bytes_written - written, (kind,))
+        return result
+    
+    def _crypto(self, operation, field, function, *args, count=1):
+        """Run an encrypt or decrypt call, recording its time per item when metrics are on"""
+        if self.metrics is None:
+            return function(*args)
+        start = time.perf_counter()
+        result = function(*args)
+        self._crypto_seconds.observe((time.perf_counter() - start) / max(count, 1), (operation, field), count)
+        return result
     
     def _generate_key(self, password):
         """Generate encryption key from password"""
@@ -43,43 +1670,275 @@ class EncryptedDatabase:
         key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
         return key
     
-    def _load_data(self):
-        """Load and decrypt data from file"""
-        if not os.path.exists(self.db_file):
-            return None
-        
-        try:
-            with open(self.db_file, 'rb') as file:
-                encrypted_data = file.read()
-                
-            if not encrypted_data:
-                return None
-                
-            decrypted_data = self.fernet.decrypt(encrypted_data)
-            return json.loads(decrypted_data.decode())
-        
-        except Exception as e:
-            print(f"Error loading database: {e}")
-            return None
+    def _room_capacity(self, room):
+        """Retention cap of a room"""
+        return self.data['metadata'].get('room_capacities', {}).get(room, self.max_room_messages)
+    
+    def _hydrate_rooms(self):
+        """Give every room a ring of its current capacity, returning whether any history was dropped"""
+        trimmed = False
+        rooms = [('public', self.data)] + [(name, group) for name, group in self.data['groups'].items()]
+        for room, holder in rooms:
+            key = 'public_messages' if room == 'public' else 'messages'
+            messages = holder.get(key, [])
+            capacity = self._room_capacity(room)
+            if not isinstance(messages, MessageRing):
+                holder[key] = MessageRing(capacity, messages)
+                trimmed = trimmed or len(holder[key]) < len(messages)
+            elif messages.capacity != capacity:
+                trimmed = messages.resize(capacity) > 0 or trimmed
+        return trimmed
+    
+    def _rebuild_group_indexes(self):
+        """Turn member lists into sets and rebuild the directory, user -> groups index and message count"""
+        self.user_groups = {}
+        self._message_count = len(self.data['public_messages'])
+        for name, group in self.data['groups'].items():
+            group['members'] = set(group.get('members', []))
+            for username in group['members']:
+                self.user_groups.setdefault(username, set()).add(name)
+            self._message_count += len(group.get('messages', []))
+        self.group_directory.rebuild(self.data['groups'], self.lsn)
+    
+    def _load_sessions(self):
+        """Index the loaded sessions, or drop them when sessions are not persisted"""
+        if self.persist_sessions:
+            # The store shares the dict that gets serialized with the dataset
+            self.sessions = SessionStore(self.data['user_sessions'])
+        else:
+            self.data['user_sessions'] = {}
+            self.sessions = SessionStore()
+    
+    def _stamp_metadata(self):
+        """Update metadata before anything is written"""
+        self.data['metadata']['last_updated'] = datetime.now().isoformat()
+        self.data['metadata']['lsn'] = self.lsn
+        self.data['metadata']['max_room_messages'] = self.max_room_messages
+        self.data['metadata']['version'] = STORAGE_FORMAT_VERSION
     
     def save(self):
-        """Encrypt and save data to file"""
+        """Write the complete dataset through the storage backend (a checkpoint)"""
+        with self._io_lock:
+            return self._checkpoint()
+    
+    def _checkpoint(self):
+        """Checkpoint a snapshot of the dataset; the caller holds _io_lock"""
+        with self._lock:
+            # The checkpoint covers every applied record, pending or not
+            ops, self._pending = self._pending, []
+            self._stamp_metadata()
+            data = self._snapshot_data()
+        saved = False
         try:
-            # Update metadata
-            self.data['metadata']['last_updated'] = datetime.now().isoformat()
-            
-            # Convert data to JSON and encrypt
-            json_data = json.dumps(self.data, indent=2, default=str)
-            encrypted_data = self.fernet.encrypt(json_data.encode())
-            
-            # Write to file
-            with open(self.db_file, 'wb') as file:
-                file.write(encrypted_data)
-            
-            return True
-        except Exception as e:
-            print(f"Error saving database: {e}")
-            return False
+            saved = self._backend_write('save', self.backend.checkpoint, data)
+            return saved
+        finally:
+            if not saved:
+                self._requeue(ops)
+    
+    # Mutation records
+    def _room_lock(self, room):
+        """Lock guarding one room's history"""
+        lock = self._room_locks.get(room)
+        if lock is None:
+            lock = self._room_locks.setdefault(room, threading.Lock())
+        return lock
+    
+    @contextmanager
+    def _op_locks(self, op):
+        """Hold the metadata and room locks a record needs while it is applied"""
+        if op['op'] in SESSION_OPS:
+            # The session table has its own lock
+            yield
+            return
+        
+        meta_lock = self._meta_lock.write_lock if op['op'] in STRUCTURAL_OPS else self._meta_lock.read_lock
+        with meta_lock():
+            if 'room' in op:
+                with self._room_lock(op['room']):
+                    yield
+            else:
+                yield
+    
+    def _execute(self, op):
+        """Apply a mutation to memory and make it durable"""
+        with self._op_locks(op):
+            self._sequence(op)
+        self._commit_sequenced()
+    
+    def _sequence(self, op):
+        """Number, apply and queue a record; the caller holds its _op_locks"""
+        with self._lock:
+            self.lsn += 1
+            op['lsn'] = self.lsn
+            self._apply_op(op)
+            self._journal_op(op)
+            self._pending.append(op)
+        
+    def _commit_sequenced(self):
+        """Make queued records durable now, or leave them to the write-behind flusher"""
+        if not self.write_behind:
+            self.flush()
+        elif len(self._pending) >= self.flush_max_ops:
+            self._flush_requested.set()
+    
+    def _apply_op(self, op):
+        """Apply a single mutation record to the in-memory data"""
+        getattr(self, f"_op_{op['op']}")(op)
+    
+    # Write-behind flushing
+    def _flush_loop(self):
+        """Background thread that group-commits pending records"""
+        while not self._closed:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing database: {e}")
+    
+    def flush(self):
+        """Commit all pending records now
+        
+        Records are taken with a snapshot of what the backend reads, then
+        encrypted and written outside _lock, so reads and new writes carry
+        on during disk I/O. Concurrent callers queue on _io_lock and the
+        first one commits everything queued so far.
+        """
+        with self._io_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                ops, self._pending = self._pending, []
+                self._stamp_metadata()
+                scope = self.backend.snapshot_scope(ops)
+                data = None if scope is False else self._snapshot_data(scope)
+            committed = False
+            try:
+                committed = self._backend_write('commit', self.backend.commit, ops, data)
+                return committed
+            finally:
+                if not committed:
+                    self._requeue(ops)
+    
+    def _requeue(self, ops):
+        """Put records whose write failed back at the front of the queue, to retry on the next flush"""
+        with self._lock:
+            self._pending[:0] = ops
+    
+    def pending_writes(self):
+        """Number of applied records not yet committed to disk"""
+        return len(self._pending)
+    
+    def close(self):
+        """Stop the flusher thread, commit everything still pending and release the backend"""
+        if self._closed:
+            return
+        self._closed = True
+        self._flush_requested.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        with self._io_lock:
+            self.backend.close()
+        if self._crypto_pool is not None:
+            self._crypto_pool.shutdown()
+            self._crypto_pool = None
+    
+    # Mutation handlers (shared by live writes and log replay)
+    def _op_put_user(self, op):
+        # Records keep their own payloads; commits serialize them outside the lock
+        self.data['users'][op['user_id']] = dict(op['user'])
+    
+    def _op_touch_user(self, op):
+        if op['user_id'] in self.data['users']:
+            self.data['users'][op['user_id']]['last_active'] = op['at']
+    
+    def _op_add_message(self, op):
+        message = op['message']
+        messages = self._room_messages(op['room'])
+        if messages is None:
+            return
+        
+        # The ring drops the oldest message once the room is at capacity
+        if messages.append(message) is not None:
+            op['evicted'] = 1
+        else:
+            self._message_count += 1
+        if op['room'] != 'public':
+            self.group_directory.update(op['room'], message_count=len(messages))
+        
+        # Update user message count
+        if message.get('user_id') in self.data['users']:
+            self.data['users'][message['user_id']]['message_count'] += 1
+    
+    def _op_migrate_messages(self, op):
+        messages = self._room_messages(op['room'])
+        if messages is None:
+            return
+        positions = None
+        applied = []
+        for index, record in op['messages']:
+            # Retention may have shifted the ring since the batch was read
+            if not (index < len(messages) and messages[index].get('id') == record.get('id')):
+                if positions is None:
+                    positions = {m.get('id'): i for i, m in enumerate(messages) if m.get('v') != MESSAGE_SCHEMA_VERSION}
+                index = positions.get(record.get('id'))
+                if index is None or record.get('id') is None:
+                    continue
+            if messages[index].get('v') != MESSAGE_SCHEMA_VERSION:
+                messages[index] = record
+                applied.append([index, record])
+        # Backends locate rows by these resolved positions; v1 rows may have no id
+        op['messages'] = applied
+    
+    def _op_put_group(self, op):
+        group = dict(op['group'])
+        group['messages'] = MessageRing(self._room_capacity(op['group_name']), group.get('messages', []))
+        group['members'] = set(group.get('members', []))
+        replaced = self.data['groups'].get(op['group_name'])
+        self._message_count += len(group['messages']) - (len(replaced.get('messages', [])) if replaced else 0)
+        self.data['groups'][op['group_name']] = group
+        for username in group['members']:
+            self.user_groups.setdefault(username, set()).add(op['group_name'])
+        self.group_directory.add(op['group_name'], group, op['lsn'])
+    
+    def _op_set_capacity(self, op):
+        self.data['metadata'].setdefault('room_capacities', {})[op['room']] = op['capacity']
+        messages = self._room_messages(op['room'])
+        if messages is not None:
+            op['evicted'] = messages.resize(op['capacity'])
+            self._message_count -= op['evicted']
+            if op['room'] != 'public':
+                self.group_directory.update(op['room'], message_count=len(messages))
+    
+    def _op_add_member(self, op):
+        group = self.data['groups'].get(op['group_name'])
+        if group and op['username'] not in group['members']:
+            group['members'].add(op['username'])
+            self.user_groups.setdefault(op['username'], set()).add(op['group_name'])
+            self.group_directory.update(op['group_name'], member_count=len(group['members']))
+    
+    def _op_remove_member(self, op):
+        group = self.data['groups'].get(op['group_name'])
+        if group and op['username'] in group['members']:
+            group['members'].discard(op['username'])
+            joined = self.user_groups.get(op['username'])
+            if joined is not None:
+                joined.discard(op['group_name'])
+                if not joined:
+                    del self.user_groups[op['username']]
+            self.group_directory.update(op['group_name'], member_count=len(group['members']))
+    
+    def _op_put_session(self, op):
+        self.sessions.put(op['session_id'], dict(op['session']))
+    
+    def _op_update_session(self, op):
+        self.sessions.update(op['session_id'], op['data'], op['at'])
+    
+    def _op_remove_sessions(self, op):
+        for session_id in op['session_ids']:
+            self.sessions.remove(session_id)
     
     # User Management
     def add_user(self, user_id, username, public_key="", metadata=None):
@@ -95,15 +1954,17 @@ class EncryptedDatabase:
             'metadata': metadata or {}
         }
         
-        self.data['users'][user_id] = user_data
-        self.save()
+        self._execute({'op': 'put_user', 'user_id': user_id, 'user': user_data})
         return user_data
     
     def update_user_activity(self, user_id):
         """Update user's last activity time"""
         if user_id in self.data['users']:
-            self.data['users'][user_id]['last_active'] = datetime.now().isoformat()
-            self.save()
+            self._execute({
+                'op': 'touch_user',
+                'user_id': user_id,
+                'at': datetime.now().isoformat()
+            })
     
     def get_user(self, user_id):
         """Get user data by ID"""
@@ -111,33 +1972,21 @@ class EncryptedDatabase:
     
     def get_all_users(self):
         """Get all users"""
-        return self.data['users']
+        with self._meta_lock.read_lock():
+            return dict(self.data['users'])
     
     # Message Management
     def add_public_message(self, message_data):
         """Add a message to public chat"""
         # Encrypt message content
-        encrypted_message = self._encrypt_message_content(message_data)
-        encrypted_message['room'] = 'public'
-        encrypted_message['stored_at'] = datetime.now().isoformat()
-        
-        self.data['public_messages'].append(encrypted_message)
-        
-        # Keep only last 1000 messages
-        if len(self.data['public_messages']) > 1000:
-            self.data['public_messages'] = self.data['public_messages'][-1000:]
-        
-        # Update user message count
-        if 'user_id' in message_data and message_data['user_id'] in self.data['users']:
-            self.data['users'][message_data['user_id']]['message_count'] += 1
+        encrypted_message = self._encrypt_message_content({**message_data, 'room': 'public'})
         
-        self.save()
+        self._store_message('public', encrypted_message, message_data)
         return encrypted_message
     
     def get_public_messages(self, limit=50):
         """Get recent public messages"""
-        messages = self.data['public_messages'][-limit:]
-        return [self._decrypt_message_content(msg) for msg in messages]
+        return self.get_messages_page('public', limit=limit)['messages']
     
     def add_group_message(self, group_name, message_data):
         """Add a message to a group"""
@@ -145,24 +1994,9 @@ class EncryptedDatabase:
             return None
         
         # Encrypt message content
-        encrypted_message = self._encrypt_message_content(message_data)
-        encrypted_message['room'] = group_name
-        encrypted_message['stored_at'] = datetime.now().isoformat()
-        
-        if 'messages' not in self.data['groups'][group_name]:
-            self.data['groups'][group_name]['messages'] = []
-        
-        self.data['groups'][group_name]['messages'].append(encrypted_message)
-        
-        # Keep only last 1000 messages per group
-        if len(self.data['groups'][group_name]['messages']) > 1000:
-            self.data['groups'][group_name]['messages'] = self.data['groups'][group_name]['messages'][-1000:]
+        encrypted_message = self._encrypt_message_content({**message_data, 'room': group_name})
         
-        # Update user message count
-        if 'user_id' in message_data and message_data['user_id'] in self.data['users']:
-            self.data['users'][message_data['user_id']]['message_count'] += 1
-        
-        self.save()
+        self._store_message(group_name, encrypted_message, message_data)
         return encrypted_message
     
     def get_group_messages(self, group_name, limit=50):
@@ -170,49 +2004,189 @@ class EncryptedDatabase:
         if group_name not in self.data['groups']:
             return []
         
-        messages = self.data['groups'][group_name].get('messages', [])[-limit:]
-        return [self._decrypt_message_content(msg) for msg in messages]
+        return self.get_messages_page(group_name, limit=limit)['messages']
     
-    def _encrypt_message_content(self, message_data):
-        """Encrypt sensitive message content"""
-        encrypted_data = message_data.copy()
-        
-        # Encrypt the actual message content
-        if 'message' in encrypted_data:
-            encrypted_data['encrypted_message'] = self.fernet.encrypt(
-                encrypted_data['message'].encode()
-            ).decode()
-            # Keep original for backward compatibility, but in production remove this
+    def _store_message(self, room, encrypted_message, message_data):
+        """Record a new message and extend the room's cached decrypted tail"""
+        # The plaintext is at hand, so the cache never pays for a decrypt
+        content = {
+            field: value for field, value in message_data.items()
+            if field not in MESSAGE_METADATA_FIELDS and field != 'timestamp'
+        }
+        if _timestamp_ms(message_data.get('timestamp')) is None and 'timestamp' in message_data:
+            content['timestamp'] = message_data['timestamp']
+        decrypted_message = _message_view(encrypted_message, content)
             
-        if 'encrypted_content' in encrypted_data and encrypted_data['encrypted_content']:
-            encrypted_data['double_encrypted_content'] = self.fernet.encrypt(
-                encrypted_data['encrypted_content'].encode()
-            ).decode()
+        op = {'op': 'add_message', 'room': room, 'message': encrypted_message}
+        with self._op_locks(op):
+            self._sequence(op)
+            self.message_cache.append(room, decrypted_message, self._room_messages(room).capacity)
+        self._commit_sequenced()
+    
+    def _room_messages(self, room):
+        """Stored history ring of 'public' or a group, or None if the room does not exist"""
+        if room == 'public':
+            return self.data['public_messages']
+        group = self.data['groups'].get(room)
+        if group is None:
+            return None
+        return group['messages']
+    
+    def set_room_capacity(self, room, capacity):
+        """Change how many messages a room retains (persisted, drops the oldest on shrink)"""
+        op = {'op': 'set_capacity', 'room': room, 'capacity': int(capacity)}
+        with self._op_locks(op):
+            if self._room_messages(room) is None:
+                return False
+            self._sequence(op)
+            self.message_cache.invalidate(room)
+        self._commit_sequenced()
+        return True
+    
+    def get_messages_page(self, room, before_message_id=None, before_timestamp=None, limit=50):
+        """Get one page of history older than a cursor, decrypting only that page"""
+        with self._meta_lock.read_lock():
+            with self._room_lock(room):
+                start, page, records, newest = self._locate_page(room, before_message_id, before_timestamp, limit)
+        
+        if page is None:
+            # Decrypt without holding any lock
+            page = self.decrypt_messages(records)
+            with self._meta_lock.read_lock():
+                with self._room_lock(room):
+                    # Only cache if no message arrived while we were decrypting
+                    messages = self._room_messages(room)
+                    if messages and messages[-1] is newest:
+                        self.message_cache.store(room, start, page, len(messages))
+        
+        return {'room': room, 'messages': page, 'has_more': start > 0}
+    
+    def _locate_page(self, room, before_message_id, before_timestamp, limit):
+        """(start, cached page or None, records to decrypt, newest record) of a page; needs the room lock"""
+        messages = self._room_messages(room)
+        if not messages:
+            return 0, [], [], None
+        
+        end = len(messages)
+        if before_message_id is not None:
+            # Cursors almost always point near the tail, so scan backwards
+            for index in range(len(messages) - 1, -1, -1):
+                if messages[index].get('id') == before_message_id:
+                    end = index
+                    break
+            else:
+                # The cursor message has been evicted by retention
+                end = 0 if before_timestamp is None else end
+        cutoff = _timestamp_ms(before_timestamp)
+        if cutoff is not None and end == len(messages):
+            # Messages are appended in time order, so bisect their timestamps
+            low, high = 0, len(messages)
+            while low < high:
+                middle = (low + high) // 2
+                if message_time_ms(messages[middle]) < cutoff:
+                    low = middle + 1
+                else:
+                    high = middle
+            end = low
+        
+        start = max(0, end - limit)
+        total = len(messages)
+        page = self.message_cache.get(room, start, end, total)
+        return start, page, (messages[start:end] if page is None else []), messages[-1]
+    
+    # Message schema migration
+    def migrate_messages(self, batch_size=500, pause=0.01):
+        """Rewrite stored v1 messages as v2 records in bounded batches, returning how many changed
         
-        return encrypted_data
+        Each batch is read and swapped in under the room's lock but encrypted
+        outside it, so the app keeps serving while history is migrated.
+        """
+        migrated = 0
+        while not self._closed:
+            with self._meta_lock.read_lock():
+                rooms = ['public'] + list(self.data['groups'])
+            found = 0
+            for room in rooms:
+                position = 0
+                while not self._closed:
+                    with self._meta_lock.read_lock():
+                        with self._room_lock(room):
+                            messages = self._room_messages(room)
+                            batch = []
+                            while messages is not None and position < len(messages) and len(batch) < batch_size:
+                                if messages[position].get('v') != MESSAGE_SCHEMA_VERSION:
+                                    batch.append((position, messages[position]))
+                                position += 1
+                    if not batch:
+                        break
+                    
+                    # Through the batch API, so large histories use the crypto pool
+                    records = self.encrypt_messages(self.decrypt_messages(record for _, record in batch))
+                    converted = [[index, record] for (index, _), record in zip(batch, records)]
+                    op = {'op': 'migrate_messages', 'room': room, 'messages': converted}
+                    with self._op_locks(op):
+                        self._sequence(op)
+                        self.message_cache.invalidate(room)
+                    self._commit_sequenced()
+                    found += len(batch)
+                    time.sleep(pause)
+            if not found:
+                break
+            migrated += found
+        return migrated
+    
+    def _encrypt_message_content(self, message_data):
+        """Encrypt sensitive message content"""
+        return self._crypto('encrypt', 'message', encrypt_message_fields, self.cipher, message_data)
     
     def _decrypt_message_content(self, encrypted_data):
         """Decrypt message content"""
-        decrypted_data = encrypted_data.copy()
+        return self._crypto('decrypt', 'message', decrypt_message_fields, self.cipher, encrypted_data)
         
-        # Decrypt the message content
-        if 'encrypted_message' in encrypted_data:
-            try:
-                decrypted_data['message'] = self.fernet.decrypt(
-                    encrypted_data['encrypted_message'].encode()
-                ).decode()
-            except Exception as e:
-                print(f"Error decrypting message: {e}")
+    # Batch encryption
+    def _crypto_executor(self):
+        """Lazily started pool for batch encryption and decryption"""
+        if self._crypto_pool is None:
+            if self.crypto_pool_kind == 'process':
+                self._crypto_pool = ProcessPoolExecutor(
+                    max_workers=self.crypto_workers,
+                    initializer=_init_crypto_worker,
+                    initargs=(self.key, self.cipher.name)
+                )
+            else:
+                self._crypto_pool = ThreadPoolExecutor(
+                    max_workers=self.crypto_workers,
+                    thread_name_prefix='crypto'
+                )
+        return self._crypto_pool
         
-        if 'double_encrypted_content' in encrypted_data:
-            try:
-                decrypted_data['encrypted_content'] = self.fernet.decrypt(
-                    encrypted_data['double_encrypted_content'].encode()
-                ).decode()
-            except Exception as e:
-                print(f"Error decrypting content: {e}")
+    def _map_messages(self, function, messages):
+        """Run a per-message crypto function over a batch, preserving order"""
+        messages = list(messages)
+        if len(messages) < self.parallel_threshold or self.crypto_workers <= 1:
+            return [function(self.cipher, message) for message in messages]
         
-        return decrypted_data
+        # One chunk per worker keeps task overhead flat however large the batch
+        chunk_size = -(-len(messages) // self.crypto_workers)
+        chunks = [messages[i:i + chunk_size] for i in range(0, len(messages), chunk_size)]
+        executor = self._crypto_executor()
+        if self.crypto_pool_kind == 'process':
+            results = executor.map(_crypt_chunk_in_worker, [function] * len(chunks), chunks)
+        else:
+            results = executor.map(lambda chunk: [function(self.cipher, m) for m in chunk], chunks)
+        return [message for chunk in results for message in chunk]
+    
+    def encrypt_messages(self, messages):
+        """Encrypt a batch of messages, in parallel above parallel_threshold"""
+        messages = list(messages)
+        return self._crypto('encrypt', 'message', self._map_messages, encrypt_message_fields, messages,
+                            count=len(messages))
+    
+    def decrypt_messages(self, messages):
+        """Decrypt a batch of stored messages, in parallel above parallel_threshold"""
+        messages = list(messages)
+        return self._crypto('decrypt', 'message', self._map_messages, decrypt_message_fields, messages,
+                            count=len(messages))
     
     # Group Management
     def create_group(self, group_name, creator_username, password="", metadata=None):
@@ -223,7 +2197,9 @@ class EncryptedDatabase:
         # Encrypt group password
         encrypted_password = ""
         if password:
-            encrypted_password = self.fernet.encrypt(password.encode()).decode()
+            encrypted_password = self._crypto(
+                'encrypt', 'group_password', self.cipher.encrypt, password.encode()
+            ).decode()
         
         group_data = {
             'id': hashlib.sha256(group_name.encode()).hexdigest()[:16],
@@ -236,8 +2212,13 @@ class EncryptedDatabase:
             'metadata': metadata or {}
         }
         
-        self.data['groups'][group_name] = group_data
-        self.save()
+        op = {'op': 'put_group', 'group_name': group_name, 'group': group_data}
+        with self._op_locks(op):
+            # Another handler may have created it since the check above
+            if group_name in self.data['groups']:
+                return None
+            self._sequence(op)
+        self._commit_sequenced()
         return group_data
     
     def join_group(self, group_name, username, password=""):
@@ -250,8 +2231,8 @@ class EncryptedDatabase:
         # Check password if required
         if group['encrypted_password']:
             try:
-                stored_password = self.fernet.decrypt(
-                    group['encrypted_password'].encode()
+                stored_password = self._crypto(
+                    'decrypt', 'group_password', self.cipher.decrypt, group['encrypted_password'].encode()
                 ).decode()
                 if password != stored_password:
                     return False
@@ -261,8 +2242,7 @@ class EncryptedDatabase:
         
         # Add user to group if not already a member
         if username not in group['members']:
-            group['members'].append(username)
-            self.save()
+            self._execute({'op': 'add_member', 'group_name': group_name, 'username': username})
         
         return True
     
@@ -273,133 +2253,323 @@ class EncryptedDatabase:
         
         group = self.data['groups'][group_name]
         if username in group['members']:
-            group['members'].remove(username)
-            self.save()
+            self._execute({'op': 'remove_member', 'group_name': group_name, 'username': username})
             return True
         
         return False
     
     def get_group(self, group_name):
         """Get group data"""
-        group = self.data['groups'].get(group_name)
-        if group:
-            # Decrypt password for internal use (don't expose in API)
+        with self._meta_lock.read_lock():
+            group = self.data['groups'].get(group_name)
+            if not group:
+                return None
             decrypted_group = group.copy()
-            if group['encrypted_password']:
-                try:
-                    decrypted_group['password'] = self.fernet.decrypt(
-                        group['encrypted_password'].encode()
-                    ).decode()
-                except:
-                    decrypted_group['password'] = ""
-            else:
+            decrypted_group['members'] = sorted(group['members'])
+        
+        # Decrypt password for internal use (don't expose in API)
+        if group['encrypted_password']:
+            try:
+                decrypted_group['password'] = self._crypto(
+                    'decrypt', 'group_password', self.cipher.decrypt, group['encrypted_password'].encode()
+                ).decode()
+            except:
                 decrypted_group['password'] = ""
-            return decrypted_group
-        return None
+        else:
+            decrypted_group['password'] = ""
+        return decrypted_group
+    
+    def has_group(self, group_name):
+        """Whether a group exists, without copying or decrypting it"""
+        return group_name in self.data['groups']
+    
+    def get_user_groups(self, username):
+        """Names of the groups a user belongs to"""
+        with self._meta_lock.read_lock():
+            return sorted(self.user_groups.get(username, ()))
     
     def get_all_groups(self):
         """Get all groups (without passwords)"""
-        groups = {}
-        for name, group in self.data['groups'].items():
-            groups[name] = {
-                'id': group['id'],
-                'name': group['name'],
-                'creator': group['creator'],
-                'created_at': group['created_at'],
-                'member_count': len(group['members']),
-                'message_count': len(group.get('messages', [])),
-                'has_password': bool(group['encrypted_password'])
+        with self._meta_lock.read_lock():
+            return {name: dict(summary) for name, summary in self.group_directory.summaries.items()}
+    
+    def get_groups_page(self, offset=0, limit=50):
+        """Summaries of up to limit groups from offset, in creation order, with the total"""
+        offset = max(offset, 0)
+        with self._meta_lock.read_lock():
+            summaries = self.group_directory.summaries
+            page = itertools.islice(summaries.items(), offset, offset + max(limit, 0))
+            return {
+                'total': len(summaries),
+                'offset': offset,
+                'groups': {name: dict(summary) for name, summary in page}
+            }
+    
+    def get_group_list(self):
+        """Names of all groups with the directory version they reflect"""
+        with self._meta_lock.read_lock():
+            return {
+                'version': self.group_directory.version,
+                'available_groups': list(self.group_directory.summaries)
             }
-        return groups
+    
+    def get_group_list_version(self):
+        """Current version of the group directory"""
+        return self.group_directory.version
+    
+    def get_group_list_changes(self, since_version):
+        """Groups added and removed after since_version, or None if a full list is needed"""
+        with self._meta_lock.read_lock():
+            return self.group_directory.changes_since(since_version)
     
     # Session Management
+    def _session_op(self, op):
+        """Log a session change when sessions are persisted, else just apply it"""
+        if self.persist_sessions:
+            self._execute(op)
+        else:
+            self._apply_op(op)
+    
     def add_session(self, session_id, user_data):
         """Add user session"""
-        self.data['user_sessions'][session_id] = {
-            **user_data,
-            'session_start': datetime.now().isoformat(),
-            'last_activity': datetime.now().isoformat()
-        }
-        self.save()
+        self._session_op({
+            'op': 'put_session',
+            'session_id': session_id,
+            'session': {
+                **user_data,
+                'session_start': datetime.now().isoformat(),
+                'last_activity': datetime.now().isoformat()
+            }
+        })
     
     def update_session(self, session_id, data):
         """Update session data"""
-        if session_id in self.data['user_sessions']:
-            self.data['user_sessions'][session_id].update(data)
-            self.data['user_sessions'][session_id]['last_activity'] = datetime.now().isoformat()
-            self.save()
+        if session_id in self.sessions:
+            self._session_op({
+                'op': 'update_session',
+                'session_id': session_id,
+                'data': data,
+                'at': datetime.now().isoformat()
+            })
+    
+    def touch_session(self, session_id):
+        """Mark a session as active now"""
+        self.update_session(session_id, {})
     
     def remove_session(self, session_id):
         """Remove user session"""
-        if session_id in self.data['user_sessions']:
-            del self.data['user_sessions'][session_id]
-            self.save()
+        if session_id in self.sessions:
+            self._session_op({'op': 'remove_sessions', 'session_ids': [session_id]})
     
     def get_session(self, session_id):
         """Get session data"""
-        return self.data['user_sessions'].get(session_id)
+        return self.sessions.get(session_id)
     
     def get_all_sessions(self):
         """Get all active sessions"""
-        return self.data['user_sessions']
+        return self.sessions.sessions
     
     # Analytics and Statistics
     def get_stats(self):
-        """Get database statistics"""
-        total_messages = len(self.data['public_messages'])
-        for group in self.data['groups'].values():
-            total_messages += len(group.get('messages', []))
-        
+        """Get database statistics from maintained counters, in constant time"""
         return {
             'total_users': len(self.data['users']),
             'total_groups': len(self.data['groups']),
-            'total_messages': total_messages,
+            'total_messages': self._message_count,
             'public_messages': len(self.data['public_messages']),
-            'active_sessions': len(self.data['user_sessions']),
-            'database_size': os.path.getsize(self.db_file) if os.path.exists(self.db_file) else 0,
+            'active_sessions': len(self.sessions),
+            # As of the last commit or save
+            'database_size': self._disk_bytes,
             'created_at': self.data['metadata']['created_at'],
             'last_updated': self.data['metadata']['last_updated']
         }
     
     # Backup and Recovery
-    def create_backup(self, backup_file=None):
+    def _journal_op(self, op):
+        """Keep a serialized copy of an applied record for the next incremental backup"""
+        if self._journal is None:
+            return
+        if len(self._journal) >= BACKUP_JOURNAL_MAX_OPS:
+            # Too far behind; the next backup has to be a full one
+            self._journal = None
+            self._last_backup = None
+            return
+        self._journal.append((op['lsn'], json.dumps(op, separators=(',', ':'), default=_json_default)))
+    
+    def _snapshot_data(self, rooms=None):
+        """Point-in-time copy of the dataset that later mutations cannot reach
+        
+        Message records are replaced, never changed in place, so histories
+        are copied as lists of references; only the mutable containers
+        around them are copied. With rooms given, only those histories are
+        included; the others are left out rather than copied empty.
+        """
+        with self._lock:
+            metadata = dict(self.data['metadata'])
+            if 'room_capacities' in metadata:
+                metadata['room_capacities'] = dict(metadata['room_capacities'])
+            snapshot = {
+                'users': {user_id: dict(user) for user_id, user in self.data['users'].items()},
+                'groups': {},
+                'user_sessions': self.sessions.snapshot() if self.persist_sessions else {},
+                'metadata': metadata
+            }
+            if rooms is None or 'public' in rooms:
+                snapshot['public_messages'] = self.data['public_messages'].to_list()
+            for name, group in self.data['groups'].items():
+                copy = {key: value for key, value in group.items() if key != 'messages'}
+                copy['members'] = set(group['members'])
+                if rooms is None or name in rooms:
+                    copy['messages'] = group['messages'].to_list()
+                snapshot['groups'][name] = copy
+            return snapshot
+    
+    def start_backup(self, backup_file=None, incremental=False, progress=None):
+        """Snapshot the database now and write the backup from a background thread
+        
+        Returns the job status dict (also kept in backup_jobs under its id).
+        An incremental backup holds only the records applied since the last
+        successful backup; without one it falls back to a full backup.
+        progress, if given, is called with the job status as it advances.
+        """
+        job, payload, total = self._prepare_backup(backup_file, incremental)
+        threading.Thread(target=self._write_backup, args=(job, payload, total, progress), daemon=True).start()
+        return job
+    
+    def create_backup(self, backup_file=None, incremental=False):
         """Create encrypted backup of database"""
+        job, payload, total = self._prepare_backup(backup_file, incremental)
+        self._write_backup(job, payload, total)
+        return job['backup_file'] if job['status'] == 'done' else None
+    
+    def get_backup_status(self, backup_id):
+        """Status dict of a backup started in this process, or None"""
+        job = self.backup_jobs.get(backup_id)
+        return dict(job) if job else None
+    
+    def _prepare_backup(self, backup_file, incremental):
+        """Take the snapshot (or journal slice) a backup will write"""
+        backup_id = uuid.uuid4().hex
         if not backup_file:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_file = f"backup_encrypted_chat_{timestamp}.db"
+            backup_file = f"backup_encrypted_chat_{timestamp}_{backup_id[:8]}.db"
+        
+        with self._lock:
+            base = self._last_backup if incremental and self._journal is not None else None
+            manifest = {
+                'id': backup_id,
+                'kind': 'incremental' if base else 'full',
+                'base_id': base['id'] if base else None,
+                'base_lsn': base['lsn'] if base else None,
+                'lsn': self.lsn,
+                'created_at': datetime.now().isoformat(),
+                'original_file': self.db_file
+            }
+            if base:
+                ops = [entry for lsn, entry in self._journal if lsn > base['lsn']]
+                payload = {'metadata': {'backup': manifest}, 'ops': ops}
+                total = len(ops)
+            else:
+                payload = self._snapshot_data()
+                payload['metadata']['backup'] = manifest
+                payload['metadata']['backup_created'] = manifest['created_at']
+                payload['metadata']['original_file'] = self.db_file
+                total = sum(len(payload[section]) for section in ('users', 'public_messages', 'groups', 'user_sessions'))
+            if self._journal is None:
+                self._journal = []
+        
+        job = {
+            'backup_id': backup_id,
+            'backup_file': backup_file,
+            'kind': manifest['kind'],
+            'base_id': manifest['base_id'],
+            'lsn': manifest['lsn'],
+            'status': 'running',
+            'progress': 0.0,
+            'error': None
+        }
+        self.backup_jobs[backup_id] = job
+        return job, payload, total
+    
+    def _write_backup(self, job, payload, total, progress=None):
+        """Encrypt and write a prepared backup, updating its job status"""
+        written = 0
+        
+        def advance(entries):
+            nonlocal written
+            written += entries
+            fraction = min(written / total, 1.0) if total else 1.0
+            # Report at most once per percent
+            if progress and int(fraction * 100) > int(job['progress'] * 100):
+                job['progress'] = fraction
+                progress(dict(job))
+            job['progress'] = fraction
         
         try:
-            # Create backup with current data
-            backup_data = self.data.copy()
-            backup_data['metadata']['backup_created'] = datetime.now().isoformat()
-            backup_data['metadata']['original_file'] = self.db_file
-            
-            json_data = json.dumps(backup_data, indent=2, default=str)
-            encrypted_data = self.fernet.encrypt(json_data.encode())
-            
-            with open(backup_file, 'wb') as file:
-                file.write(encrypted_data)
-            
-            return backup_file
+            if payload.get('ops') is not None:
+                # Journal entries are stored as the JSON they were captured as
+                payload['ops'] = [json.loads(entry) for entry in payload['ops']]
+            write_encrypted_file(
+                job['backup_file'], self.cipher, payload, self.backend.codec, self.backend.compression, advance
+            )
+            with self._lock:
+                # Later backups are incremental against this one
+                if self._last_backup is None or job['lsn'] > self._last_backup['lsn']:
+                    self._last_backup = {'id': job['backup_id'], 'lsn': job['lsn']}
+                if self._journal is not None:
+                    self._journal = [(lsn, entry) for lsn, entry in self._journal if lsn > self._last_backup['lsn']]
+            job['status'] = 'done'
+            job['progress'] = 1.0
         except Exception as e:
             print(f"Error creating backup: {e}")
-            return None
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        if progress:
+            progress(dict(job))
     
-    def restore_from_backup(self, backup_file):
-        """Restore database from backup"""
+    def restore_from_backup(self, backup_file, incremental_files=()):
+        """Restore database from a full backup plus an optional chain of incremental backups"""
         try:
-            with open(backup_file, 'rb') as file:
-                encrypted_data = file.read()
+            # Backups from before the chunked format are single tokens; both load here
+            backup_data = read_encrypted_file(backup_file, self.cipher)
+            manifest = backup_data['metadata'].pop('backup', None) or {'id': None, 'kind': 'full', 'lsn': 0}
+            if manifest['kind'] != 'full':
+                raise ValueError(f"{backup_file} is an incremental backup, not a full one")
             
-            decrypted_data = self.fernet.decrypt(encrypted_data)
-            backup_data = json.loads(decrypted_data.decode())
+            chain = []
+            previous = manifest
+            for incremental_file in incremental_files:
+                incremental = read_encrypted_file(incremental_file, self.cipher)
+                step = incremental['metadata']['backup']
+                if step['kind'] != 'incremental' or step['base_id'] != previous['id']:
+                    raise ValueError(f"{incremental_file} does not follow backup {previous['id']}")
+                chain.append(incremental['ops'])
+                previous = step
             
-            # Restore data
-            self.data = backup_data
-            self.data['metadata']['restored_at'] = datetime.now().isoformat()
-            self.data['metadata']['restored_from'] = backup_file
+            # Restore data; readers and writers wait until the new dataset is on disk
+            with self._meta_lock.write_lock(), self._io_lock:
+                with self._lock:
+                    self.message_cache.invalidate()
+                    self.data = backup_data
+                    self.data['metadata']['restored_at'] = datetime.now().isoformat()
+                    self.data['metadata']['restored_from'] = backup_file
+                    self._hydrate_rooms()
+                    self._load_sessions()
+                    self._rebuild_group_indexes()
+                    for ops in chain:
+                        for op in ops:
+                            self._apply_op(op)
             
-            self.save()
+                    # Give the restored directory a version no client has seen yet
+                    self.lsn = max(self.lsn, previous.get('lsn', 0)) + 1
+                    self._rebuild_group_indexes()
+                
+                    # The restored state is not what earlier backups describe
+                    self._journal = None
+                    self._last_backup = None
+                
+                # A restore replaces everything, so checkpoint instead of logging it
+                self._checkpoint()
             return True
             
         except Exception as e:
@@ -407,27 +2577,12 @@ class EncryptedDatabase:
             return False
     
     # Cleanup and Maintenance
-    def cleanup_old_sessions(self, hours=24):
-        """Remove sessions older than specified hours"""
-        from datetime import timedelta
-        
-        cutoff_time = datetime.now() - timedelta(hours=hours)
-        sessions_to_remove = []
-        
-        for session_id, session_data in self.data['user_sessions'].items():
-            try:
-                last_activity = datetime.fromisoformat(session_data['last_activity'])
-                if last_activity < cutoff_time:
-                    sessions_to_remove.append(session_id)
-            except Exception as e:
-                print(f"Error parsing session time: {e}")
-                sessions_to_remove.append(session_id)
-        
-        for session_id in sessions_to_remove:
-            del self.data['user_sessions'][session_id]
+    def cleanup_old_sessions(self, hours=24, limit=None):
+        """Remove sessions idle for more than the specified hours, at most limit per call"""
+        sessions_to_remove = self.sessions.expire(time.time() - hours * 3600, limit)
         
-        if sessions_to_remove:
-            self.save()
+        if sessions_to_remove and self.persist_sessions:
+            self._execute({'op': 'remove_sessions', 'session_ids': sessions_to_remove})
         
         return len(sessions_to_remove)
     
@@ -436,17 +2591,145 @@ class EncryptedDatabase:
         return {
             'file_path': os.path.abspath(self.db_file),
             'file_exists': os.path.exists(self.db_file),
-            'file_size_bytes': os.path.getsize(self.db_file) if os.path.exists(self.db_file) else 0,
+            'file_size_bytes': self._disk_bytes,
+            'storage_mode': self.storage_mode,
+            **self.backend.info(),
+            'lsn': self.lsn,
             'encryption_key_length': len(self.key),
+            'cipher': self.cipher.name,
+            'message_cache': self.message_cache.stats(),
             'data_structure': {
                 'users': len(self.data.get('users', {})),
                 'public_messages': len(self.data.get('public_messages', [])),
                 'groups': len(self.data.get('groups', {})),
-                'sessions': len(self.data.get('user_sessions', {}))
+                'sessions': len(self.sessions)
             },
-            'metadata': self.data.get('metadata', {})
+            'metadata': dict(self.data.get('metadata', {}))
         }
 
+class AsyncEncryptedDatabase:
+    """asyncio facade over EncryptedDatabase
+    
+    Calls that encrypt, decrypt, hash or take the database lock run in a
+    thread pool so the event loop keeps serving sockets. Lookups that are
+    plain in-memory dict reads are answered inline.
+    """
+    
+    def __init__(self, *args, executor_workers=4, database=None, **kwargs):
+        self.db = database if database is not None else EncryptedDatabase(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix="db")
+    
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+    
+    # In-memory lookups
+    def get_session(self, session_id):
+        return self.db.get_session(session_id)
+    
+    def has_group(self, group_name):
+        return self.db.has_group(group_name)
+    
+    def get_group_list_version(self):
+        return self.db.get_group_list_version()
+    
+    def pending_writes(self):
+        return self.db.pending_writes()
+    
+    # Users and sessions
+    async def add_user(self, user_id, username, public_key="", metadata=None):
+        return await self._run(self.db.add_user, user_id, username, public_key, metadata)
+    
+    async def get_user(self, user_id):
+        return await self._run(self.db.get_user, user_id)
+    
+    async def get_all_users(self):
+        return await self._run(self.db.get_all_users)
+    
+    async def update_user_activity(self, user_id):
+        return await self._run(self.db.update_user_activity, user_id)
+    
+    async def add_session(self, session_id, user_data):
+        return await self._run(self.db.add_session, session_id, user_data)
+    
+    async def touch_session(self, session_id):
+        return await self._run(self.db.touch_session, session_id)
+    
+    async def remove_session(self, session_id):
+        return await self._run(self.db.remove_session, session_id)
+    
+    async def cleanup_old_sessions(self, hours=24, limit=None):
+        return await self._run(self.db.cleanup_old_sessions, hours, limit)
+    
+    # Messages
+    async def add_public_message(self, message_data):
+        return await self._run(self.db.add_public_message, message_data)
+    
+    async def add_group_message(self, group_name, message_data):
+        return await self._run(self.db.add_group_message, group_name, message_data)
+    
+    async def get_messages_page(self, room, before_message_id=None, before_timestamp=None, limit=50):
+        return await self._run(self.db.get_messages_page, room, before_message_id, before_timestamp, limit)
+    
+    # Groups
+    async def create_group(self, group_name, creator_username, password="", metadata=None):
+        return await self._run(self.db.create_group, group_name, creator_username, password, metadata)
+    
+    async def join_group(self, group_name, username, password=""):
+        return await self._run(self.db.join_group, group_name, username, password)
+    
+    async def leave_group(self, group_name, username):
+        return await self._run(self.db.leave_group, group_name, username)
+    
+    async def get_group(self, group_name):
+        return await self._run(self.db.get_group, group_name)
+    
+    async def get_user_groups(self, username):
+        # Takes the meta read lock, which a restore holds for its whole checkpoint
+        return await self._run(self.db.get_user_groups, username)
+    
+    async def get_all_groups(self):
+        return await self._run(self.db.get_all_groups)
+    
+    async def get_groups_page(self, offset=0, limit=50):
+        return await self._run(self.db.get_groups_page, offset, limit)
+    
+    async def get_group_list(self):
+        return await self._run(self.db.get_group_list)
+    
+    async def get_group_list_changes(self, since_version):
+        return await self._run(self.db.get_group_list_changes, since_version)
+    
+    # Maintenance
+    def get_stats(self):
+        return self.db.get_stats()
+    
+    async def get_database_info(self):
+        return await self._run(self.db.get_database_info)
+    
+    async def migrate_messages(self, batch_size=500, pause=0.01):
+        return await self._run(self.db.migrate_messages, batch_size, pause)
+    
+    async def create_backup(self, backup_file=None, incremental=False):
+        return await self._run(self.db.create_backup, backup_file, incremental)
+    
+    async def start_backup(self, backup_file=None, incremental=False):
+        return await self._run(self.db.start_backup, backup_file, incremental)
+    
+    def get_backup_status(self, backup_id):
+        return self.db.get_backup_status(backup_id)
+    
+    async def restore_from_backup(self, backup_file, incremental_files=()):
+        return await self._run(self.db.restore_from_backup, backup_file, incremental_files)
+    
+    async def flush(self):
+        return await self._run(self.db.flush)
+    
+    async def close(self):
+        """Close the database from the pool, then stop the pool"""
+        await self._run(self.db.close)
+        self.executor.shutdown(wait=True)
+
 # Example usage and testing
 if __name__ == "__main__":
     # Initialize database
@@ -0,0 +1,174 @@
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+
+# In-process metrics served as Prometheus text (exposition format 0.0.4) from
+# /metrics, with no client library or push gateway. Recording a sample is a
+# bisect and a few integer adds under a per-instrument lock; anything costly
+# to compute (room counts, file sizes) is a gauge callback run only when the
+# endpoint is scraped. Pass no registry (CHAT_METRICS=0) and nothing is
+# recorded at all.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bucket upper bounds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CRYPTO_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+SIZE_BUCKETS = tuple(2 ** power for power in range(8, 31, 2))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+class Histogram:
+    """Cumulative-bucket histogram, one series per tuple of label values"""
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value, labels=(), count=1):
+        """Record value (count times, for a batch of equal samples)"""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts (the last is +Inf), then sum and count
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += count
+            series[1] += value * count
+            series[2] += count
+    
+    def time(self, function, labels=()):
+        """Wrap a function or coroutine function to observe its duration in seconds"""
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed_coroutine(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, labels)
+            return timed_coroutine
+        
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - start, labels)
+        return timed
+    
+    def render(self):
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        lines = []
+        for labels, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, labels, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+class Gauge:
+    """Current value, either set directly or read from a callback at scrape time
+    
+    A callback returns a number, or a dict of label value tuples to numbers.
+    """
+    kind = 'gauge'
+    
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+    
+    def set(self, value, labels=()):
+        self._values[labels] = value
+    
+    def render(self):
+        values = dict(self._values)
+        if self.function is not None:
+            try:
+                result = self.function()
+            except Exception as e:
+                print(f"Error reading gauge {self.name}: {e}")
+                result = None
+            if isinstance(result, dict):
+                values.update(result)
+            elif result is not None:
+                values[()] = result
+        return [
+            f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+            for labels, value in sorted(values.items())
+        ]
+
+class Counter(Gauge):
+    """Monotonic total, either incremented directly or read from a callback at scrape time"""
+    kind = 'counter'
+    
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames, function)
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class MetricsRegistry:
+    """Named instruments and their Prometheus text rendering"""
+    
+    def __init__(self):
+        self._instruments = {}
+        self._lock = threading.Lock()
+    
+    def _register(self, instrument):
+        with self._lock:
+            # Registering a name twice hands back the first instrument
+            return self._instruments.setdefault(instrument.name, instrument)
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+    
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+    
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self._register(Counter(name, documentation, labelnames, function))
+    
+    def render(self):
+        """All instruments in the Prometheus text exposition format"""
+        with self._lock:
+            instruments = list(self._instruments.values())
+        lines = []
+        for instrument in instruments:
+            lines.append(f'# HELP {instrument.name} {instrument.documentation}')
+            lines.append(f'# TYPE {instrument.name} {instrument.kind}')
+            lines.extend(instrument.render())
+        return '\n'.join(lines) + '\n'
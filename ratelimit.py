@@ -0,0 +1,130 @@
+import threading
+import time
+
+# Per-connection token buckets for the events that write to the database.
+# Each action (sending, creating groups, joining) has its own budget of a
+# refill rate and a burst, charged to every key of the caller: its sid and,
+# once joined, its username. user_id is minted afresh on every join_chat, so
+# it cannot carry a budget across connections; the username bucket is shared
+# by every tab using that name and outlives a disconnect, so reconnecting
+# under the same name does not buy a fresh burst. Usernames are not
+# authenticated, so a client that picks a new name each time is only held to
+# its per-connection budget. Buckets that have refilled to their burst are
+# dropped, as a missing bucket starts full anyway. On top of that, writes are
+# refused outright while the database has more than max_pending_writes
+# records waiting for the flusher, so a backed-up disk sheds load instead of
+# queueing it in memory.
+
+class RateLimiter:
+    """Token buckets keyed by (key, action), plus a pending-writes high-water mark
+    
+    budgets maps an action to (tokens per second, burst); actions without a
+    budget are never rate limited. pending_writes is a callable returning
+    the database's queue length, checked when max_pending_writes is above 0.
+    """
+    
+    def __init__(self, budgets, pending_writes=None, max_pending_writes=0, backpressure_retry=1.0, metrics=None,
+                 prune_interval=60.0):
+        self.budgets = {action: budget for action, budget in budgets.items() if budget}
+        self.pending_writes = pending_writes
+        self.max_pending_writes = max_pending_writes
+        self.backpressure_retry = backpressure_retry
+        self.prune_interval = prune_interval
+        # key -> {action: [tokens, last refill]}
+        self._buckets = {}
+        self._last_prune = time.monotonic()
+        self._allowed = {}
+        self._limited = {}
+        self._lock = threading.Lock()
+        if metrics is not None:
+            metrics.counter('chat_rate_allowed_total', 'Events let through by the rate limiter', ('action',),
+                            function=lambda: {(action,): count for action, count in self._copy(self._allowed).items()})
+            metrics.counter('chat_rate_limited_total', 'Events refused by the rate limiter', ('action', 'reason'),
+                            function=lambda: self._copy(self._limited))
+            metrics.gauge('chat_rate_limiter_keys', 'Connections and users with a token bucket',
+                          function=lambda: len(self._buckets))
+    
+    def check(self, action, keys):
+        """None when the action may go ahead (and is charged), else (reason, seconds to wait)"""
+        if self.max_pending_writes > 0 and self.pending_writes is not None:
+            try:
+                backed_up = self.pending_writes() > self.max_pending_writes
+            except Exception as e:
+                print(f"Error reading pending writes: {e}")
+                backed_up = False
+            if backed_up:
+                return self._refuse(action, 'backpressure', self.backpressure_retry)
+        
+        budget = self.budgets.get(action)
+        if budget is None:
+            with self._lock:
+                self._allowed[action] = self._allowed.get(action, 0) + 1
+            return None
+        
+        rate, burst = budget
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_prune >= self.prune_interval:
+                self._prune(now)
+            buckets = []
+            wait = 0.0
+            for key in keys:
+                bucket = self._buckets.setdefault(key, {}).setdefault(action, [burst, now])
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                if bucket[0] < 1:
+                    wait = max(wait, (1 - bucket[0]) / rate)
+                buckets.append(bucket)
+            # Every key must have a token; none is charged otherwise
+            if wait == 0.0:
+                for bucket in buckets:
+                    bucket[0] -= 1
+                self._allowed[action] = self._allowed.get(action, 0) + 1
+                return None
+        return self._refuse(action, 'rate', wait)
+    
+    def _refuse(self, action, reason, retry_after):
+        with self._lock:
+            self._limited[(action, reason)] = self._limited.get((action, reason), 0) + 1
+        return reason, round(retry_after, 3)
+    
+    def _copy(self, counts):
+        with self._lock:
+            return dict(counts)
+    
+    def _prune(self, now):
+        # Needs the lock; a key goes once every one of its buckets is full again
+        self._last_prune = now
+        for key, actions in list(self._buckets.items()):
+            if all(bucket[0] + (now - bucket[1]) * self.budgets[action][0] >= self.budgets[action][1]
+                   for action, bucket in actions.items()):
+                del self._buckets[key]
+    
+    def forget(self, *keys):
+        """Drop the buckets of a disconnected sid"""
+        with self._lock:
+            for key in keys:
+                self._buckets.pop(key, None)
+    
+    def get_stats(self):
+        """Budgets and allowed/limited counts per action"""
+        with self._lock:
+            limited = {}
+            for (action, reason), count in self._limited.items():
+                limited.setdefault(action, {})[reason] = count
+            return {
+                'budgets': {action: {'per_second': rate, 'burst': burst} for action, (rate, burst) in self.budgets.items()},
+                'max_pending_writes': self.max_pending_writes,
+                'allowed': dict(self._allowed),
+                'limited': limited,
+                'tracked_keys': len(self._buckets)
+            }
+
+def parse_budget(setting, default):
+    """A 'rate,burst' budget setting; '0' turns the limit off (None)"""
+    if setting is None:
+        return default
+    if setting.strip() in ('', '0'):
+        return None
+    rate, _, burst = setting.partition(',')
+    return float(rate), float(burst or rate)
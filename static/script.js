@@ -4,6 +4,14 @@ class EncryptedChatApp {
         this.currentUser = null;
         this.currentRoom = 'public';
         this.isEncryptionEnabled = true;
+        this.historyPageSize = 30;
+        this.historyTimeoutMs = 10000;
+        this.groupListVersion = 0;
+        this.groupElements = new Map();
+        // Groups this browser joined under the current username, remembered
+        // locally since the server does not reveal membership to an unproven name
+        this.memberGroups = new Set();
+        this.resetHistoryState();
         this.initializeElements();
         this.bindEvents();
         this.setupSocketListeners();
@@ -57,6 +65,11 @@ class EncryptedChatApp {
             if (e.key === 'Enter') this.sendMessage();
         });
 
+        // Load older messages when scrolled to the top
+        this.messagesContainer.addEventListener('scroll', () => {
+            if (this.messagesContainer.scrollTop < 50) this.loadOlderMessages();
+        });
+
         // Encryption toggle
         this.encryptToggle.addEventListener('change', (e) => {
             this.isEncryptionEnabled = e.target.checked;
@@ -90,15 +103,29 @@ class EncryptedChatApp {
             
             // Load public messages
             data.public_messages.forEach(msg => this.displayMessage(msg));
+            this.updateHistoryState(data.public_messages, data.has_more_history);
             
             // Update group list
+            this.groupListVersion = data.group_list_version;
+            this.memberGroups = this.loadMemberGroups();
             this.updateGroupList(data.available_groups);
+            if (this.memberGroups.size > 0) {
+                this.displaySystemMessage(`Use Rejoin and the group password to return to: ${[...this.memberGroups].join(', ')}`);
+            }
         });
 
         this.socket.on('new_message', (message) => {
+            // Joined groups deliver messages for rooms we are not viewing
+            if (message.room && message.room !== this.currentRoom) return;
             this.displayMessage(message);
         });
 
+        this.socket.on('new_messages', (batch) => {
+            // Busy rooms deliver several messages per event
+            if (batch.room !== this.currentRoom) return;
+            batch.messages.forEach(msg => this.displayMessage(msg));
+        });
+
         this.socket.on('user_joined', (data) => {
             this.displaySystemMessage(`${data.username} joined ${data.room}`);
         });
@@ -114,25 +141,69 @@ class EncryptedChatApp {
 
         this.socket.on('group_joined', (data) => {
             this.hideJoinGroupModal();
-            this.switchRoom(data.group_name);
+            this.memberGroups.add(data.group_name);
+            this.saveMemberGroups();
+            this.switchRoom(data.group_name, false);
             this.messagesContainer.innerHTML = '';
             data.messages.forEach(msg => this.displayMessage(msg));
+            this.updateHistoryState(data.messages, data.has_more_history);
+        });
+
+        this.socket.on('history_loaded', (data) => {
+            if (data.room !== this.currentRoom) return;
+            // A page for a cursor we have moved past arrived after its request was given up
+            if (data.before_message_id && data.before_message_id !== this.oldestMessageId) return;
+            this.finishHistoryRequest();
+
+            if (data.before_message_id) {
+                this.prependMessages(data.messages);
+            } else {
+                // Latest page for a room we just switched to
+                this.messagesContainer.innerHTML = '';
+                data.messages.forEach(msg => this.displayMessage(msg));
+            }
+            this.updateHistoryState(data.messages, data.has_more);
         });
 
         this.socket.on('group_left', (data) => {
             if (this.currentRoom === data.group_name) {
                 this.switchRoom('public');
             }
+            // Left for good, so a later session offers Join rather than Rejoin
+            this.memberGroups.delete(data.group_name);
+            this.saveMemberGroups();
+            const groupElement = this.groupElements.get(data.group_name);
+            if (groupElement) groupElement.querySelector('.join-group-btn').textContent = 'Join';
             this.displaySystemMessage(`Left group "${data.group_name}"`);
         });
 
         this.socket.on('group_list_updated', (data) => {
-            this.updateGroupList(data.available_groups);
+            if (data.available_groups) {
+                // Full list
+                this.groupListVersion = data.version;
+                this.updateGroupList(data.available_groups);
+            } else if (data.previous_version > this.groupListVersion) {
+                // Missed an update; ask for everything after our version
+                this.socket.emit('sync_group_list', { version: this.groupListVersion });
+            } else if (data.version > this.groupListVersion) {
+                // Deltas are net changes, so overlapping ones are safe to reapply
+                this.groupListVersion = data.version;
+                data.added.forEach(groupName => this.addGroupElement(groupName));
+                data.removed.forEach(groupName => this.removeGroupElement(groupName));
+            }
         });
 
         this.socket.on('error', (data) => {
+            this.finishHistoryRequest();
             alert(data.message);
         });
+
+        this.socket.on('rate_limited', (data) => {
+            if (data.event === 'load_history') this.finishHistoryRequest();
+            const wait = Math.max(1, Math.ceil(data.retry_after));
+            const cause = data.reason === 'backpressure' ? 'The server is busy' : 'You are sending too fast';
+            this.displaySystemMessage(`${cause}; try again in ${wait}s`);
+        });
     }
 
     switchScreen(screenName) {
@@ -188,7 +259,57 @@ class EncryptedChatApp {
         this.messageInput.value = '';
     }
 
+    resetHistoryState() {
+        this.oldestMessageId = null;
+        this.hasMoreHistory = false;
+        this.finishHistoryRequest();
+    }
+
+    updateHistoryState(messages, hasMore) {
+        if (messages.length > 0) {
+            this.oldestMessageId = messages[0].id;
+        }
+        this.hasMoreHistory = Boolean(hasMore) && this.oldestMessageId !== null;
+    }
+
+    requestHistory(beforeMessageId = null) {
+        this.isLoadingHistory = true;
+        // Rooms this connection has not joined get no answer, so never wait forever
+        clearTimeout(this.historyTimeout);
+        this.historyTimeout = setTimeout(() => this.finishHistoryRequest(), this.historyTimeoutMs);
+        this.socket.emit('load_history', {
+            room: this.currentRoom,
+            before_message_id: beforeMessageId,
+            limit: this.historyPageSize
+        });
+    }
+
+    finishHistoryRequest() {
+        clearTimeout(this.historyTimeout);
+        this.historyTimeout = null;
+        this.isLoadingHistory = false;
+    }
+
+    loadOlderMessages() {
+        if (!this.hasMoreHistory || this.isLoadingHistory) return;
+        this.requestHistory(this.oldestMessageId);
+    }
+
+    prependMessages(messages) {
+        // Keep the viewport anchored on what the user was reading
+        const previousHeight = this.messagesContainer.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(msg => fragment.appendChild(this.createMessageElement(msg)));
+        this.messagesContainer.insertBefore(fragment, this.messagesContainer.firstChild);
+        this.messagesContainer.scrollTop += this.messagesContainer.scrollHeight - previousHeight;
+    }
+
     displayMessage(message) {
+        this.messagesContainer.appendChild(this.createMessageElement(message));
+        this.messagesContainer.scrollTop = this.messagesContainer.scrollHeight;
+    }
+
+    createMessageElement(message) {
         const messageElement = document.createElement('div');
         messageElement.className = `message ${message.username === this.currentUser ? 'own' : ''}`;
 
@@ -221,8 +342,7 @@ class EncryptedChatApp {
             </div>
         `;
 
-        this.messagesContainer.appendChild(messageElement);
-        this.messagesContainer.scrollTop = this.messagesContainer.scrollHeight;
+        return messageElement;
     }
 
     displaySystemMessage(text) {
@@ -233,7 +353,7 @@ class EncryptedChatApp {
         this.messagesContainer.scrollTop = this.messagesContainer.scrollHeight;
     }
 
-    switchRoom(room) {
+    switchRoom(room, loadHistory = true) {
         // Update active room indicator
         document.querySelectorAll('.room-item').forEach(item => {
             item.classList.remove('active');
@@ -256,29 +376,62 @@ class EncryptedChatApp {
 
         // Clear messages when switching rooms
         this.messagesContainer.innerHTML = '';
+        this.resetHistoryState();
+
+        // Fetch the latest page; rooms that were not joined yet answer with nothing
+        if (loadHistory) this.requestHistory();
     }
 
     updateGroupList(groups) {
         this.groupList.innerHTML = '';
-        
-        groups.forEach(groupName => {
-            const groupElement = document.createElement('div');
-            groupElement.className = 'room-item';
-            groupElement.dataset.room = groupName;
-            groupElement.innerHTML = `
-                <span>${groupName}</span>
-                <button class="join-group-btn" data-group="${groupName}">Join</button>
-            `;
-            
-            // Add click handler for join button
-            const joinBtn = groupElement.querySelector('.join-group-btn');
-            joinBtn.addEventListener('click', (e) => {
-                e.stopPropagation();
-                this.showJoinGroupModal(groupName);
-            });
-            
-            this.groupList.appendChild(groupElement);
+        this.groupElements = new Map();
+
+        groups.forEach(groupName => this.addGroupElement(groupName));
+    }
+
+    addGroupElement(groupName) {
+        if (this.groupElements.has(groupName)) return;
+
+        const groupElement = document.createElement('div');
+        groupElement.className = 'room-item';
+        groupElement.dataset.room = groupName;
+        groupElement.innerHTML = `
+            <span>${groupName}</span>
+            <button class="join-group-btn" data-group="${groupName}">${this.memberGroups.has(groupName) ? 'Rejoin' : 'Join'}</button>
+        `;
+
+        // Add click handler for join button
+        const joinBtn = groupElement.querySelector('.join-group-btn');
+        joinBtn.addEventListener('click', (e) => {
+            e.stopPropagation();
+            this.showJoinGroupModal(groupName);
         });
+
+        this.groupElements.set(groupName, groupElement);
+        this.groupList.appendChild(groupElement);
+    }
+
+    loadMemberGroups() {
+        try {
+            return new Set(JSON.parse(localStorage.getItem(`groups:${this.currentUser}`)) || []);
+        } catch (e) {
+            return new Set();
+        }
+    }
+
+    saveMemberGroups() {
+        try {
+            localStorage.setItem(`groups:${this.currentUser}`, JSON.stringify([...this.memberGroups]));
+        } catch (e) {
+            // Storage disabled or full; Rejoin hints last for this page only
+        }
+    }
+
+    removeGroupElement(groupName) {
+        const groupElement = this.groupElements.get(groupName);
+        if (!groupElement) return;
+        groupElement.remove();
+        this.groupElements.delete(groupName);
     }
 
     showCreateGroupModal() {
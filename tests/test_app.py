@@ -0,0 +1,67 @@
+import asyncio
+import subprocess
+import tempfile
+import pytest  # type: ignore
+from encrypted_chat_app.benchmarks.socketio_load import LoadClient, free_port, start_server
+
+# Runs each server as a subprocess, the same way benchmarks/socketio_load.py does
+
+@pytest.fixture(params=['app', 'async'])
+def server_url(request):
+    with tempfile.TemporaryDirectory() as directory:
+        port = free_port()
+        process = start_server(request.param, 'snapshot', port, directory)
+        try:
+            yield f'http://127.0.0.1:{port}'
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+async def claim_member_username(url):
+    member = LoadClient(url, 'alice', ['websocket'], None)
+    await member.connect()
+    await member.call('create_group', {'group_name': 'secret', 'password': 'pw'}, 'group_created')
+    await member.send('secret', 0)
+    while member.received < 1:
+        await asyncio.sleep(0.01)
+    
+    # Same username on a new connection, without the group password
+    intruder = LoadClient(url, 'alice', ['websocket'], None)
+    await intruder.client.connect(url, transports=['websocket'])
+    joined, _ = await intruder.call('join_chat', {'username': 'alice'}, 'chat_joined')
+    # The group is listed like any other; nothing says this name is a member
+    assert 'joined_groups' not in joined
+    assert 'secret' in joined['available_groups']
+    
+    await member.send('secret', 1)
+    while member.received < 2:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.5)
+    assert intruder.received == 0
+    
+    # History of a room the connection has not entered is not served
+    with pytest.raises(asyncio.TimeoutError):
+        await intruder.call('load_history', {'room': 'secret'}, 'history_loaded', timeout=1)
+    
+    # join_group still wants the password
+    await intruder.call('join_group', {'group_name': 'secret', 'password': 'wrong'}, 'error')
+    await member.send('secret', 2)
+    while member.received < 3:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.5)
+    assert intruder.received == 0
+    
+    await intruder.call('join_group', {'group_name': 'secret', 'password': 'pw'}, 'group_joined')
+    await member.send('secret', 3)
+    while intruder.received < 1:
+        await asyncio.sleep(0.01)
+    
+    await intruder.disconnect()
+    await member.disconnect()
+
+def test_claimed_username_does_not_receive_group_traffic(server_url):
+    asyncio.run(asyncio.wait_for(claim_member_username(server_url), 60))
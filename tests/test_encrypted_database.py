@@ -0,0 +1,172 @@
+import os
+import uuid
+from datetime import datetime
+import pytest  # type: ignore
+from encrypted_chat_app.encrypted_database import EncryptedDatabase
+
+PASSWORD = 'test-password'
+
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / 'chat.db')
+
+def open_db(db_file, storage_mode, **options):
+    return EncryptedDatabase(db_file, PASSWORD, storage_mode=storage_mode, **options)
+
+def send(db, text, room='public'):
+    message = {
+        'id': str(uuid.uuid4()),
+        'user_id': 'user',
+        'username': 'alice',
+        'message': text,
+        'encrypted_content': '',
+        'timestamp': datetime.now().isoformat()
+    }
+    if room == 'public':
+        db.add_public_message(message)
+    else:
+        db.add_group_message(room, message)
+
+def history(db, room='public'):
+    return [message['message'] for message in db.get_messages_page(room, limit=1000)['messages']]
+
+def test_sharded_mode_keeps_history_of_a_snapshot_file(db_file):
+    db = open_db(db_file, 'snapshot')
+    db.create_group('team', 'alice')
+    send(db, 'public 1')
+    send(db, 'group 1', 'team')
+    db.close()
+    
+    db = open_db(db_file, 'sharded')
+    assert history(db) == ['public 1']
+    assert history(db, 'team') == ['group 1']
+    send(db, 'public 2')
+    db.close()
+    
+    db = open_db(db_file, 'sharded')
+    assert history(db) == ['public 1', 'public 2']
+    assert history(db, 'team') == ['group 1']
+    db.close()
+
+def test_sqlite_mode_imports_a_snapshot_file(db_file):
+    db = open_db(db_file, 'snapshot')
+    db.create_group('team', 'alice')
+    send(db, 'public 1')
+    send(db, 'group 1', 'team')
+    db.close()
+    
+    db = open_db(db_file, 'sqlite')
+    assert history(db) == ['public 1']
+    send(db, 'public 2')
+    db.close()
+    assert os.path.exists(db_file + '.pre-sqlite')
+    
+    db = open_db(db_file, 'sqlite')
+    assert history(db) == ['public 1', 'public 2']
+    assert history(db, 'team') == ['group 1']
+    db.close()
+
+def test_sqlite_mode_rejects_an_unreadable_file(db_file):
+    with open(db_file, 'wb') as file:
+        file.write(b'not a database')
+    with pytest.raises(ValueError, match='neither a SQLite database'):
+        open_db(db_file, 'sqlite')
+
+def crash(db):
+    """Drop a database without close(), so nothing is checkpointed on the way out"""
+    db.backend.close()
+
+def test_wal_replays_records_after_a_crash(db_file):
+    db = open_db(db_file, 'wal')
+    db.create_group('team', 'alice')
+    send(db, 'public 1')
+    send(db, 'group 1', 'team')
+    crash(db)
+    assert os.path.getsize(db_file + '.wal') > 0
+    
+    db = open_db(db_file, 'wal')
+    assert history(db) == ['public 1']
+    assert history(db, 'team') == ['group 1']
+    db.close()
+
+def test_wal_truncates_a_torn_tail(db_file):
+    db = open_db(db_file, 'wal')
+    send(db, 'public 1')
+    crash(db)
+    intact = os.path.getsize(db_file + '.wal')
+    # A record header promising more bytes than made it to disk
+    with open(db_file + '.wal', 'ab') as file:
+        file.write((1000).to_bytes(4, 'big') + b'torn')
+    
+    db = open_db(db_file, 'wal')
+    assert history(db) == ['public 1']
+    assert os.path.getsize(db_file + '.wal') == intact
+    send(db, 'public 2')
+    crash(db)
+    
+    db = open_db(db_file, 'wal')
+    assert history(db) == ['public 1', 'public 2']
+    db.close()
+
+def test_wal_checkpoint_then_reopen(db_file):
+    db = open_db(db_file, 'wal')
+    send(db, 'public 1')
+    assert db.save()
+    assert os.path.getsize(db_file + '.wal') == 0
+    send(db, 'public 2')
+    crash(db)
+    
+    db = open_db(db_file, 'wal')
+    assert history(db) == ['public 1', 'public 2']
+    db.close()
+
+@pytest.fixture
+def backup_chain(tmp_path, db_file):
+    """A full backup and two incremental backups, each after one more message"""
+    db = open_db(db_file, 'snapshot')
+    files = []
+    for index in range(3):
+        send(db, f'public {index + 1}')
+        files.append(db.create_backup(str(tmp_path / f'backup{index}.db'), incremental=index > 0))
+    db.close()
+    return files
+
+def test_restore_applies_an_incremental_backup_chain(tmp_path, backup_chain):
+    db = open_db(str(tmp_path / 'restored.db'), 'snapshot')
+    assert db.restore_from_backup(backup_chain[0], backup_chain[1:])
+    assert history(db) == ['public 1', 'public 2', 'public 3']
+    db.close()
+    
+    db = open_db(str(tmp_path / 'restored.db'), 'snapshot')
+    assert history(db) == ['public 1', 'public 2', 'public 3']
+    db.close()
+
+def test_restore_rejects_a_broken_chain(tmp_path, backup_chain):
+    db = open_db(str(tmp_path / 'restored.db'), 'snapshot')
+    send(db, 'kept')
+    # The second incremental does not follow the full backup directly
+    assert not db.restore_from_backup(backup_chain[0], backup_chain[2:])
+    # ...and an incremental is not a starting point
+    assert not db.restore_from_backup(backup_chain[1])
+    assert history(db) == ['kept']
+    db.close()
+
+def test_sqlite_migrates_v1_messages_without_an_id(db_file):
+    db = open_db(db_file, 'sqlite')
+    for index in range(5):
+        # A v1 record as older versions stored it, with no message id
+        db._execute({'op': 'add_message', 'room': 'public', 'message': {
+            'user_id': 'user',
+            'username': 'alice',
+            'encrypted_message': db.cipher.encrypt(f'old {index}'.encode()).decode(),
+            'timestamp': f'2024-01-01T00:00:0{index}',
+            'stored_at': f'2024-01-01T00:00:0{index}',
+            'room': 'public'
+        }})
+    assert db.migrate_messages(batch_size=2, pause=0) == 5
+    db.close()
+    
+    db = open_db(db_file, 'sqlite')
+    assert all(message.get('v') == 2 for message in db.data['public_messages'])
+    assert history(db) == [f'old {index}' for index in range(5)]
+    db.close()